@@ -0,0 +1,86 @@
+import argparse
+import timeit
+from copy import deepcopy
+from typing import Dict, List
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from config.mypath import Path
+from dataloaders.helpers import jaccard
+from networks.inference import INFERENCE_MODES, fuse_for_inference, set_inference_mode
+from networks.osvos_resnet import OSVOS_RESNET
+from networks.osvos_vgg import OSVOS_VGG
+from util import io_helper
+from util.logger import get_logger
+
+log = get_logger(__file__)
+
+
+def get_network(variant: str, version: int, path_model: str) -> torch.nn.Module:
+    if variant == 'vgg':
+        net = OSVOS_VGG(pretrained=0)
+    else:
+        net = OSVOS_RESNET(pretrained=False, version=version)
+    net.load_state_dict(torch.load(path_model, map_location=lambda storage, loc: storage))
+    net.eval()
+    return net
+
+
+def run(net: torch.nn.Module, data_loader: DataLoader) -> Dict[str, List]:
+    masks = []
+    times = []
+    gts = []
+    with torch.no_grad():
+        for minibatch in data_loader:
+            time_start = timeit.default_timer()
+            outputs = net(minibatch['image'])
+            prediction = outputs[-1].numpy()[0, 0]
+            times.append(timeit.default_timer() - time_start)
+
+            masks.append(prediction >= 0)  # sigmoid(x) >= 0.5
+            gts.append(minibatch['gt'].numpy()[0, 0] >= 0.5)
+    return {'masks': masks, 'times': times[1:], 'gts': gts}
+
+
+def main(variant: str, version: int, path_model: str, db_root_dir: str, seq_name: str, n_frames: int,
+         is_fusing: bool, n_threads: int) -> None:
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    net = get_network(variant, version, path_model)
+    if is_fusing:
+        net = fuse_for_inference(net)
+    data_loader = io_helper.get_data_loader_annotated(db_root_dir, seq_name, n_frames)
+
+    results = {}
+    for mode in INFERENCE_MODES:
+        results[mode] = run(set_inference_mode(deepcopy(net), mode), data_loader)
+
+    reference = results['fp32']
+    j_reference = np.mean([jaccard(gt, mask) for gt, mask in zip(reference['gts'], reference['masks'])])
+    for mode in INFERENCE_MODES:
+        result = results[mode]
+        j_mean = np.mean([jaccard(gt, mask) for gt, mask in zip(result['gts'], result['masks'])])
+        j_agreement = np.mean([jaccard(m_ref, m) for m_ref, m in zip(reference['masks'], result['masks'])])
+        times_ms = np.array(result['times']) * 1000
+        log.info('{0:>13}: J mean {1:.4f} (delta {2:+.4f}), J vs fp32 {3:.4f}, '
+                 'latency mean {4:.1f} ms, median {5:.1f} ms, p90 {6:.1f} ms'.format(
+                     mode, j_mean, j_mean - j_reference, j_agreement, times_ms.mean(), np.median(times_ms),
+                     np.percentile(times_ms, 90)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the inference modes on a DAVIS validation sequence')
+    parser.add_argument('--variant', default='resnet', choices=['resnet', 'vgg'])
+    parser.add_argument('--version', default=18, type=int)
+    parser.add_argument('--model', required=True, type=str, help='path to the state dict of the network')
+    parser.add_argument('--db-root-dir', default=Path.db_root_dir(), type=str)
+    parser.add_argument('-s', '--sequence-name', default='blackswan', type=str)
+    parser.add_argument('--n-frames', default=50, type=int)
+    parser.add_argument('--no-fuse', action='store_true', help='do not fold the batch norms and the upscaling')
+    parser.add_argument('--n-threads', default=None, type=int, help='number of CPU threads, torch default if not set')
+    args = parser.parse_args()
+
+    main(args.variant, args.version, args.model, args.db_root_dir, args.sequence_name, args.n_frames,
+         not args.no_fuse, args.n_threads)
@@ -0,0 +1,72 @@
+import argparse
+from typing import Optional
+
+import torch
+
+from networks.inference import INFERENCE_MODES, fuse_for_inference, set_inference_mode
+from networks.osvos_resnet import OSVOS_RESNET
+from networks.osvos_vgg import OSVOS_VGG
+from util import benchmark_helper
+from util.args_helper import parse_resolution
+from util.logger import get_logger
+
+log = get_logger(__file__)
+
+
+def get_network(variant: str, version: int, path_model: Optional[str], scale_down_exponent: int) -> torch.nn.Module:
+    """
+    Without a model path the weights stay randomly initialized, which does not change the latency
+    """
+    if variant == 'prune':
+        if path_model is None:
+            raise Exception('Pruned networks are saved as a whole, --model is required')
+        return torch.load(path_model, map_location=lambda storage, loc: storage)
+
+    if variant == 'vgg':
+        net = OSVOS_VGG(pretrained=0)
+    elif variant == 'mimic':
+        net = OSVOS_RESNET(pretrained=False, scale_down_exponent=scale_down_exponent, is_mode_mimic=True)
+    else:
+        net = OSVOS_RESNET(pretrained=False, version=version)
+    if path_model is not None:
+        net.load_state_dict(torch.load(path_model, map_location=lambda storage, loc: storage))
+    return net
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.n_threads is not None:
+        torch.set_num_threads(args.n_threads)
+    net = get_network(args.variant, args.version, args.model, args.scale_down_exponent)
+    net.eval()
+    if args.fuse:
+        net = fuse_for_inference(net)
+    if args.cuda:
+        net = net.cuda()
+    net = set_inference_mode(net, args.inference_mode)
+
+    name = args.name or '{0}{1}'.format(args.variant, '' if args.variant in ['vgg', 'prune'] else args.version)
+    results = benchmark_helper.benchmark_resolutions(net, args.resolutions, name, batch_size=args.batch_size,
+                                                     n_warmup=args.n_warmup, n_runs=args.n_runs)
+    if args.output is not None:
+        benchmark_helper.save_results(results, args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the inference latency of an OSVOS network')
+    parser.add_argument('--variant', default='resnet', choices=['vgg', 'resnet', 'prune', 'mimic'])
+    parser.add_argument('--version', default=18, type=int)
+    parser.add_argument('--model', default=None, type=str, help='path to the weights, or the whole pruned network')
+    parser.add_argument('--scale-down-exponent', default=0, type=int, help='channel reduction of mimic networks')
+    parser.add_argument('--name', default=None, type=str, help='name of the results, the variant by default')
+    parser.add_argument('--resolutions', default=[(480, 854)], type=parse_resolution, nargs='+',
+                        help='input resolutions as HxW')
+    parser.add_argument('--batch-size', default=1, type=int)
+    parser.add_argument('--n-warmup', default=5, type=int)
+    parser.add_argument('--n-runs', default=50, type=int)
+    parser.add_argument('--n-threads', default=None, type=int, help='number of CPU threads, torch default if not set')
+    parser.add_argument('--fuse', action='store_true', help='fold the batch norms and the upscaling')
+    parser.add_argument('--inference-mode', default='fp32', choices=INFERENCE_MODES)
+    parser.add_argument('--cuda', action='store_true')
+    parser.add_argument('--output', default=None, type=str, help='.json or .csv file to append the results to')
+
+    main(parser.parse_args())
@@ -0,0 +1,132 @@
+import argparse
+import timeit
+
+import torch
+from torch.autograd.graph import saved_tensors_hooks
+
+from layers.osvos_layers import class_balanced_cross_entropy_loss
+from util.logger import get_logger
+
+log = get_logger(__file__)
+
+
+def class_balanced_cross_entropy_loss_reference(output, label, size_average=True, is_balancing_per_sample=False):
+    """The former implementation of class_balanced_cross_entropy_loss, kept to check the fused one against"""
+    labels = torch.ge(label, 0.5).float()
+
+    num_labels_pos = _sum(labels, is_balancing_per_sample)
+    num_labels_neg = _sum(1.0 - labels, is_balancing_per_sample)
+    num_total = num_labels_pos + num_labels_neg
+
+    output_gt_zero = torch.ge(output, 0).float()
+    loss_val = torch.mul(output, (labels - output_gt_zero)) - torch.log(
+        1 + torch.exp(output - 2 * torch.mul(output, output_gt_zero)))
+
+    loss_pos = _sum(-torch.mul(labels, loss_val), is_balancing_per_sample)
+    loss_neg = _sum(-torch.mul(1.0 - labels, loss_val), is_balancing_per_sample)
+
+    final_loss = num_labels_neg / num_total * loss_pos + num_labels_pos / num_total * loss_neg
+
+    if size_average:
+        if is_balancing_per_sample:
+            final_loss = final_loss / (label.size()[1] * label.size()[2] * label.size()[3])
+        else:
+            final_loss = final_loss / (label.size()[0] * label.size()[1] * label.size()[2] * label.size()[3])
+
+    if is_balancing_per_sample:
+        final_loss = torch.sum(final_loss)
+
+    return final_loss
+
+
+def _sum(x, is_per_sample):
+    if is_per_sample:
+        return x.view(x.size()[0], -1).sum(dim=1)
+    return torch.sum(x)
+
+
+def loss_reference(outputs, gts):
+    return torch.stack([class_balanced_cross_entropy_loss_reference(o, gts, size_average=False,
+                                                                    is_balancing_per_sample=True)
+                        for o in outputs])
+
+
+def loss_fused(outputs, gts):
+    return class_balanced_cross_entropy_loss(outputs, gts, size_average=False, is_balancing_per_sample=True)
+
+
+def get_inputs(batch_size: int, height: int, width: int, n_heads: int, device: torch.device):
+    outputs = [(torch.randn(batch_size, 1, height, width, device=device) * 4).requires_grad_()
+               for _ in range(n_heads)]
+    gts = (torch.rand(batch_size, 1, height, width, device=device) > 0.8).float()
+    return outputs, gts
+
+
+def measure_saved_bytes(loss_function, outputs, gts) -> int:
+    """
+    Bytes of the tensors the autograd graph of the loss keeps alive until the backward pass
+    """
+    saved = {}
+
+    def pack(tensor):
+        saved[tensor.data_ptr()] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    with saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss_function(outputs, gts)
+    # the network outputs are alive anyway
+    ptrs_outputs = {o.data_ptr() for o in outputs}
+    return sum(n_bytes for ptr, n_bytes in saved.items() if ptr not in ptrs_outputs)
+
+
+def measure_time(loss_function, outputs, gts, n_runs: int) -> float:
+    def step():
+        for o in outputs:
+            o.grad = None
+        loss_function(outputs, gts).sum().backward()
+        if outputs[0].is_cuda:
+            torch.cuda.synchronize()
+
+    step()
+    return min(timeit.repeat(step, number=1, repeat=n_runs))
+
+
+def main(batch_size: int, height: int, width: int, n_heads: int, n_runs: int, use_cuda: bool) -> None:
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    outputs, gts = get_inputs(batch_size, height, width, n_heads, device)
+
+    losses_reference = loss_reference(outputs, gts)
+    losses_reference.sum().backward()
+    grads_reference = [o.grad.clone() for o in outputs]
+    for o in outputs:
+        o.grad = None
+    losses_fused = loss_fused(outputs, gts)
+    losses_fused.sum().backward()
+
+    error_loss = ((losses_fused - losses_reference).abs() / losses_reference.abs()).max().item()
+    error_grad = max((o.grad - g).abs().max().item() for o, g in zip(outputs, grads_reference))
+    log.info('Max relative loss difference: {0:.3e}'.format(error_loss))
+    log.info('Max absolute gradient difference: {0:.3e}'.format(error_grad))
+
+    for name, loss_function in [('reference', loss_reference), ('fused', loss_fused)]:
+        n_bytes = measure_saved_bytes(loss_function, outputs, gts)
+        time_step = measure_time(loss_function, outputs, gts, n_runs)
+        log.info('{0}: {1:.2f} MB saved for backward, {2:.2f} ms per forward + backward'.format(
+            name, n_bytes / 2 ** 20, time_step * 1000))
+        if use_cuda:
+            torch.cuda.reset_peak_memory_stats()
+            measure_time(loss_function, outputs, gts, 1)
+            log.info('{0}: {1:.2f} MB peak CUDA memory'.format(name, torch.cuda.max_memory_allocated() / 2 ** 20))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the fused class balanced loss with the former version')
+    parser.add_argument('--batch-size', default=1, type=int)
+    parser.add_argument('--height', default=480, type=int)
+    parser.add_argument('--width', default=854, type=int)
+    parser.add_argument('--n-heads', default=5, type=int, help='number of side outputs, 5 during offline training')
+    parser.add_argument('--n-runs', default=20, type=int)
+    parser.add_argument('--cuda', action='store_true')
+    args = parser.parse_args()
+
+    main(args.batch_size, args.height, args.width, args.n_heads, args.n_runs, args.cuda)
@@ -0,0 +1,52 @@
+import argparse
+
+import numpy as np
+import torch
+
+from benchmarks.inference_modes import get_network
+from benchmarks.temporal import run
+from config.mypath import Path
+from dataloaders.helpers import jaccard
+from networks.inference import fuse_for_inference
+from util import io_helper
+from util.logger import get_logger
+from util.roi_helper import RoiPredictor
+
+log = get_logger(__file__)
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.n_threads is not None:
+        torch.set_num_threads(args.n_threads)
+    net = fuse_for_inference(get_network(args.variant, args.version, args.model))
+
+    for seq_name in args.sequence_names:
+        data_loader = io_helper.get_data_loader_annotated(args.db_root_dir, seq_name, args.n_frames)
+        reference = run(net, data_loader)
+        log.info('{0} full: J mean {1:.4f}, latency mean {2:.1f} ms'.format(
+            seq_name, np.mean(reference['js']), 1000 * np.mean(reference['times'])))
+
+        for padding in args.paddings:
+            roi = RoiPredictor(net, padding=padding)
+            result = run(roi, data_loader)
+            j_agreement = np.mean([jaccard(m_ref, m) for m_ref, m in zip(reference['masks'], result['masks'])])
+            log.info('{0} padding {1}: {2:.1%} of the pixels, {3} full frames, J mean {4:.4f} (delta {5:+.4f}), '
+                     'J vs full {6:.4f}, latency mean {7:.1f} ms'.format(
+                         seq_name, padding, roi.area_fraction, roi.n_full, np.mean(result['js']),
+                         np.mean(result['js']) - np.mean(reference['js']), j_agreement,
+                         1000 * np.mean(result['times'])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pixel reduction and accuracy of the region of interest inference on '
+                                                 'DAVIS validation sequences')
+    parser.add_argument('--variant', default='resnet', choices=['resnet', 'vgg'])
+    parser.add_argument('--version', default=18, type=int)
+    parser.add_argument('--model', required=True, type=str, help='path to the state dict of the network')
+    parser.add_argument('--db-root-dir', default=Path.db_root_dir(), type=str)
+    parser.add_argument('-s', '--sequence-names', default=['blackswan', 'kite-surf'], nargs='+')
+    parser.add_argument('--n-frames', default=None, type=int, help='all frames of a sequence if not set')
+    parser.add_argument('--paddings', default=[0.1, 0.25, 0.5], type=float, nargs='+')
+    parser.add_argument('--n-threads', default=None, type=int, help='number of CPU threads, torch default if not set')
+
+    main(parser.parse_args())
@@ -0,0 +1,185 @@
+import argparse
+import sys
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import torch
+from torch import nn
+
+from layers.osvos_layers import DeepSupervisionLoss, center_crop
+from networks.osvos_resnet import OSVOS_RESNET
+from networks.osvos_vgg import OSVOS_VGG
+from util import benchmark_helper
+from util.args_helper import parse_resolution
+from util.benchmark_helper import BenchmarkResult
+from util.logger import get_logger
+
+log = get_logger(__file__)
+
+CASES = ['forward', 'forward_backward', 'loss', 'center_crop']
+PATH_BASELINE_DEFAULT = Path(__file__).parent / 'baseline.json'
+
+
+def make_pruned_resnet(fraction: float, seed: int = 0, n_min_channels: int = 4) -> OSVOS_RESNET:
+    """Synthetic pruned ResNet18: a random fraction of the inner channels of every residual block is removed,
+    which leaves the irregular channel counts the pruning in prune.py produces.
+    """
+    random = np.random.RandomState(seed)
+    net = OSVOS_RESNET(pretrained=False, version=18)
+    for stage in net.layer_stages:
+        for block in stage:
+            n_channels = block.conv1.out_channels
+            n_keep = max(n_min_channels, int(round(n_channels * (1 - fraction))))
+            keep = torch.from_numpy(np.sort(random.choice(n_channels, n_keep, replace=False)))
+
+            conv1 = nn.Conv2d(block.conv1.in_channels, n_keep, kernel_size=3, stride=block.conv1.stride,
+                              padding=1, bias=False)
+            conv1.weight.data.copy_(block.conv1.weight.data[keep])
+            bn1 = nn.BatchNorm2d(n_keep)
+            conv2 = nn.Conv2d(n_keep, block.conv2.out_channels, kernel_size=3, padding=1, bias=False)
+            conv2.weight.data.copy_(block.conv2.weight.data[:, keep])
+            block.conv1, block.bn1, block.conv2 = conv1, bn1, conv2
+    return net
+
+
+def get_variants() -> Dict[str, Callable[[], nn.Module]]:
+    variants = {
+        'vgg16': lambda: OSVOS_VGG(pretrained=0),
+        'resnet18': lambda: OSVOS_RESNET(pretrained=False, version=18),
+        'resnet34': lambda: OSVOS_RESNET(pretrained=False, version=34),
+    }
+    for k in range(7):
+        variants['mimic{0}'.format(k)] = (lambda k_: lambda: OSVOS_RESNET(pretrained=False, scale_down_exponent=k_,
+                                                                          is_mode_mimic=True))(k)
+    for percentage in [25, 50, 75]:
+        variants['pruned{0}'.format(percentage)] = (lambda p_: lambda: make_pruned_resnet(p_ / 100))(percentage)
+    return variants
+
+
+def run_network_cases(name: str, net: nn.Module, cases: List[str], resolutions: List[Tuple[int, int]],
+                      n_warmup: int, n_runs: int) -> List[BenchmarkResult]:
+    device = benchmark_helper.get_device(net)
+    criterion = DeepSupervisionLoss()
+    results = []
+    for height, width in resolutions:
+        inputs = torch.randn(1, 3, height, width, device=device)
+        gts = (torch.rand(1, 1, height, width, device=device) > 0.8).float()
+
+        if 'forward' in cases:
+            net.eval()
+            results.append(benchmark_helper.benchmark(net, [inputs], '{0}/forward'.format(name),
+                                                      n_warmup=n_warmup, n_runs=n_runs))
+
+        if 'forward_backward' in cases:
+            net.train()
+
+            def step():
+                net.zero_grad()
+                loss, _ = criterion(net(inputs), gts)
+                loss.backward()
+
+            results.append(benchmark_helper.benchmark_callable(step, '{0}/forward_backward'.format(name), device,
+                                                               height, width, n_warmup=n_warmup, n_runs=n_runs))
+    return results
+
+
+def run_layer_cases(cases: List[str], resolutions: List[Tuple[int, int]], n_warmup: int,
+                    n_runs: int) -> List[BenchmarkResult]:
+    device = torch.device('cpu')
+    criterion = DeepSupervisionLoss()
+    results = []
+    for height, width in resolutions:
+        if 'loss' in cases:
+            outputs = [torch.randn(1, 1, height, width, requires_grad=True) for _ in range(5)]
+            gts = (torch.rand(1, 1, height, width) > 0.8).float()
+
+            def step():
+                loss, _ = criterion(outputs, gts, side_weight=0.5)
+                loss.backward()
+
+            results.append(benchmark_helper.benchmark_callable(step, 'loss', device, height, width,
+                                                               n_warmup=n_warmup, n_runs=n_runs))
+
+        if 'center_crop' in cases:
+            # the 16 channel output of the upscaling of the last ResNet stage is 56 pixels larger than the input
+            upscaled = torch.randn(1, 16, height + 56, width + 56)
+
+            def crop():
+                center_crop(upscaled, height, width)
+
+            results.append(benchmark_helper.benchmark_callable(crop, 'center_crop', device, height, width,
+                                                               n_warmup=n_warmup, n_runs=n_runs))
+    return results
+
+
+def compare(results: List[BenchmarkResult], baseline: List[BenchmarkResult], max_slowdown: float) -> bool:
+    """
+    Log the change of the median latency of every result and return False if any exceeds max_slowdown
+    """
+    baseline = {_get_key(r): r for r in baseline}
+    is_passing = True
+    for result in results:
+        reference = baseline.get(_get_key(result))
+        if reference is None:
+            log.warn('{0} {1}x{2}: not in the baseline'.format(result.name, result.height, result.width))
+            continue
+        change = result.latency_p50_ms / reference.latency_p50_ms - 1
+        message = '{0} {1}x{2}: p50 {3:.2f} ms, baseline {4:.2f} ms ({5:+.1%})'.format(
+            result.name, result.height, result.width, result.latency_p50_ms, reference.latency_p50_ms, change)
+        if change > max_slowdown:
+            log.error(message + ' slower than allowed')
+            is_passing = False
+        else:
+            log.info(message)
+    return is_passing
+
+
+def _get_key(result: BenchmarkResult) -> Tuple:
+    return result.name, result.device, result.height, result.width, result.batch_size
+
+
+def main(args: argparse.Namespace) -> int:
+    torch.manual_seed(0)
+    if args.n_threads is not None:
+        torch.set_num_threads(args.n_threads)
+
+    variants = get_variants()
+    unknown = [v for v in args.variants if v not in variants]
+    if len(unknown) > 0:
+        raise Exception('Unknown variants {0}, must be in {1}'.format(unknown, list(variants.keys())))
+
+    results = run_layer_cases(args.cases, args.resolutions, args.n_warmup, args.n_runs)
+    for name in args.variants:
+        net = variants[name]()
+        results += run_network_cases(name, net, args.cases, args.resolutions, args.n_warmup, args.n_runs)
+
+    if args.output is not None:
+        benchmark_helper.save_results(results, args.output)
+
+    if args.save_baseline:
+        benchmark_helper.save_results(results, args.baseline, is_appending=False)
+        return 0
+    if not args.baseline.exists():
+        log.warn('No baseline at {0}, store one with --save-baseline'.format(str(args.baseline)))
+        return 0
+    is_passing = compare(results, benchmark_helper.load_results(args.baseline), args.max_slowdown)
+    return 0 if is_passing else 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time all network variants and fail on a slowdown against a baseline')
+    parser.add_argument('--variants', default=list(get_variants().keys()), nargs='+')
+    parser.add_argument('--cases', default=CASES, nargs='+', choices=CASES)
+    parser.add_argument('--resolutions', default=[(480, 854), (240, 427)], type=parse_resolution, nargs='+',
+                        help='input resolutions as HxW')
+    parser.add_argument('--n-warmup', default=2, type=int)
+    parser.add_argument('--n-runs', default=10, type=int)
+    parser.add_argument('--n-threads', default=None, type=int, help='number of CPU threads, torch default if not set')
+    parser.add_argument('--baseline', default=PATH_BASELINE_DEFAULT, type=Path)
+    parser.add_argument('--save-baseline', action='store_true', help='replace the baseline with the results')
+    parser.add_argument('--max-slowdown', default=0.2, type=float,
+                        help='fail if the median latency of a case grew by more than this fraction')
+    parser.add_argument('--output', default=None, type=str, help='.json or .csv file to append the results to')
+
+    sys.exit(main(parser.parse_args()))
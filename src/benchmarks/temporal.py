@@ -0,0 +1,70 @@
+import argparse
+import timeit
+from typing import Dict, List
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from benchmarks.inference_modes import get_network
+from config.mypath import Path
+from dataloaders.helpers import jaccard
+from networks.inference import fuse_for_inference
+from util import io_helper
+from util.logger import get_logger
+from util.temporal_helper import TemporalPredictor
+
+log = get_logger(__file__)
+
+
+def run(net: torch.nn.Module, data_loader: DataLoader) -> Dict[str, List]:
+    masks = []
+    times = []
+    js = []
+    with torch.no_grad():
+        for minibatch in data_loader:
+            time_start = timeit.default_timer()
+            outputs = net(minibatch['image'])
+            mask = outputs[-1].numpy()[0, 0] >= 0  # sigmoid(x) >= 0.5
+            times.append(timeit.default_timer() - time_start)
+
+            masks.append(mask)
+            js.append(jaccard(minibatch['gt'].numpy()[0, 0] >= 0.5, mask))
+    return {'masks': masks, 'times': times, 'js': js}
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.n_threads is not None:
+        torch.set_num_threads(args.n_threads)
+    net = fuse_for_inference(get_network(args.variant, args.version, args.model))
+
+    for seq_name in args.sequence_names:
+        data_loader = io_helper.get_data_loader_annotated(args.db_root_dir, seq_name, args.n_frames)
+        reference = run(net, data_loader)
+        log.info('{0} full: J mean {1:.4f}, latency mean {2:.1f} ms'.format(
+            seq_name, np.mean(reference['js']), 1000 * np.mean(reference['times'])))
+
+        for threshold in args.thresholds:
+            temporal = TemporalPredictor(net, threshold=threshold, max_skip=args.max_skip)
+            result = run(temporal, data_loader)
+            j_agreement = np.mean([jaccard(m_ref, m) for m_ref, m in zip(reference['masks'], result['masks'])])
+            log.info('{0} threshold {1}: skip rate {2:.1%}, J mean {3:.4f} (delta {4:+.4f}), J vs full {5:.4f}, '
+                     'latency mean {6:.1f} ms'.format(seq_name, threshold, temporal.skip_rate, np.mean(result['js']),
+                                                      np.mean(result['js']) - np.mean(reference['js']), j_agreement,
+                                                      1000 * np.mean(result['times'])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Skip rate and accuracy of the temporal mask reuse on DAVIS '
+                                                 'validation sequences')
+    parser.add_argument('--variant', default='resnet', choices=['resnet', 'vgg'])
+    parser.add_argument('--version', default=18, type=int)
+    parser.add_argument('--model', required=True, type=str, help='path to the state dict of the network')
+    parser.add_argument('--db-root-dir', default=Path.db_root_dir(), type=str)
+    parser.add_argument('-s', '--sequence-names', default=['blackswan', 'car-shadow', 'dance-twirl'], nargs='+')
+    parser.add_argument('--n-frames', default=None, type=int, help='all frames of a sequence if not set')
+    parser.add_argument('--thresholds', default=[1.0, 2.0, 4.0], type=float, nargs='+')
+    parser.add_argument('--max-skip', default=5, type=int)
+    parser.add_argument('--n-threads', default=None, type=int, help='number of CPU threads, torch default if not set')
+
+    main(parser.parse_args())
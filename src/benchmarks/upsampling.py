@@ -0,0 +1,69 @@
+import argparse
+import timeit
+
+import torch
+
+from networks.inference import export_for_inference
+from networks.osvos_resnet import OSVOS_RESNET
+from networks.osvos_vgg import OSVOS_VGG
+from util.logger import get_logger
+
+log = get_logger(__file__)
+
+
+def get_network(variant: str, version: int) -> torch.nn.Module:
+    if variant == 'vgg':
+        net = OSVOS_VGG(pretrained=0)
+    else:
+        net = OSVOS_RESNET(pretrained=False, version=version)
+    # the initialization of the side branches is close to 0, which would make the parity check meaningless
+    for m in net.modules():
+        if isinstance(m, torch.nn.Conv2d):
+            m.weight.data.normal_(0, 0.05)
+    net.eval()
+    return net
+
+
+def measure_time(net: torch.nn.Module, inputs: torch.Tensor, n_runs: int) -> float:
+    def step():
+        net(inputs)
+        if inputs.is_cuda:
+            torch.cuda.synchronize()
+
+    with torch.no_grad():
+        step()
+        return min(timeit.repeat(step, number=1, repeat=n_runs))
+
+
+def main(variant: str, version: int, height: int, width: int, n_runs: int, use_cuda: bool) -> None:
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    net = get_network(variant, version).to(device)
+    net_inference = export_for_inference(net)
+    inputs = torch.randn(1, 3, height, width, device=device)
+
+    with torch.no_grad():
+        outputs = net(inputs)
+        outputs_inference = net_inference(inputs)
+    for index, (o, o_inference) in enumerate(zip(outputs, outputs_inference)):
+        error = ((o - o_inference).abs().max() / o.abs().max()).item()
+        log.info('Output {0}: max relative difference {1:.3e}'.format(index, error))
+
+    time_original = measure_time(net, inputs, n_runs)
+    time_inference = measure_time(net_inference, inputs, n_runs)
+    log.info('original: {0:.2f} ms per forward'.format(time_original * 1000))
+    log.info('exported: {0:.2f} ms per forward'.format(time_inference * 1000))
+    log.info('speedup: {0:.2f}x'.format(time_original / time_inference))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the transposed convolution upscaling with the exported '
+                                                 'separable one and the fuse layer folded into the side branches')
+    parser.add_argument('--variant', default='resnet', choices=['resnet', 'vgg'])
+    parser.add_argument('--version', default=18, type=int)
+    parser.add_argument('--height', default=480, type=int)
+    parser.add_argument('--width', default=854, type=int)
+    parser.add_argument('--n-runs', default=10, type=int)
+    parser.add_argument('--cuda', action='store_true')
+    args = parser.parse_args()
+
+    main(args.variant, args.version, args.height, args.width, args.n_runs, args.cuda)
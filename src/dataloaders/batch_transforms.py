@@ -0,0 +1,52 @@
+import math
+from typing import Tuple
+
+import torch
+from torch.nn import functional as F
+
+
+class BatchScaleNRotate(object):
+    """Scale, rotate and horizontally flip a collated N x C x H x W batch of images and ground truths.
+
+    Every sample gets its own random affine transformation, which is shared by its image and its ground truth.
+    Images are sampled bilinearly, ground truths with nearest neighbours. Uncovered regions are filled with 0,
+    which is the mean value for mean subtracted images.
+    Args:
+        rots (tuple): (minimum, maximum) rotation angle in degrees
+        scales (tuple): (minimum, maximum) scale
+        is_flipping (bool): flip every sample with a probability of 0.5
+    """
+
+    def __init__(self, rots=(-30, 30), scales=(.75, 1.25), is_flipping=True):
+        self.rots = rots
+        self.scales = scales
+        self.is_flipping = is_flipping
+
+    def __call__(self, image: torch.Tensor, gt: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        theta = self.get_affine_matrices(image.size()[0], image.size()[2], image.size()[3], image.device)
+        grid = F.affine_grid(theta, list(image.size()), align_corners=False)
+
+        image = F.grid_sample(image, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        gt = F.grid_sample(gt.float(), grid, mode='nearest', padding_mode='zeros', align_corners=False)
+        return image, gt
+
+    def get_affine_matrices(self, n: int, height: int, width: int, device: torch.device) -> torch.Tensor:
+        """
+        Return the N x 2 x 3 matrices mapping normalized output coordinates to normalized input coordinates
+        """
+        rot = torch.empty(n, device=device).uniform_(self.rots[0], self.rots[1]) * math.pi / 180
+        sc = torch.empty(n, device=device).uniform_(self.scales[0], self.scales[1])
+        cos, sin = torch.cos(rot) / sc, torch.sin(rot) / sc
+
+        # inverse of cv2.getRotationMatrix2D, corrected for the aspect ratio of the normalized coordinates
+        theta = torch.zeros(n, 2, 3, device=device)
+        theta[:, 0, 0] = cos
+        theta[:, 0, 1] = -sin * height / width
+        theta[:, 1, 0] = sin * width / height
+        theta[:, 1, 1] = cos
+
+        if self.is_flipping:
+            flip = (torch.rand(n, device=device) < 0.5).float() * -2 + 1
+            theta[:, :, 0] *= flip.view(-1, 1)
+
+        return theta
@@ -0,0 +1,55 @@
+import random
+from typing import Iterator, List, Sequence, Tuple
+
+from torch.utils.data import Dataset, Sampler
+
+from dataloaders import custom_transforms
+
+
+class ScaleBucketBatchSampler(Sampler):
+    """Yield batches of (index, scale, is_flipping) keys, where all samples of a batch share the same scale.
+
+    This is the batched counterpart of RandomHorizontalFlip + Resize: the scale is drawn once per batch,
+    the flip once per sample, so every batch can be collated into a single tensor.
+    """
+
+    def __init__(self, n_samples: int, batch_size: int, scales: Sequence[float] = (0.5, 0.8, 1),
+                 shuffle: bool = True, is_flipping: bool = True):
+        self.n_samples = n_samples
+        self.batch_size = batch_size
+        self.scales = scales
+        self.shuffle = shuffle
+        self.is_flipping = is_flipping
+
+    def __iter__(self) -> Iterator[List[Tuple[int, float, bool]]]:
+        indices = list(range(self.n_samples))
+        if self.shuffle:
+            random.shuffle(indices)
+
+        for start in range(0, self.n_samples, self.batch_size):
+            scale = self.scales[random.randint(0, len(self.scales) - 1)]
+            yield [(index, scale, self.is_flipping and random.random() < 0.5)
+                   for index in indices[start:start + self.batch_size]]
+
+    def __len__(self) -> int:
+        return (self.n_samples + self.batch_size - 1) // self.batch_size
+
+
+class BucketedDataset(Dataset):
+    """Apply the augmentation chosen by ScaleBucketBatchSampler to the samples of a dataset without transform."""
+
+    def __init__(self, dataset: Dataset):
+        if dataset.transform is not None:
+            raise Exception('BucketedDataset applies the transforms itself, the dataset must not have any')
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, key: Tuple[int, float, bool]):
+        index, scale, is_flipping = key
+        sample = self.dataset[index]
+        if is_flipping:
+            sample = custom_transforms.HorizontalFlip()(sample)
+        sample = custom_transforms.Resize(scales=[scale])(sample)
+        return custom_transforms.ToTensor()(sample)
@@ -6,6 +6,7 @@ import numpy as np
 from scipy.misc import imresize
 from torch.utils.data import Dataset
 
+from dataloaders import preprocessing
 from util.logger import get_logger
 from config.mypath import Path
 
@@ -98,8 +99,7 @@ class CustomImages(Dataset):
             if self.labels[idx] is not None:
                 label = imresize(label, self.inputRes, interp='nearest')
 
-        img = np.array(img, dtype=np.float32)
-        img = np.subtract(img, np.array(self.meanval, dtype=np.float32))
+        img = preprocessing.subtract_mean(img, self.meanval)
 
         if self.labels[idx] is not None:
             gt = np.array(label, dtype=np.float32)
@@ -2,6 +2,9 @@ import random
 import cv2
 import numpy as np
 import torch
+from torch.utils.data.dataloader import default_collate
+
+from dataloaders import preprocessing
 
 
 class ScaleNRotate(object):
@@ -92,19 +95,29 @@ class Resize(object):
         return sample
 
 
+class HorizontalFlip(object):
+    """Horizontally flip the given image and ground truth."""
+
+    def __call__(self, sample):
+
+        for elem in sample.keys():
+            if elem in ['fname', 'seq_name']:
+                continue
+            else:
+                tmp = sample[elem]
+                tmp = cv2.flip(tmp, flipCode=1)
+                sample[elem] = tmp
+
+        return sample
+
+
 class RandomHorizontalFlip(object):
     """Horizontally flip the given image and ground truth randomly with a probability of 0.5."""
 
     def __call__(self, sample):
 
         if random.random() < 0.5:
-            for elem in sample.keys():
-                if elem in ['fname', 'seq_name']:
-                    continue
-                else:
-                    tmp = sample[elem]
-                    tmp = cv2.flip(tmp, flipCode=1)
-                    sample[elem] = tmp
+            sample = HorizontalFlip()(sample)
 
         return sample
 
@@ -131,3 +144,15 @@ class ToTensor(object):
                 sample[elem] = torch.from_numpy(tmp)
 
         return sample
+
+
+class SubtractMeanCollate(object):
+    """Collate samples with uint8 images (e.g. from a FrameCache) and subtract the mean value once per batch."""
+
+    def __init__(self, meanval=(104.00699, 116.66877, 122.67892)):
+        self.meanval = meanval
+
+    def __call__(self, batch):
+        minibatch = default_collate(batch)
+        minibatch['image'] = preprocessing.subtract_mean_tensor(minibatch['image'], self.meanval)
+        return minibatch
@@ -6,6 +6,8 @@ import numpy as np
 from scipy.misc import imresize
 from torch.utils.data import Dataset
 
+from dataloaders import preprocessing
+from dataloaders.frame_cache import FrameCache
 from util.logger import get_logger
 from config.mypath import Path
 
@@ -26,9 +28,12 @@ class DAVIS2016(Dataset):
                  db_root_dir='/media/eec/external/Databases/Segmentation/DAVIS-2016',
                  transform=None,
                  meanval=(104.00699, 116.66877, 122.67892),
-                 seq_name=None):
+                 seq_name=None,
+                 cache_dir=None):
         """Loads image to label pairs for tool pose estimation
         db_root_dir: dataset directory with subfolders "JPEGImages" and "Annotations"
+        cache_dir: if set, the frames are decoded once into a FrameCache in this directory. Images are then
+                   returned as uint8 without mean subtraction, see custom_transforms.SubtractMeanCollate
         """
         self.mode = mode.lower()
         self.inputRes = inputRes
@@ -73,6 +78,7 @@ class DAVIS2016(Dataset):
             tmp = [(s, f, i, l)
                    for s, f, i, l in zip(seq_list, fname_list, img_list, labels)
                    if s == self.seq_name]
+            frames = list(tmp)
             tmp = [(s, f, i, l if index == 0 else None)
                    for index, (s, f, i, l) in enumerate(tmp)]
             seq_list, fname_list, img_list, labels = list(zip(*tmp))
@@ -81,6 +87,9 @@ class DAVIS2016(Dataset):
                 fname_list = [fname_list[0]]
                 img_list = [img_list[0]]
                 labels = [labels[0]]
+                frames = frames[:1]
+        else:
+            frames = list(zip(seq_list, fname_list, img_list, labels))
 
         assert (len(labels) == len(img_list))
 
@@ -89,6 +98,11 @@ class DAVIS2016(Dataset):
         self.img_list = img_list
         self.labels = labels
 
+        self.frame_cache = None
+        if cache_dir is not None:
+            self.frame_cache = FrameCache(cache_dir, inputRes=inputRes)
+            self.frame_cache.update(frames, self._decode)
+
         log.info('Done initializing ' + fname + ' Dataset')
 
     def __len__(self):
@@ -112,20 +126,17 @@ class DAVIS2016(Dataset):
         """
         Make the image-ground-truth pair
         """
-        img = cv2.imread(os.path.join(self.db_root_dir, self.img_list[idx]))
-        if self.labels[idx] is not None:
-            label = cv2.imread(os.path.join(self.db_root_dir, self.labels[idx]), 0)
-        else:
-            gt = np.zeros(img.shape[:-1], dtype=np.uint8)
+        if self.frame_cache is not None:
+            img, gt = self.frame_cache.get(self.seq_list[idx], self.fname_list[idx])
+            if self.labels[idx] is None:
+                gt = np.zeros(img.shape[:-1], dtype=np.float32)
+            return img, gt
 
-        if self.inputRes is not None:
-            # inputRes = list(reversed(self.inputRes))
-            img = imresize(img, self.inputRes)
-            if self.labels[idx] is not None:
-                label = imresize(label, self.inputRes, interp='nearest')
+        img, label = self._decode(self.img_list[idx], self.labels[idx])
+        if self.labels[idx] is None:
+            gt = np.zeros(img.shape[:-1], dtype=np.float32)
 
-        img = np.array(img, dtype=np.float32)
-        img = np.subtract(img, np.array(self.meanval, dtype=np.float32))
+        img = preprocessing.subtract_mean(img, self.meanval)
 
         if self.labels[idx] is not None:
             gt = np.array(label, dtype=np.float32)
@@ -133,6 +144,23 @@ class DAVIS2016(Dataset):
 
         return img, gt
 
+    def _decode(self, img_path, label_path):
+        """
+        Read the image and the label (if any) and resize them to inputRes
+        """
+        img = cv2.imread(os.path.join(self.db_root_dir, img_path))
+        label = None
+        if label_path is not None:
+            label = cv2.imread(os.path.join(self.db_root_dir, label_path), 0)
+
+        if self.inputRes is not None:
+            # inputRes = list(reversed(self.inputRes))
+            img = imresize(img, self.inputRes)
+            if label_path is not None:
+                label = imresize(label, self.inputRes, interp='nearest')
+
+        return img, label
+
     def get_img_size(self):
         img = cv2.imread(os.path.join(self.db_root_dir, self.img_list[0]))
 
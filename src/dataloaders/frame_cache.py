@@ -0,0 +1,128 @@
+import json
+import os
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+from util.logger import get_logger
+
+log = get_logger(__file__)
+
+
+class FrameCache(object):
+    """Decoded frames of a dataset stored as memory-mapped arrays, one set of files per sequence.
+
+    Images are kept as uint8 (N x H x W x 3), masks as packed bits (N x ceil(H * W / 8)), so the
+    annotations are assumed to be binary. The index maps seq_name -> fname -> (position, has_label).
+    Arrays are opened lazily in every process, therefore DataLoader workers share the pages of the
+    page cache instead of each decoding the JPEGs again.
+    """
+
+    _index_file_name = 'index.json'
+
+    def __init__(self, cache_dir: str, inputRes: Optional[Tuple[int, int]] = None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.inputRes = None if inputRes is None else list(inputRes)
+        self._index = self._load_index()
+        self._arrays = {}  # type: Dict[str, Tuple[np.ndarray, np.ndarray]]
+
+    def __getstate__(self):
+        # memory maps must not be pickled into the workers, they would be copied as plain arrays
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
+    def update(self, frames: Iterable[Tuple[str, str, str, Optional[str]]],
+               decode: Callable[[str, Optional[str]], Tuple[np.ndarray, Optional[np.ndarray]]]) -> None:
+        """Decode every sequence that is missing frames in the cache.
+        frames: (seq_name, fname, img_path, label_path) tuples, label_path may be None
+        decode: maps (img_path, label_path) to a uint8 image and a uint8 label (or None)
+        """
+        sequences = {}
+        for seq_name, fname, img_path, label_path in frames:
+            sequences.setdefault(seq_name, []).append((fname, img_path, label_path))
+
+        for seq_name, seq_frames in sorted(sequences.items()):
+            if self._is_complete(seq_name, seq_frames):
+                continue
+            self._build_sequence(seq_name, seq_frames, decode)
+
+    def get(self, seq_name: str, fname: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return a copy of the uint8 image and the float32 {0, 1} mask of the given frame
+        """
+        position, _ = self._index['sequences'][seq_name]['frames'][fname]
+        images, masks = self._open(seq_name)
+        img = np.array(images[position])
+        n_pixels = img.shape[0] * img.shape[1]
+        gt = np.unpackbits(masks[position])[:n_pixels].reshape(img.shape[:2]).astype(np.float32)
+        return img, gt
+
+    def _is_complete(self, seq_name: str, seq_frames) -> bool:
+        entry = self._index['sequences'].get(seq_name)
+        if entry is None:
+            return False
+        for fname, _, label_path in seq_frames:
+            if fname not in entry['frames']:
+                return False
+            if label_path is not None and not entry['frames'][fname][1]:
+                return False
+        return True
+
+    def _build_sequence(self, seq_name: str, seq_frames, decode) -> None:
+        log.info('Caching decoded frames of sequence {0} in {1}'.format(seq_name, str(self.cache_dir)))
+        images = []
+        masks = []
+        frames = {}
+        for position, (fname, img_path, label_path) in enumerate(seq_frames):
+            img, label = decode(img_path, label_path)
+            images.append(img)
+            if label is None:
+                label = np.zeros(img.shape[:2], dtype=np.uint8)
+            masks.append(np.packbits(label.reshape(-1) > 0))
+            frames[fname] = (position, label_path is not None)
+
+        path_images, path_masks = self._get_paths(seq_name)
+        self._save(path_images, np.stack(images).astype(np.uint8))
+        self._save(path_masks, np.stack(masks))
+        self._arrays.pop(seq_name, None)
+
+        self._index['sequences'][seq_name] = {'frames': frames}
+        self._save_index()
+
+    def _open(self, seq_name: str) -> Tuple[np.ndarray, np.ndarray]:
+        arrays = self._arrays.get(seq_name)
+        if arrays is None:
+            path_images, path_masks = self._get_paths(seq_name)
+            arrays = (np.load(str(path_images), mmap_mode='r'), np.load(str(path_masks), mmap_mode='r'))
+            self._arrays[seq_name] = arrays
+        return arrays
+
+    def _get_paths(self, seq_name: str) -> Tuple[Path, Path]:
+        return self.cache_dir / (seq_name + '.images.npy'), self.cache_dir / (seq_name + '.masks.npy')
+
+    @staticmethod
+    def _save(path: Path, array: np.ndarray) -> None:
+        path_tmp = path.with_name(path.name + '.tmp')
+        with open(str(path_tmp), 'wb') as f:
+            np.save(f, array)
+        os.replace(str(path_tmp), str(path))
+
+    def _load_index(self) -> dict:
+        path_index = self.cache_dir / self._index_file_name
+        if path_index.exists():
+            with open(str(path_index)) as f:
+                index = json.load(f)
+            if index['inputRes'] == self.inputRes:
+                return index
+            log.warn('Frame cache {0} was built for another resolution, rebuilding'.format(str(self.cache_dir)))
+        return {'inputRes': self.inputRes, 'sequences': {}}
+
+    def _save_index(self) -> None:
+        path_index = self.cache_dir / self._index_file_name
+        path_tmp = path_index.with_name(path_index.name + '.tmp')
+        with open(str(path_tmp), 'w') as f:
+            json.dump(self._index, f)
+        os.replace(str(path_tmp), str(path_index))
@@ -139,3 +139,19 @@ def overlay_mask_tool(img, mask, transparency=1.0):
     im_over[:, :, 2] = (1 - mask[:, :, 2]) * img[:, :, 2] + mask[:, :, 2] * (
         transparency + (1 - transparency) * img[:, :, 2])
     return im_over
+
+
+def jaccard(annotation, segmentation):
+    """
+    Region similarity J of the DAVIS benchmark: intersection over union of two binary masks
+    annotation: ground truth mask
+    segmentation: predicted mask
+    return: 1 if both masks are empty
+    """
+    annotation = annotation.astype(np.bool_)
+    segmentation = segmentation.astype(np.bool_)
+
+    union = np.sum(annotation | segmentation)
+    if union == 0:
+        return 1.0
+    return np.sum(annotation & segmentation) / float(union)
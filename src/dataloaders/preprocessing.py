@@ -0,0 +1,43 @@
+from typing import Optional, Sequence
+
+import numpy as np
+import torch
+
+MEAN_VALUE = (104.00699, 116.66877, 122.67892)
+
+
+def subtract_mean(img: np.ndarray, meanval: Sequence[float] = MEAN_VALUE) -> np.ndarray:
+    """
+    uint8 (or float) H x W x C image to a float32 mean subtracted one, converted and subtracted in a single pass
+    """
+    return np.subtract(img, np.asarray(meanval, dtype=np.float32), dtype=np.float32)
+
+
+def subtract_mean_tensor(images: torch.Tensor, meanval: Sequence[float] = MEAN_VALUE) -> torch.Tensor:
+    """
+    uint8 (or float) N x C x H x W tensor to a float32 mean subtracted one, converted and subtracted in a single op
+    """
+    mean = torch.tensor(meanval, dtype=torch.float32, device=images.device).view(1, -1, 1, 1)
+    return torch.sub(images, mean)
+
+
+class FramePreprocessor(object):
+    """Turn uint8 H x W x C frames into 1 x C x H x W float input tensors of a network on device.
+
+    The frame is wrapped without copying and moved as uint8, then permuted, converted and mean subtracted in one op
+    into a buffer that is reused as long as the frame size does not change. The returned tensor is therefore only
+    valid until the next call, it must not be kept across frames.
+    """
+
+    def __init__(self, meanval: Sequence[float] = MEAN_VALUE, device: Optional[torch.device] = None):
+        self.device = torch.device('cpu') if device is None else device
+        self._mean = torch.tensor(meanval, dtype=torch.float32, device=self.device).view(1, -1, 1, 1)
+        self._buffer = None  # type: Optional[torch.Tensor]
+
+    def __call__(self, img: np.ndarray) -> torch.Tensor:
+        with torch.no_grad():
+            frame = torch.from_numpy(np.ascontiguousarray(img))
+            frame = frame.to(self.device).permute(2, 0, 1).unsqueeze(0)
+            if self._buffer is None or self._buffer.size() != frame.size():
+                self._buffer = torch.empty(frame.size(), dtype=torch.float32, device=self.device)
+            return torch.sub(frame, self._mean, out=self._buffer)
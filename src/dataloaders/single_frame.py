@@ -0,0 +1,81 @@
+import random
+from typing import List, Sequence
+
+import torch
+from torch.utils.data import Dataset
+
+from dataloaders import custom_transforms, preprocessing
+from util import gpu_handler
+from util.logger import get_logger
+
+log = get_logger(__file__)
+
+
+class SingleFrameLoader(object):
+    """Replacement of the DataLoader for online training, where the dataset consists of a single frame.
+
+    Every flip x scale variant of the frame is computed once with the same transforms as
+    io_helper.get_data_loader_train and kept in memory (on the GPU if available), so iterating
+    needs neither worker processes nor disk I/O. Without is_flipping only the unflipped variants are kept, for
+    augmentations that flip on the device.
+    """
+
+    def __init__(self, dataset: Dataset, batch_size: int = 1, scales: Sequence[float] = (0.5, 0.8, 1),
+                 is_flipping: bool = True):
+        if len(dataset) != 1:
+            raise Exception('SingleFrameLoader expects exactly one frame, got {0}'.format(len(dataset)))
+        if dataset.transform is not None:
+            raise Exception('SingleFrameLoader applies the transforms itself, the dataset must not have any')
+        self.dataset = dataset
+        self.batch_size = batch_size
+
+        sample = dataset[0]
+        self.seq_name = sample['seq_name']
+        self.fname = sample['fname']
+
+        if getattr(dataset, 'frame_cache', None) is not None:
+            # cached frames come without mean subtraction
+            sample['image'] = preprocessing.subtract_mean(sample['image'], dataset.meanval)
+
+        # images[index_scale] has shape n_flips x C x H x W, the first dimension being the flip
+        self.images = []  # type: List[torch.FloatTensor]
+        self.gts = []  # type: List[torch.FloatTensor]
+        flips = [False, True] if is_flipping else [False]
+        for scale in scales:
+            variants = [self._make_variant(sample, scale, is_flipped) for is_flipped in flips]
+            images, gts = zip(*variants)
+            self.images.append(gpu_handler.cast_cuda_if_possible(torch.stack(images)))
+            self.gts.append(gpu_handler.cast_cuda_if_possible(torch.stack(gts)))
+
+        log.info('Precomputed {0} variants of {1}/{2}'.format(len(flips) * len(scales), self.seq_name, self.fname))
+
+    def __len__(self):
+        return 1
+
+    def __iter__(self):
+        index_scale = random.randint(0, len(self.images) - 1)
+        images, gts = self.images[index_scale], self.gts[index_scale]
+        index_flip_max = images.size()[0] - 1
+        if self.batch_size == 1:
+            index_flip = random.randint(0, index_flip_max)
+            image, gt = images[index_flip:index_flip + 1], gts[index_flip:index_flip + 1]
+        else:
+            index_flip = torch.LongTensor([random.randint(0, index_flip_max) for _ in range(self.batch_size)])
+            index_flip = index_flip.to(images.device)
+            image, gt = images.index_select(0, index_flip), gts.index_select(0, index_flip)
+
+        yield {
+            'image': image,
+            'gt': gt,
+            'seq_name': [self.seq_name] * self.batch_size,
+            'fname': [self.fname] * self.batch_size
+        }
+
+    @staticmethod
+    def _make_variant(sample: dict, scale: float, is_flipping: bool):
+        variant = dict(sample)
+        if is_flipping:
+            variant = custom_transforms.HorizontalFlip()(variant)
+        variant = custom_transforms.Resize(scales=[scale])(variant)
+        variant = custom_transforms.ToTensor()(variant)
+        return variant['image'].float(), variant['gt'].float()
@@ -1,8 +1,10 @@
 from __future__ import division
+from functools import lru_cache
 import numpy as np
 import torch
 from PIL import Image
-from torch.autograd import Variable
+from torch.autograd import Function, Variable
+from torch import nn
 from torch.nn import functional as F
 
 
@@ -14,44 +16,136 @@ def sigmoid_np(x):
     return 1 / (1 + np.exp(-x))
 
 
-def class_balanced_cross_entropy_loss(output, label, size_average=True):
+def class_balanced_cross_entropy_loss(output, label, size_average=True, is_balancing_per_sample=False):
     """Define the class balanced cross entropy loss to train the network
     Args:
-    output: Output of the network
+    output: Output of the network, or a list (or K x N x C x H x W stack) of the outputs of several heads
     label: Ground truth label
+    size_average: divide the loss by the number of pixels
+    is_balancing_per_sample: balance the classes of every sample of the batch separately and sum the losses,
+                             which is equivalent to accumulating the gradients of the samples one by one
     Returns:
-    Tensor that evaluates the loss
+    Tensor that evaluates the loss, with one value per head if several heads were given
     """
+    is_single_head = torch.is_tensor(output) and output.dim() == label.dim()
+    if is_single_head:
+        outputs = [output]
+    elif torch.is_tensor(output):
+        outputs = list(output.unbind(0))
+    else:
+        outputs = list(output)
 
-    labels = torch.ge(label, 0.5).float()
+    is_pos = torch.ge(label, 0.5)
+    if is_balancing_per_sample:
+        num_labels_pos = is_pos.view(is_pos.size()[0], -1).sum(dim=1).float().view(-1, 1, 1, 1)
+        num_total = label[0].numel()
+    else:
+        num_labels_pos = is_pos.sum().float()
+        num_total = label.numel()
+    num_labels_neg = num_total - num_labels_pos
 
-    num_labels_pos = torch.sum(labels)
-    num_labels_neg = torch.sum(1.0 - labels)
-    num_total = num_labels_pos + num_labels_neg
+    # the weights already contain the division by the number of pixels
+    divisor = num_total if size_average else 1
+    weight_pos = num_labels_neg / (num_total * divisor)
+    weight_neg = num_labels_pos / (num_total * divisor)
 
-    output_gt_zero = torch.ge(output, 0).float()
-    loss_val = torch.mul(output, (labels - output_gt_zero)) - torch.log(
-        1 + torch.exp(output - 2 * torch.mul(output, output_gt_zero)))
+    losses = _ClassBalancedCrossEntropy.apply(is_pos, weight_pos, weight_neg, *outputs)
+    return losses[0] if is_single_head else losses
 
-    loss_pos = torch.sum(-torch.mul(labels, loss_val))
-    loss_neg = torch.sum(-torch.mul(1.0 - labels, loss_val))
 
-    final_loss = num_labels_neg / num_total * loss_pos + num_labels_pos / num_total * loss_neg
+class _ClassBalancedCrossEntropy(Function):
+    """Weighted binary cross entropy on logits, written as softplus(-x) for positives and softplus(x) for negatives.
+    Only the boolean labels are kept for the backward pass, which computes weight * (sigmoid(x) - label) directly.
+    """
 
-    if size_average:
-        final_loss = final_loss / (label.size()[0] * label.size()[1] * label.size()[2] * label.size()[3])
+    @staticmethod
+    def forward(ctx, is_pos, weight_pos, weight_neg, *outputs):
+        weight_signed = torch.where(is_pos, -weight_pos, weight_neg).to(outputs[0].dtype)
+        weight = weight_signed.abs()
 
-    return final_loss
+        losses = outputs[0].new_empty(len(outputs))
+        for index, output in enumerate(outputs):
+            logits_signed = torch.where(is_pos, -output, output)
+            losses[index] = torch.sum(F.softplus(logits_signed).mul_(weight))
 
+        ctx.save_for_backward(is_pos, weight_signed, *outputs)
+        return losses
 
-def center_crop(x, height, width):
-    crop_h = torch.FloatTensor([x.size()[2]]).sub(height).div(-2)
-    crop_w = torch.FloatTensor([x.size()[3]]).sub(width).div(-2)
+    @staticmethod
+    def backward(ctx, grad_losses):
+        is_pos, weight_signed = ctx.saved_tensors[:2]
+        outputs = ctx.saved_tensors[2:]
+
+        grads = []
+        for index, output in enumerate(outputs):
+            if not ctx.needs_input_grad[3 + index]:
+                grads.append(None)
+                continue
+            grad = torch.sigmoid(torch.where(is_pos, -output, output))
+            grads.append(grad.mul_(weight_signed).mul_(grad_losses[index]))
 
-    return F.pad(x, [
-        crop_w.ceil().int()[0], crop_w.floor().int()[0],
-        crop_h.ceil().int()[0], crop_h.floor().int()[0],
-    ])
+        return (None, None, None) + tuple(grads)
+
+
+class DeepSupervisionLoss(nn.Module):
+    """Loss over all side outputs of OSVOS_RESNET / OSVOS_VGG, the fused output being the last one.
+    The side outputs are weighted by side_weight, usually 1 - epoch / n_epochs, the fused output by 1.
+    Args:
+    criterion: loss of a single output and its target, the class balanced cross entropy of all heads at once if None
+    size_average, is_balancing_per_sample: passed to the class balanced cross entropy if no criterion is given
+    Returns:
+    The total loss and the detached losses of the heads, which stay on the device until they are logged
+    """
+
+    def __init__(self, criterion=None, size_average=False, is_balancing_per_sample=True):
+        super(DeepSupervisionLoss, self).__init__()
+        self.criterion = criterion
+        self.size_average = size_average
+        self.is_balancing_per_sample = is_balancing_per_sample
+
+    def forward(self, outputs, targets, side_weight=1.0):
+        if self.criterion is None:
+            losses = class_balanced_cross_entropy_loss(outputs, targets, size_average=self.size_average,
+                                                       is_balancing_per_sample=self.is_balancing_per_sample)
+        else:
+            if torch.is_tensor(targets):
+                targets = [targets] * len(outputs)
+            losses = torch.stack([self.criterion(o, t) for o, t in zip(outputs, targets)])
+
+        weights = losses.new_full((len(outputs),), side_weight)
+        weights[-1] = 1
+        loss = torch.dot(weights, losses)
+        return loss, losses.detach()
+
+
+def center_crop(x, height, width):
+    """Crop the last two dimensions of x to height x width around the center, as a view if x is large enough"""
+    slice_h, slice_w, padding = _get_crop_plan(x.size()[2], x.size()[3], int(height), int(width))
+    x = x[:, :, slice_h, slice_w]
+    if padding is not None:
+        x = F.pad(x, padding)
+    return x
+
+
+@lru_cache(maxsize=64)
+def _get_crop_plan(size_h, size_w, height, width):
+    """Slices of the cropped region and, if the input is smaller than the target, the remaining padding.
+    Matches the former F.pad with (negative) padding of ceil(-d / 2) before and floor(-d / 2) after, d = size - target
+    """
+    slice_h, pad_h = _get_crop_plan_1d(size_h, height)
+    slice_w, pad_w = _get_crop_plan_1d(size_w, width)
+    padding = pad_w + pad_h
+    if not any(padding):
+        padding = None
+    return slice_h, slice_w, padding
+
+
+def _get_crop_plan_1d(size, target):
+    d = size - target
+    if d >= 0:
+        start = d // 2
+        return slice(start, start + target), (0, 0)
+    return slice(0, size), ((-d + 1) // 2, -d // 2)
 
 
 def upsample_filt(size):
@@ -1,5 +1,6 @@
 import argparse
 from pathlib import Path
+from functools import partial
 from typing import Optional
 import shutil
 
@@ -8,7 +9,7 @@ from torch import nn, optim
 from torch.autograd import Variable
 from tensorboardX import SummaryWriter
 
-from layers.osvos_layers import class_balanced_cross_entropy_loss
+from layers.osvos_layers import DeepSupervisionLoss, class_balanced_cross_entropy_loss
 from networks.osvos_resnet import OSVOS_RESNET
 from util import gpu_handler, experiment_helper, io_helper
 from util.logger import get_logger
@@ -58,7 +59,7 @@ def main(n_epochs: int, sequence_name: Optional[str], is_offline_mode: bool, sca
                                                     seq_name=sequence_name)
 
     if not no_training:
-        dataloader_train = io_helper.get_data_loader_train(Path('/usr/stud/ondrag/DAVIS'), batch_size=1,
+        dataloader_train = io_helper.get_data_loader_train(Path('/usr/stud/ondrag/DAVIS'), batch_size=5,
                                                            seq_name=sequence_name)
         net_teacher = None
         if learn_from == 'teacher':
@@ -74,13 +75,16 @@ def main(n_epochs: int, sequence_name: Optional[str], is_offline_mode: bool, sca
         optimizer = optim.Adam(net_student.parameters(), lr=learning_rate, weight_decay=0.0002)
 
         if criterion == 'MSE':
-            criterion = nn.MSELoss(size_average=False)
+            criterion = DeepSupervisionLoss(nn.MSELoss(size_average=False))
             criterion = gpu_handler.cast_cuda_if_possible(criterion)
         elif criterion == 'L1':
-            criterion = nn.L1Loss(size_average=False)
+            criterion = DeepSupervisionLoss(nn.L1Loss(size_average=False))
             criterion = gpu_handler.cast_cuda_if_possible(criterion)
+        elif criterion == 'CBCEL' and learn_from == 'teacher':
+            criterion = DeepSupervisionLoss(partial(class_balanced_cross_entropy_loss, is_balancing_per_sample=True))
         elif criterion == 'CBCEL':
-            criterion = class_balanced_cross_entropy_loss
+            # all heads share the ground truth, so their losses are computed at once
+            criterion = DeepSupervisionLoss(size_average=True)
         else:
             raise Exception('Unknown loss function')
 
@@ -153,38 +157,40 @@ def calculate_loss(criterion, epoch, n_epochs, learn_from, net_student, net_teac
             net_teacher.eval()
 
     n_samples_train = len(dataloader)
-    running_loss_train = [0] * 5
+    if n_samples_train == 0:
+        log.warning('No {0} minibatches in epoch {1}, skipping its loss'.format(mode, epoch))
+        return
+    # the losses are summed up on the device and only copied to the host once per epoch
+    running_loss_train = 0
+    loss_iter = []
     loss_train = []
-    counter_gradient = 0
-    avg_grad_every_n = 5
 
     loss_epoch = 0.0
     for index, minibatch in enumerate(dataloader):
-        loss = _get_loss_minibatch(criterion, epoch, n_epochs, learn_from, minibatch, net_student, net_teacher)
-        loss_epoch += loss.data[0]
+        loss, losses = _get_loss_minibatch(criterion, epoch, n_epochs, learn_from, minibatch, net_student,
+                                           net_teacher)
+        loss_epoch += loss.detach()
+        running_loss_train = running_loss_train + losses
+
+        if mode == 'train':
+            loss.backward()
+            loss_iter.append(loss.detach())
+            optimizer.step()
+            optimizer.zero_grad()
 
         if index % n_samples_train == n_samples_train - 1:
-            running_loss_train = [x / n_samples_train for x in running_loss_train]
+            running_loss_train = (running_loss_train / n_samples_train).tolist()
             loss_train.append(running_loss_train[-1])
             summary_writer.add_scalar('total_loss_epoch', running_loss_train[-1], epoch)
+            for i, loss_i in enumerate(torch.stack(loss_iter).tolist() if loss_iter else []):
+                summary_writer.add_scalar('total_loss_iter', loss_i, i + n_samples_train * epoch)
             log.info('[Epoch: %d, numImages: %5d]' % (epoch, index + 1))
             for l in range(0, len(running_loss_train)):
                 log.info('Loss %d: %f' % (l, running_loss_train[l]))
-                running_loss_train[l] = 0
-
-        if mode == 'train':
-            loss /= avg_grad_every_n
-            loss.backward()
-
-        counter_gradient += 1
+            running_loss_train = 0
+            loss_iter = []
 
-        if counter_gradient % avg_grad_every_n == 0 and mode == 'train':
-            summary_writer.add_scalar('total_loss_iter', loss.data[0], index + n_samples_train * epoch)
-            optimizer.step()
-            optimizer.zero_grad()
-            counter_gradient = 0
-
-    loss_epoch /= len(dataloader.dataset)
+    loss_epoch = loss_epoch.item() / n_samples_train
     summary_writer.add_scalar('{mode}/loss'.format(mode=mode), loss_epoch, epoch)
 
 
@@ -201,21 +207,15 @@ def _get_loss_minibatch(criterion, epoch, n_epochs, learn_from, minibatch, net_s
         ground_truth = Variable(ground_truth)
         ground_truth = gpu_handler.cast_cuda_if_possible(ground_truth)
 
-    losses = [0] * len(outputs_student)
-    for i in range(0, len(outputs_student)):
-        o_student = outputs_student[i]
-        o_student = gpu_handler.cast_cuda_if_possible(o_student)
-
-        if learn_from == 'teacher':
-            o_teacher = outputs_teacher[i]
-            o_teacher = o_teacher.detach()
-            o_teacher = gpu_handler.cast_cuda_if_possible(o_teacher)
-            losses[i] = criterion(o_student, o_teacher)
-        else:
-            losses[i] = criterion(o_student, ground_truth)
+    if learn_from == 'teacher':
+        targets = [o_teacher.detach() for o_teacher in outputs_teacher]
+    else:
+        targets = ground_truth
 
-    loss = (1 - epoch / n_epochs) * sum(losses[:-1]) + losses[-1]  # type: Variable
-    return loss
+    # average over the samples of the batch, all criteria sum over them
+    loss, losses = criterion(outputs_student, targets, side_weight=1 - epoch / n_epochs)
+    batch_size = inputs_image.size()[0]
+    return loss / batch_size, losses / batch_size
 
 
 if __name__ == '__main__':
@@ -0,0 +1,252 @@
+from copy import deepcopy
+from typing import List, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+from layers.osvos_layers import center_crop, upsample_filt
+from networks.osvos_resnet import OSVOS_RESNET
+from networks.osvos_vgg import OSVOS_VGG
+from util.logger import get_logger
+
+log = get_logger(__file__)
+
+
+class SeparableBilinearUpsample(nn.Module):
+    """Fixed bilinear upsampling of every channel, equivalent to a ConvTranspose2d initialized by interp_surgery.
+
+    The 2D bilinear filter is the outer product of a 1D filter, so the upsampling is done by two depthwise
+    transposed convolutions along the height and the width, which needs 2 * k instead of k * k * C multiplications
+    per input pixel and output channel.
+    """
+
+    def __init__(self, n_channels: int, kernel_size: int, stride: int):
+        super(SeparableBilinearUpsample, self).__init__()
+        self.n_channels = n_channels
+        self.kernel_size = kernel_size
+        self.stride = stride
+
+        filt = torch.from_numpy(_upsample_filt_1d(kernel_size)).float()
+        self.register_buffer('weight_h', filt.view(1, 1, kernel_size, 1).repeat(n_channels, 1, 1, 1))
+        self.register_buffer('weight_w', filt.view(1, 1, 1, kernel_size).repeat(n_channels, 1, 1, 1))
+
+    def forward(self, x):
+        x = F.conv_transpose2d(x, self.weight_h, stride=(self.stride, 1), groups=self.n_channels)
+        return F.conv_transpose2d(x, self.weight_w, stride=(1, self.stride), groups=self.n_channels)
+
+    def extra_repr(self):
+        return '{0}, kernel_size={1}, stride={2}'.format(self.n_channels, self.kernel_size, self.stride)
+
+
+class OSVOSInference(nn.Module):
+    """Inference-only version of OSVOS_RESNET and OSVOS_VGG with the same outputs.
+
+    The fuse layer is a 1x1 convolution over the concatenated, upscaled side_prep outputs. Upscaling, cropping and
+    the 1x1 convolution are linear and act on every channel alike, so they commute: every side branch applies its
+    slice of the fuse weights at low resolution and only upscales a single channel. Together with score_dsn this
+    gives one 2-channel 1x1 convolution and one upscaling per side branch.
+    """
+
+    def __init__(self, stem: nn.Module, stages: nn.ModuleList, side_prep: nn.ModuleList, scores: nn.ModuleList,
+                 upscales: nn.ModuleList, bias_fuse: torch.Tensor):
+        super(OSVOSInference, self).__init__()
+        self.stem = stem
+        self.stages = stages
+        self.side_prep = side_prep
+        self.scores = scores
+        self.upscales = upscales
+        self.register_buffer('bias_fuse', bias_fuse.view(1, -1, 1, 1))
+
+    def forward(self, x):
+        crop_h, crop_w = int(x.size()[-2]), int(x.size()[-1])
+        x = self.stem(x)
+
+        side_out = []
+        out = self.bias_fuse
+        for layer_stage, layer_side_prep, layer_scores, layer_upscale in zip(self.stages, self.side_prep,
+                                                                              self.scores, self.upscales):
+            x = layer_stage(x)
+            scores = layer_upscale(layer_scores(layer_side_prep(x)))
+            scores = center_crop(scores, crop_h, crop_w)
+            side_out.append(scores[:, :1])
+            out = out + scores[:, 1:]
+
+        side_out.append(out)
+        return side_out
+
+
+def export_for_inference(net: Union[OSVOS_RESNET, OSVOS_VGG], atol: float = 1e-6) -> OSVOSInference:
+    """Return an OSVOSInference network with copies of the weights of net, which is left untouched.
+    Raises an exception if an upscaling layer does not hold the fixed bilinear filter anymore.
+    """
+    if isinstance(net, OSVOS_RESNET):
+        stem, stages = net.layer_base, net.layer_stages
+        side_prep, score_dsn, fuse = net.side_prep, net.score_dsn, net.layer_fuse
+        upscale_side_prep, upscale_score_dsn = net.upscale_side_prep, net.upscale_score_dsn
+    elif isinstance(net, OSVOS_VGG):
+        stem, stages = net.stages[0], net.stages[1:]
+        side_prep, score_dsn, fuse = net.side_prep, net.score_dsn, net.fuse
+        upscale_side_prep, upscale_score_dsn = net.upscale, net.upscale_
+    else:
+        raise Exception('Cannot export {0} for inference'.format(type(net).__name__))
+
+    weights_fuse = _split_fuse_weights(fuse, [m.out_channels for m in upscale_side_prep])
+
+    scores = nn.ModuleList()
+    upscales = nn.ModuleList()
+    for layer_score_dsn, layer_upscale_side_prep, layer_upscale_score_dsn, weight_fuse in zip(
+            score_dsn, upscale_side_prep, upscale_score_dsn, weights_fuse):
+        kernel_size, stride = _get_bilinear_geometry(layer_upscale_side_prep, atol)
+        if _get_bilinear_geometry(layer_upscale_score_dsn, atol) != (kernel_size, stride):
+            raise Exception('The upscaling layers of a side branch differ in kernel size or stride')
+
+        # channel 0: score_dsn, channel 1: the part of fuse belonging to this branch
+        layer_scores = nn.Conv2d(layer_score_dsn.in_channels, layer_score_dsn.out_channels + fuse.out_channels,
+                                 kernel_size=1, padding=0)
+        layer_scores.weight.data.copy_(torch.cat([layer_score_dsn.weight.data, weight_fuse]))
+        layer_scores.bias.data.copy_(torch.cat([layer_score_dsn.bias.data, torch.zeros_like(fuse.bias.data)]))
+        scores.append(layer_scores)
+        upscales.append(SeparableBilinearUpsample(layer_scores.out_channels, kernel_size, stride))
+
+    net_inference = OSVOSInference(deepcopy(stem), deepcopy(nn.ModuleList(stages)), deepcopy(side_prep), scores,
+                                   upscales, fuse.bias.data.clone())
+    net_inference = net_inference.to(fuse.weight.device)
+    net_inference.eval()
+    log.info('Exported {0} for inference'.format(type(net).__name__))
+    return net_inference
+
+
+INFERENCE_MODES = ['fp32', 'channels_last', 'bf16']
+
+
+class InferenceModeWrapper(nn.Module):
+    """Run a network in channels-last memory format, optionally with bfloat16 weights and activations.
+    Inputs are converted on the fly and the outputs are returned as float32, so callers stay unchanged.
+    The wrapped network is a copy, net itself keeps its dtype, memory format and mode.
+    """
+
+    def __init__(self, net: nn.Module, mode: str):
+        super(InferenceModeWrapper, self).__init__()
+        if mode not in INFERENCE_MODES:
+            raise Exception('Unknown inference mode {0}, must be one of {1}'.format(mode, INFERENCE_MODES))
+        self.mode = mode
+        self.dtype = torch.bfloat16 if mode == 'bf16' else torch.float32
+        self.net = deepcopy(net).to(dtype=self.dtype, memory_format=torch.channels_last)
+        self.net.eval()
+
+    def forward(self, x):
+        x = x.to(dtype=self.dtype).contiguous(memory_format=torch.channels_last)
+        with torch.no_grad():
+            outputs = self.net(x)
+        return [o.float() for o in outputs]
+
+
+def set_inference_mode(net: nn.Module, mode: str) -> nn.Module:
+    """
+    Return net itself for fp32, else an InferenceModeWrapper of it
+    """
+    if mode == 'fp32':
+        return net
+    log.info('Using inference mode {0}'.format(mode))
+    return InferenceModeWrapper(net, mode)
+
+
+def fuse_for_inference(net: nn.Module) -> nn.Module:
+    """Return a frozen eval-only copy of net with every BatchNorm2d folded into the preceding convolution.
+    This covers the Sequential layers (layer_base, downsample) and the conv / bn pairs of the residual blocks, also
+    those of pruned networks. OSVOS networks are additionally exported with export_for_inference.
+    """
+    net = deepcopy(net)
+    net.eval()
+    n_folded = _fold_batchnorms(net)
+    log.info('Folded {0} batch normalizations of {1}'.format(n_folded, type(net).__name__))
+
+    if isinstance(net, (OSVOS_RESNET, OSVOS_VGG)):
+        net = export_for_inference(net)
+    for p in net.parameters():
+        p.requires_grad = False
+    return net
+
+
+def _fold_batchnorms(module: nn.Module) -> int:
+    n_folded = 0
+    if isinstance(module, nn.Sequential):
+        children = list(module.children())
+        for index in range(1, len(children)):
+            if isinstance(children[index - 1], nn.Conv2d) and isinstance(children[index], nn.BatchNorm2d):
+                module[index] = _fold_batchnorm(children[index - 1], children[index])
+                n_folded += 1
+
+    # residual blocks: BasicBlock, BasicBlockDummy and Bottleneck
+    for name_conv, name_bn in [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')]:
+        conv, bn = getattr(module, name_conv, None), getattr(module, name_bn, None)
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            setattr(module, name_bn, _fold_batchnorm(conv, bn))
+            n_folded += 1
+
+    for child in module.children():
+        n_folded += _fold_batchnorms(child)
+    return n_folded
+
+
+def _fold_batchnorm(conv: nn.Conv2d, bn: nn.BatchNorm2d) -> nn.Module:
+    """
+    Fold bn into the weights and the bias of conv in place and return the module that replaces bn
+    """
+    if bn.num_features != conv.out_channels:
+        raise Exception('{0} does not match the output channels of {1}'.format(bn, conv))
+    if bn.running_mean is None:
+        raise Exception('{0} has no running statistics to fold'.format(bn))
+
+    scale = bn.running_var.data.add(bn.eps).rsqrt()
+    if bn.affine:
+        scale = scale.mul(bn.weight.data)
+        shift = bn.bias.data
+    else:
+        shift = torch.zeros_like(scale)
+
+    bias = conv.bias.data if conv.bias is not None else torch.zeros_like(scale)
+    conv.weight.data.mul_(scale.view(-1, 1, 1, 1))
+    conv.bias = nn.Parameter(bias.sub(bn.running_mean.data).mul(scale).add(shift))
+    return nn.Identity()
+
+
+def _split_fuse_weights(fuse: nn.Conv2d, n_channels_branches: List[int]) -> List[torch.Tensor]:
+    if fuse.kernel_size != (1, 1):
+        raise Exception('Only a 1x1 fuse layer commutes with the upscaling')
+    if fuse.in_channels != sum(n_channels_branches):
+        raise Exception('The fuse layer does not match the side branches')
+    return list(torch.split(fuse.weight.data, n_channels_branches, dim=1))
+
+
+def _get_bilinear_geometry(layer: nn.ConvTranspose2d, atol: float) -> Tuple[int, int]:
+    """
+    Return kernel size and stride of an upscaling layer after checking that it holds the interp_surgery filter
+    """
+    kernel_size, stride = layer.kernel_size[0], layer.stride[0]
+    if (layer.kernel_size != (kernel_size, kernel_size) or layer.stride != (stride, stride) or layer.bias is not None
+            or layer.groups != 1 or layer.padding != (0, 0) or layer.output_padding != (0, 0)
+            or layer.dilation != (1, 1) or layer.in_channels != layer.out_channels):
+        raise Exception('{0} is not a bilinear upscaling layer'.format(layer))
+
+    filt = torch.from_numpy(upsample_filt(kernel_size)).float()
+    expected = torch.zeros_like(layer.weight.data, device='cpu')
+    for i in range(layer.in_channels):
+        expected[i, i] = filt
+    if not torch.allclose(layer.weight.data.cpu().float(), expected, atol=atol, rtol=0):
+        raise Exception('{0} does not hold the bilinear filter anymore'.format(layer))
+    return kernel_size, stride
+
+
+def _upsample_filt_1d(size: int) -> np.ndarray:
+    """
+    The 1D filter whose outer product with itself is upsample_filt(size)
+    """
+    factor = (size + 1) // 2
+    if size % 2 == 1:
+        center = factor - 1
+    else:
+        center = factor - 0.5
+    return 1 - abs(np.arange(size) - center) / factor
@@ -31,9 +31,11 @@ class OSVOS_RESNET(nn.Module):
 
         self.layer_stages = self._make_layer_stages(block, layers, n_channels_side_inputs)
 
+        # the stages of Bottleneck versions output block.expansion times the channels of their planes
+        n_channels_stage_outputs = [n * block.expansion for n in n_channels_side_inputs]
         (self.side_prep, self.upscale_side_prep, self.score_dsn,
-         self.upscale_score_dsn, self.layer_fuse) = self._make_osvos_layers(channels_side_input=n_channels_side_inputs,
-                                                                            n_channels_output=n_channels_output)
+         self.upscale_score_dsn, self.layer_fuse) = self._make_osvos_layers(
+            channels_side_input=n_channels_stage_outputs, n_channels_output=n_channels_output)
 
         self._initialize_weights()
         if pretrained:
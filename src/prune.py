@@ -3,15 +3,13 @@
 # which itself is adopted from https://github.com/jacobgil/pytorch-pruning
 
 from pathlib import Path
-from typing import Optional, List, Tuple
+from typing import Dict, Optional, List, Tuple
 
-import operator
-import heapq
 import argparse
 
 import numpy as np
 from tensorboardX import SummaryWriter
-from torchvision.models.resnet import BasicBlock
+from torchvision.models.resnet import BasicBlock, Bottleneck
 from tqdm import tqdm
 
 import torch
@@ -21,17 +19,27 @@ from torch import optim
 from torch.autograd import Variable
 
 from networks.osvos_resnet import OSVOS_RESNET, BasicBlockDummy
-from util import io_helper, experiment_helper, gpu_handler
-from layers.osvos_layers import class_balanced_cross_entropy_loss, center_crop
+from networks.osvos_vgg import OSVOS_VGG
+from util import io_helper, experiment_helper, gpu_handler, pruning_cost
+from util.args_helper import parse_resolution
+from util.benchmark_helper import get_device
+from util.dependency_graph import DependencyGraph, prune_groups, select_batchnorm, select_conv
+from layers.osvos_layers import DeepSupervisionLoss, class_balanced_cross_entropy_loss
 from util.logger import get_logger
 
 log = get_logger(__file__)
 
 N_MIN_CHANNELS = 4
+# the resolution of the DAVIS frames, at which the latency of the network is profiled
+LATENCY_RESOLUTION_DEFAULT = (480, 854)
+BACKBONES = ['resnet18', 'resnet34', 'resnet50', 'vgg16']
 
 
-def get_net(seq_name, train_offline: bool) -> nn.Module:
-    net = OSVOS_RESNET(pretrained=True)
+def get_net(seq_name, train_offline: bool, backbone: str = 'resnet18') -> nn.Module:
+    if backbone == 'vgg16':
+        net = OSVOS_VGG(pretrained=1)
+    else:
+        net = OSVOS_RESNET(pretrained=True, version=int(backbone[len('resnet'):]))
     # if train_offline:
     #     path_model = './models/resnet18_11_epoch-239.pth'
     # else:
@@ -43,7 +51,10 @@ def get_net(seq_name, train_offline: bool) -> nn.Module:
     return net
 
 
-def total_num_filters(net: OSVOS_RESNET) -> int:
+def total_num_filters(net: nn.Module) -> int:
+    if isinstance(net, OSVOS_VGG):
+        return sum(m.out_channels for m in net.stages.modules() if isinstance(m, nn.Conv2d))
+
     n_filters = 0
     for m in net.layer_base.modules():
         if isinstance(m, nn.Conv2d) or isinstance(m, nn.ConvTranspose2d):
@@ -53,6 +64,8 @@ def total_num_filters(net: OSVOS_RESNET) -> int:
             if isinstance(b, BasicBlock) or isinstance(b, BasicBlockDummy):
                 n_filters += b.conv1.out_channels
                 n_filters += b.conv2.out_channels
+            elif isinstance(b, Bottleneck):
+                n_filters += b.conv1.out_channels + b.conv2.out_channels + b.conv3.out_channels
     return n_filters
 
 
@@ -67,115 +80,82 @@ def total_num_filters_old(net: nn.Module) -> int:
 
 
 class FilterPruner:
+    """Taylor ranking of the filters of a ResNet18 OSVOS network, numbered as in prune_resnet18_conv_layer.
+
+    forward() runs the network with forward hooks on the ranked convolutions, which register a hook on the gradient
+    of their output. On the backward pass that hook adds the mean of activation * gradient per filter to the ranks
+    and drops the activation, so the ranking works on the real forward of the network.
+    Once profile_costs() has measured the latency a filter of every layer costs, filters are ranked by their
+    importance per millisecond saved instead of their importance alone.
+    """
+
     def __init__(self, net: nn.Module):
         self.net = net
-        self.filter_ranks = {}
-        self.activations = []
-        self.gradients = []
-        self.grad_index = 0
-        self.activation_to_layer = {}
-        self.skip_layer = []
+        self.filter_ranks = {}  # type: Dict[int, torch.Tensor]
+        self.cost_per_filter = None  # type: Optional[Dict[int, float]]
+        self.skip_layer = [index for index, modules in self.get_ranked_modules().items()
+                           if modules[0].out_channels <= N_MIN_CHANNELS]
         self.reset()
 
     def reset(self) -> None:
         self.filter_ranks = {}
 
+    def get_ranked_modules(self) -> Dict[int, List[nn.Module]]:
+        """
+        The convolutions producing the filters of every layer index
+        """
+        convs = [m for m in self.net.layer_base if isinstance(m, nn.Conv2d)]
+        for stage in self.net.layer_stages:
+            for block in stage:
+                convs += [block.conv1, block.conv2]
+        return {index: [conv] for index, conv in enumerate(convs)}
+
+    def get_consumer_modules(self) -> Dict[int, List[nn.Module]]:
+        """
+        The convolutions reading the filters of every layer index, only the second convolution of a block here
+        """
+        convs = self.get_ranked_modules()
+        return {index: convs[index + 1] for index, modules in convs.items()
+                if index + 1 in convs and modules[0] in [b.conv1 for s in self.net.layer_stages for b in s]}
+
+    def profile_costs(self, height: int, width: int) -> Dict[int, float]:
+        """
+        Measure the CPU latency in ms that a filter of every ranked layer costs on a height x width frame
+        """
+        producers = {index: modules for index, modules in self.get_ranked_modules().items()
+                     if index not in self.skip_layer}
+        consumers = {index: modules for index, modules in self.get_consumer_modules().items() if index in producers}
+        self.cost_per_filter = pruning_cost.get_filter_costs(self.net, producers, consumers, height, width)
+        return self.cost_per_filter
+
     def forward(self, x):
-        self.activations = []
-        self.gradients = []
-        self.grad_index = 0
-        self.activation_to_layer = {}
-        activation_index = 0
-        kk = 0
-        self.skip_layer = []
-
-        crop_h, crop_w = int(x.size()[-2]), int(x.size()[-1])
-
-        for l in self.net.layer_base:
-            x = l(x)
-            if isinstance(l, nn.modules.conv.Conv2d):
-                x.register_hook(self.compute_rank)
-                self.activations.append(x)
-                self.activation_to_layer[activation_index] = kk
-                if l.out_channels <= N_MIN_CHANNELS:
-                    self.skip_layer.append(kk)
-                activation_index += 1
-                kk += 1
-        # x = self.net.layer_base(x)
-
-        side = []
-        side_out = []
-        for (layer_stage, layer_side_prep, layer_upscale_side_prep,
-             layer_score_dsn, layer_upscale_score_dsn) in zip(self.net.layer_stages, self.net.side_prep,
-                                                              self.net.upscale_side_prep,
-                                                              self.net.score_dsn, self.net.upscale_score_dsn):
-            # x = layer_stage(x)
-            for kt in range(2):
-                residual = x
-                x = layer_stage[kt].conv1(x)
-                x.register_hook(self.compute_rank)
-                self.activations.append(x)
-                self.activation_to_layer[activation_index] = kk
-                if layer_stage[kt].conv1.out_channels <= N_MIN_CHANNELS:
-                    self.skip_layer.append(kk)
-                activation_index += 1
-                kk += 1
-                x = layer_stage[kt].bn1(x)
-                x = layer_stage[kt].relu(x)
-                x = layer_stage[kt].conv2(x)
-                x.register_hook(self.compute_rank)
-                self.activations.append(x)
-                self.activation_to_layer[activation_index] = kk
-                if layer_stage[kt].conv2.out_channels <= N_MIN_CHANNELS:
-                    self.skip_layer.append(kk)
-                activation_index += 1
-                kk += 1
-                x = layer_stage[kt].bn2(x)
-
-                if layer_stage[kt].downsample is not None:
-                    residual = layer_stage[kt].downsample[0](residual)
-                    # TODO: figure out activation to layer
-                    # x.register_hook(self.compute_rank)
-                    # self.activations.append(x)
-                    # self.activation_to_layer[activation_index] = kk
-                    # activation_index += 1
-                    # kk += 1
-                    residual = layer_stage[kt].downsample[1](residual)
-                x += residual
-                x = layer_stage[kt].relu(x)
-
-            temp_side_prep = layer_side_prep(x)
-
-            temp_upscale = layer_upscale_side_prep(temp_side_prep)
-            temp_cropped = center_crop(temp_upscale, crop_h, crop_w)
-            side.append(temp_cropped)
-
-            temp_score_dsn = layer_score_dsn(temp_side_prep)
-            temp_upscale_ = layer_upscale_score_dsn(temp_score_dsn)
-            temp_cropped_ = center_crop(temp_upscale_, crop_h, crop_w)
-            side_out.append(temp_cropped_)
-
-        out = torch.cat(side[:], dim=1)
-        out = self.net.layer_fuse(out)
-        side_out.append(out)
-        return side_out
-
-    def compute_rank(self, grad):
-        activation_index = len(self.activations) - self.grad_index - 1
-        activation = self.activations[activation_index]
-        values = activation * grad
-        values = values.sum(dim=3).sum(dim=2).sum(dim=0)
-        values = values.data
-
-        # Normalize the rank by the filter dimensions
-        values = values / (activation.shape[0] * activation.shape[2] * activation.shape[3])
-
-        if activation_index not in self.filter_ranks:
-            default_value = torch.FloatTensor(values.shape[0]).zero_()
-            self.filter_ranks[activation_index] = gpu_handler.cast_cuda_if_possible(default_value)
-
-        self.filter_ranks[activation_index] += values
-        self.grad_index += 1
+        handles = [module.register_forward_hook(self._get_hook(index))
+                   for index, modules in self.get_ranked_modules().items() if index not in self.skip_layer
+                   for module in modules]
+        try:
+            return self.net(x)
+        finally:
+            for handle in handles:
+                handle.remove()
+
+    def _get_hook(self, index: int):
+        def hook(module, inputs, output):
+            if not output.requires_grad:
+                return
+            # the gradient hook holds the only extra reference to the activation, until it has been used
+            activations = [output]
+            output.register_hook(lambda grad: self._accumulate_rank(index, activations.pop(), grad))
+        return hook
+
+    def _accumulate_rank(self, index: int, activation: torch.Tensor, grad: torch.Tensor) -> None:
+        with torch.no_grad():
+            values = torch.einsum('nchw,nchw->c', activation, grad)
+            # Normalize the rank by the filter dimensions
+            values /= activation.shape[0] * activation.shape[2] * activation.shape[3]
+            if index not in self.filter_ranks:
+                self.filter_ranks[index] = values
+            else:
+                self.filter_ranks[index] += values
 
     def normalize_ranks_per_layer(self):
         for i in self.filter_ranks:
@@ -187,40 +167,96 @@ class FilterPruner:
                 v = v / divisor
             self.filter_ranks[i] = v.cpu()
 
-    def lowest_ranking_filters(self, n_filters_to_prune_per_iter):
-        data = []
-        for i in sorted(self.filter_ranks.keys()):
-            for j in range(self.filter_ranks[i].size(0)):
-                index_layer = self.activation_to_layer[i]
-                if index_layer in self.skip_layer:
-                    log.info('Skipping layer {0}'.format(str(index_layer)))
-                else:
-                    data.append((index_layer, j, self.filter_ranks[i][j]))
-
-        return heapq.nsmallest(n_filters_to_prune_per_iter, data, operator.itemgetter(2))
-
-    def get_prunning_plan(self, n_filters_to_prune_per_iter):
-        filters_to_prune = self.lowest_ranking_filters(n_filters_to_prune_per_iter)
-
-        # After each of the k filters are prunned,
-        # the filter index of the next filters change since the model is smaller.
-        filters_to_prune_per_layer = {}
-        for (l, f, _) in filters_to_prune:
-            if l not in filters_to_prune_per_layer:
-                filters_to_prune_per_layer[l] = []
-            filters_to_prune_per_layer[l].append(f)
-
-        for l in filters_to_prune_per_layer:
-            filters_to_prune_per_layer[l] = sorted(filters_to_prune_per_layer[l])
-            for i in range(len(filters_to_prune_per_layer[l])):
-                filters_to_prune_per_layer[l][i] = filters_to_prune_per_layer[l][i] - i
-
-        filters_to_prune = []
-        for l in filters_to_prune_per_layer:
-            for i in filters_to_prune_per_layer[l]:
-                filters_to_prune.append((l, i))
-
-        return filters_to_prune
+    def get_rank_table(self) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """The ranks of all filters concatenated in layer order, the layer index of every rank and the
+        position of the first rank of every layer in the concatenation.
+        """
+        layers = sorted(self.filter_ranks.keys())
+        ranks = torch.cat([self.filter_ranks[i].cpu().view(-1) for i in layers])
+        sizes = torch.tensor([self.filter_ranks[i].numel() for i in layers])
+        offsets = torch.cumsum(sizes, dim=0) - sizes
+        layers = torch.tensor(layers)
+        layer_of_rank = torch.repeat_interleave(layers, sizes)
+        return ranks, layer_of_rank, offsets
+
+    def lowest_ranking_filters(self, n_filters_to_prune_per_iter: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Layer and filter indices of the n lowest ranking filters outside of the skipped layers, lowest first
+        """
+        ranks, layer_of_rank, offsets = self.get_rank_table()
+        is_skipped = torch.zeros_like(layer_of_rank, dtype=torch.bool)
+        if len(self.skip_layer) > 0:
+            log.info('Skipping layers {0}'.format(str(sorted(set(self.skip_layer)))))
+            is_skipped = torch.isin(layer_of_rank, torch.tensor(self.skip_layer, dtype=layer_of_rank.dtype))
+        if self.cost_per_filter is not None:
+            costs = torch.tensor([self.cost_per_filter.get(index, 0.0) for index in layer_of_rank.tolist()],
+                                 dtype=ranks.dtype)
+            # filters whose removal saves (almost) nothing are the last to go
+            ranks = ranks / costs.clamp(min=1e-6)
+        ranks = ranks.masked_fill(is_skipped, float('inf'))
+
+        n_filters = min(n_filters_to_prune_per_iter, int((~is_skipped).sum()))
+        _, positions = torch.topk(ranks, n_filters, largest=False, sorted=True)
+        # the layer a position belongs to is the last one starting at or before it
+        index_layers = torch.searchsorted(offsets, positions, right=True) - 1
+        return layer_of_rank[positions], positions - offsets[index_layers]
+
+    def get_prunning_plan(self, n_filters_to_prune_per_iter: int) -> List[Tuple[int, int]]:
+        layers, filters = self.lowest_ranking_filters(n_filters_to_prune_per_iter)
+
+        # the filters of a layer are pruned one after the other in increasing order,
+        # so every filter index shifts down by the number of filters of its layer pruned before it
+        order = torch.argsort(layers * (int(filters.max()) + 1 if len(filters) > 0 else 1) + filters)
+        layers, filters = layers[order], filters[order]
+        n_pruned_before = torch.arange(len(layers)) - torch.searchsorted(layers, layers)
+        filters = filters - n_pruned_before
+
+        return list(zip(layers.tolist(), filters.tolist()))
+
+    def get_keep_masks(self, n_filters_to_prune_per_iter: int) -> Dict[int, torch.Tensor]:
+        """
+        Boolean mask of the filters to keep for every layer that loses filters, for prune_resnet18_filters
+        """
+        layers, filters = self.lowest_ranking_filters(n_filters_to_prune_per_iter)
+        _, layer_of_rank, _ = self.get_rank_table()
+        n_filters_per_layer = torch.bincount(layer_of_rank)
+
+        keep_masks = {}
+        for layer_index in torch.unique(layers).tolist():
+            keep = torch.ones(int(n_filters_per_layer[layer_index]), dtype=torch.bool)
+            keep[filters[layers == layer_index]] = False
+            keep_masks[layer_index] = keep
+        return keep_masks
+
+    def prune(self, keep_masks: Dict[int, torch.Tensor]) -> nn.Module:
+        return prune_resnet18_filters(self.net, keep_masks)
+
+
+class GraphPruner(FilterPruner):
+    """Taylor ranking and pruning of the channel groups of a DependencyGraph, for any backbone.
+
+    A layer index of FilterPruner is the index of a channel group here. The rank of a channel is summed over all
+    convolutions producing it, e.g. over every block of a residual stage.
+    """
+
+    def __init__(self, net: nn.Module, example_input: Optional[torch.Tensor] = None):
+        if example_input is None:
+            example_input = torch.randn(1, 3, 64, 64, device=get_device(net))
+        self.graph = DependencyGraph(net, example_input)
+        super(GraphPruner, self).__init__(net)
+        self.skip_layer = [g.index for g in self.graph.groups
+                           if not g.is_prunable or g.n_channels <= N_MIN_CHANNELS]
+
+    def get_ranked_modules(self) -> Dict[int, List[nn.Module]]:
+        modules = dict(self.net.named_modules())
+        return {g.index: [modules[name] for name in g.producers] for g in self.graph.groups}
+
+    def get_consumer_modules(self) -> Dict[int, List[nn.Module]]:
+        modules = dict(self.net.named_modules())
+        return {g.index: [modules[name] for name in g.consumers] for g in self.graph.groups}
+
+    def prune(self, keep_masks: Dict[int, torch.Tensor]) -> nn.Module:
+        return prune_groups(self.net, self.graph, keep_masks)
 
 
 def train_for_pruning(pruner: FilterPruner, dataloader: data.DataLoader, n_epochs: int, summary_writer: SummaryWriter,
@@ -236,18 +272,12 @@ def train_for_pruning(pruner: FilterPruner, dataloader: data.DataLoader, n_epoch
             inputs, gts = gpu_handler.cast_cuda_if_possible([inputs, gts])
 
             outputs = pruner.forward(inputs)
-            if is_offline:
-                losses = [0] * len(outputs)
-                for i in range(0, len(outputs)):
-                    losses[i] = class_balanced_cross_entropy_loss(outputs[i], gts, size_average=False)
-                loss = sum(losses[:-1]) + losses[-1]  # type: Variable
-            else:
-                loss = class_balanced_cross_entropy_loss(outputs[-1], gts, size_average=False)
+            loss = _get_loss(outputs, gts, is_offline)
 
-            loss_epoch += loss.data[0]
+            loss_epoch += loss.detach()
             loss.backward()
 
-        loss_epoch /= len(dataloader.dataset)
+        loss_epoch = loss_epoch.item() / len(dataloader.dataset)
         summary_writer.add_scalar('train_pruning/loss', loss_epoch, epoch)
 
 
@@ -269,12 +299,12 @@ def calculate_loss(epoch, net, dataloader, optimizer, summary_writer, is_offline
         optimizer.zero_grad()
 
         loss = _get_loss_minibatch(minibatch, net, is_offline)
-        loss_epoch += loss.data[0]
+        loss_epoch += loss.detach()
 
         loss.backward()
         optimizer.step()
 
-    loss_epoch /= len(dataloader.dataset)
+    loss_epoch = loss_epoch.item() / len(dataloader.dataset)
     summary_writer.add_scalar('finetune/loss', loss_epoch, epoch)
 
 
@@ -284,11 +314,12 @@ def _get_loss_minibatch(minibatch, net: nn.Module, is_offline: bool) -> torch.Fl
     inputs, gts = gpu_handler.cast_cuda_if_possible([inputs, gts])
 
     outputs = net.forward(inputs)
+    return _get_loss(outputs, gts, is_offline)
+
+
+def _get_loss(outputs, gts, is_offline: bool) -> torch.FloatTensor:
     if is_offline:
-        losses = [0] * len(outputs)
-        for i in range(0, len(outputs)):
-            losses[i] = class_balanced_cross_entropy_loss(outputs[i], gts, size_average=False)
-        loss = sum(losses[:-1]) + losses[-1]  # type: torch.FloatTensor
+        loss, _ = DeepSupervisionLoss(is_balancing_per_sample=False)(outputs, gts)
     else:
         loss = class_balanced_cross_entropy_loss(outputs[-1], gts, size_average=False)
     return loss
@@ -528,15 +559,79 @@ def prune_batchnorm(batchnorm_old, filter_index, layer_index, net):
     return new_batchnorm
 
 
-# net.layer_base[1]
+def prune_resnet18_filters(net: OSVOS_RESNET, keep_masks: Dict[int, torch.Tensor]) -> OSVOS_RESNET:
+    """Remove the filters of many layers at once, keep_masks maps a layer index (numbered as in
+    prune_resnet18_conv_layer) to a boolean mask of its filters to keep.
+
+    Every affected convolution and batch norm is rebuilt once from the kept rows and columns of its parameters, on
+    their device. Blocks whose residual no longer matches get a new downsample, like in prune_resnet18_conv_layer.
+    """
+    keeps = {}
+    for layer_index, keep in keep_masks.items():
+        keep = torch.as_tensor(keep, dtype=torch.bool)
+        if not keep.any():
+            # like the sequential surgery, which stops at a single filter
+            keep = keep.clone()
+            keep[-1] = True
+        keeps[layer_index] = torch.nonzero(keep).view(-1)
+
+    conv, bn = net.layer_base[0], net.layer_base[1]
+    if 0 in keeps:
+        net.layer_base[0] = select_conv(conv, keep_out=keeps[0])
+        net.layer_base[1] = select_batchnorm(bn, keeps[0])
+
+    layer_index_in = 0
+    for index_stage, stage in enumerate(net.layer_stages):
+        for index_block, block in enumerate(stage):
+            layer_index_inner = 1 + 4 * index_stage + 2 * index_block
+            layer_index_out = layer_index_inner + 1
+            keep_in, keep_inner, keep_out = (keeps.get(layer_index_in), keeps.get(layer_index_inner),
+                                             keeps.get(layer_index_out))
+
+            if keep_in is not None or keep_inner is not None:
+                block.conv1 = select_conv(block.conv1, keep_in=keep_in, keep_out=keep_inner)
+            if keep_inner is not None:
+                block.bn1 = select_batchnorm(block.bn1, keep_inner)
+            if keep_inner is not None or keep_out is not None:
+                block.conv2 = select_conv(block.conv2, keep_in=keep_inner, keep_out=keep_out)
+            if keep_out is not None:
+                block.bn2 = select_batchnorm(block.bn2, keep_out)
+
+            if keep_in is not None or keep_out is not None:
+                if block.downsample is None:
+                    device = block.conv2.weight.device
+                    block.downsample = nn.Sequential(nn.Conv2d(block.conv1.in_channels, block.bn2.num_features,
+                                                               kernel_size=1, stride=1, bias=False),
+                                                     nn.BatchNorm2d(block.bn2.num_features)).to(device)
+                    block.downsample.train(block.training)
+                    init_downsample(block.downsample)
+                else:
+                    block.downsample[0] = select_conv(block.downsample[0], keep_in=keep_in, keep_out=keep_out)
+                    if keep_out is not None:
+                        block.downsample[1] = select_batchnorm(block.downsample[1], keep_out)
+            layer_index_in = layer_index_out
+
+        if layer_index_in in keeps:
+            net.side_prep[index_stage] = select_conv(net.side_prep[index_stage], keep_in=keeps[layer_index_in])
+    return net
+
+
+def get_pruner(net: nn.Module, is_legacy: bool = False) -> FilterPruner:
+    """
+    The legacy pruner only knows the layout of ResNet18, the graph pruner works for every backbone
+    """
+    return FilterPruner(net) if is_legacy else GraphPruner(net)
+
 
-def get_candidates_to_prune(net: nn.Module, n_filters_to_prune: int, dataloader: data.DataLoader,
+def get_candidates_to_prune(pruner: FilterPruner, n_filters_to_prune: int, dataloader: data.DataLoader,
                             n_epochs_select: int, summary_writer: SummaryWriter,
-                            iterations: int, is_offline_mode: bool) -> List[Tuple[int, int]]:
-    pruner = FilterPruner(net)
+                            iterations: int, is_offline_mode: bool,
+                            latency_resolution: Optional[Tuple[int, int]] = None) -> Dict[int, torch.Tensor]:
+    if latency_resolution is not None:
+        pruner.profile_costs(*latency_resolution)
     train_for_pruning(pruner, dataloader, n_epochs_select, summary_writer, iterations, is_offline_mode)
     pruner.normalize_ranks_per_layer()
-    return pruner.get_prunning_plan(n_filters_to_prune)
+    return pruner.get_keep_masks(n_filters_to_prune)
 
 
 class DummyProvider:
@@ -550,14 +645,25 @@ def get_experiment_id(n_epochs_select: int, n_epochs_finetune: int, prune_per_it
 
 
 def main(n_epochs_select: int, n_epochs_finetune: int, prune_per_iter: int, sequence_name: Optional[str] = None,
-         is_offline_mode: bool = False) -> None:
+         is_offline_mode: bool = False, backbone: str = 'resnet18', is_legacy_pruner: bool = False,
+         target_latency_ms: Optional[float] = None,
+         latency_resolution: Tuple[int, int] = LATENCY_RESOLUTION_DEFAULT) -> None:
+    """
+    With a target latency, filters are ranked by importance per millisecond and pruning stops at that latency
+    (measured on the CPU at latency_resolution), at the latest at percentage_prune_max. A step that stops early is
+    saved under the percentage of filters actually pruned.
+    """
+    if is_legacy_pruner and backbone != 'resnet18':
+        raise Exception('The legacy pruner only supports resnet18, not {0}'.format(backbone))
     percentage_prune_max = 90
     percentage_prune_steps = 10
+    is_latency_aware = target_latency_ms is not None
 
     experiment_id = get_experiment_id(n_epochs_select, n_epochs_finetune, prune_per_iter)
     log.info('Experiment ID: %s', experiment_id)
-    path_stem = 'resnet18/11'
-    path_stem += '/' + 'prune'
+    path_stem = backbone + '/11'
+    # the pruners rank and prune differently, so their models and results are kept apart
+    path_stem += '/' + ('prune' if is_legacy_pruner else 'prune_graph')
     path_stem += '/' + experiment_id
     path_stem += '/' + ('offline' if is_offline_mode else 'online')
     log.info('Path stem: %s', str(path_stem))
@@ -568,13 +674,20 @@ def main(n_epochs_select: int, n_epochs_finetune: int, prune_per_iter: int, sequ
     path_tensorboard = Path('tensorboard') / path_stem
     summary_writer = io_helper.get_summary_writer(path_tensorboard)
 
-    net = get_net(sequence_name, is_offline_mode)
+    net = get_net(sequence_name, is_offline_mode, backbone)
     n_filters_start = total_num_filters(net)
     n_filters_to_prune_per_iter = prune_per_iter
     n_iterations = 1 + int(n_filters_start / n_filters_to_prune_per_iter * percentage_prune_steps / 100)
 
     log.info('Filters in model: %d', n_filters_start)
     log.info('Pruning maximal percentage: %d', percentage_prune_max)
+    if is_latency_aware:
+        latency_ms = pruning_cost.measure_network_latency_ms(net, *latency_resolution)
+        log.info('Latency at %dx%d: %.1f ms, target: %.1f ms', latency_resolution[0], latency_resolution[1],
+                 latency_ms, target_latency_ms)
+        if latency_ms <= target_latency_ms:
+            log.info('The network already meets the target latency, nothing to prune')
+            return
     log.info('Output every percentage: %d', percentage_prune_steps)
     log.info('Number of iterations per percentage step: %d', n_iterations)
     log.info('Prune n filters per iteration: %d', n_filters_to_prune_per_iter)
@@ -585,6 +698,8 @@ def main(n_epochs_select: int, n_epochs_finetune: int, prune_per_iter: int, sequ
                                                      seq_name=sequence_name)
 
     fine_tune_calls = 0
+    is_target_reached = False
+    percentage_reached = 0
     for percentage in range(percentage_prune_steps, percentage_prune_max + 1, percentage_prune_steps):
         n_filters = total_num_filters(net)
         log.info('Remaining filters in model: %d', n_filters)
@@ -593,16 +708,11 @@ def main(n_epochs_select: int, n_epochs_finetune: int, prune_per_iter: int, sequ
         log.debug('Plan to prune %d...%s', 0, str(net))
 
         for index_iteration in tqdm(range(n_iterations)):
-            prune_targets = get_candidates_to_prune(net, n_filters_to_prune_per_iter, dataloader_train,
-                                                    n_epochs_select, summary_writer, fine_tune_calls, is_offline_mode)
-
-            # net = net.cpu()
-            layer_index_prev = -1
-            for layer_index, filter_index in prune_targets:
-                if layer_index != layer_index_prev:
-                    log.debug(layer_index_prev, net)
-                    layer_index_prev = layer_index
-                net = prune_resnet18_conv_layer(net, layer_index, filter_index)
+            pruner = get_pruner(net, is_legacy_pruner)
+            keep_masks = get_candidates_to_prune(pruner, n_filters_to_prune_per_iter, dataloader_train,
+                                                 n_epochs_select, summary_writer, fine_tune_calls, is_offline_mode,
+                                                 latency_resolution if is_latency_aware else None)
+            net = pruner.prune(keep_masks)
 
             net = gpu_handler.cast_cuda_if_possible(net)
             log.debug('Plan to prune %d...%s', index_iteration, str(net))
@@ -610,6 +720,19 @@ def main(n_epochs_select: int, n_epochs_finetune: int, prune_per_iter: int, sequ
             fine_tune(net, dataloader_train, args.n_epochs_finetune, summary_writer, fine_tune_calls, is_offline_mode)
             fine_tune_calls += 1
 
+            if is_latency_aware:
+                latency_ms = pruning_cost.measure_network_latency_ms(net, *latency_resolution)
+                log.info('Latency after pruning: %.1f ms, target: %.1f ms', latency_ms, target_latency_ms)
+                if latency_ms <= target_latency_ms:
+                    is_target_reached = True
+                    break
+
+        percentage_reached = int(round(100 * (1 - total_num_filters(net) / n_filters_start)))
+        log.info('Pruned percentage: %d', percentage_reached)
+        if is_target_reached:
+            # the step stopped before reaching its percentage
+            percentage = percentage_reached
+
         if is_offline_mode:
             path_output_model = path_output_model_base / str(percentage) / 'offline'
             path_output_model.mkdir(parents=True, exist_ok=True)
@@ -639,6 +762,14 @@ def main(n_epochs_select: int, n_epochs_finetune: int, prune_per_iter: int, sequ
         experiment_helper.test(net_provider, dataloader_test, path_output_images, is_visualizing_results=False,
                                eval_speeds=False, seq_name=sequence_name)
 
+        if is_target_reached:
+            log.info('Reached the target latency of %.1f ms at %d%%', target_latency_ms, percentage_reached)
+            break
+
+    if is_latency_aware and not is_target_reached:
+        log.warning('Stopped at %d%% without reaching the target latency of %.1f ms, the last latency was %.1f ms',
+                    percentage_reached, target_latency_ms, latency_ms)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(add_help=False)
@@ -651,6 +782,14 @@ if __name__ == '__main__':
     parser.add_argument('--n-epochs-select', default=20, type=int, help='version to try')
     parser.add_argument('--n-epochs-finetune', default=20, type=int, help='version to try')
     parser.add_argument('--prune-per-iter', default=64, type=int, help='filters to prune per iteration')
+    parser.add_argument('--backbone', default='resnet18', choices=BACKBONES)
+    parser.add_argument('--legacy-pruner', action='store_true',
+                        help='use the hand written ResNet18 layout instead of the traced dependency graph, the '
+                             'results go to .../prune instead of .../prune_graph')
+    parser.add_argument('--target-latency-ms', default=None, type=float,
+                        help='rank filters by importance per ms saved and prune until this CPU latency is reached')
+    parser.add_argument('--latency-resolution', default=LATENCY_RESOLUTION_DEFAULT, type=parse_resolution,
+                        help='the frame size HxW the latency is measured at')
 
     args = parser.parse_args()
 
@@ -686,8 +825,10 @@ if __name__ == '__main__':
                          for i, s in enumerate(sequences_val)
                          if i % args.sequence_group_size == args.sequence_group]
 
-        [main(args.n_epochs_select, args.n_epochs_finetune, args.prune_per_iter, s, args.offline)
+        [main(args.n_epochs_select, args.n_epochs_finetune, args.prune_per_iter, s, args.offline, args.backbone,
+              args.legacy_pruner, args.target_latency_ms, args.latency_resolution)
          for s in sequences]
 
     else:
-        main(args.n_epochs_select, args.n_epochs_finetune, args.prune_per_iter, args.sequence_name, args.offline)
+        main(args.n_epochs_select, args.n_epochs_finetune, args.prune_per_iter, args.sequence_name, args.offline,
+             args.backbone, args.legacy_pruner, args.target_latency_ms, args.latency_resolution)
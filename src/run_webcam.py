@@ -1,46 +1,92 @@
 from pathlib import Path
 from typing import Optional
-import time
 
 import click
 import numpy as np
 import cv2
 import torch
 
+from dataloaders.preprocessing import FramePreprocessor
+from networks.inference import INFERENCE_MODES, fuse_for_inference, set_inference_mode
 from networks.osvos_resnet import OSVOS_RESNET
 from networks.osvos_vgg import OSVOS_VGG
 from util.logger import get_logger
+from util.frame_sources import (CaptureSource, FrameSink, FrameSource, SyntheticSource, get_frame_sink,
+                                 get_frame_source)
+from util.overlay_helper import OverlayRenderer
+from util.resolution_helper import AdaptiveResolutionPredictor
+from util.roi_helper import RoiPredictor
+from util.stream_helper import StageTimer, run_pipelined
+from util.temporal_helper import TemporalPredictor
 
 log = get_logger(__file__)
 
-mean_value = np.array((104.00699, 116.66877, 122.67892), dtype=np.float32)
-
 
 @click.command()
 @click.option('--variant', '-var', type=click.Choice(['vgg', 'resnet', 'prune', 'mimic']), default='resnet')
 @click.option('--version', '-ver', type=int)
 @click.option('--webcam', '-wc', type=int, default=0)
+@click.option('--source', '-s', type=str, default=None,
+              help='read the frames from a camera index, a video file, an image directory (e.g. a DAVIS sequence), '
+                   '"stdin:<height>x<width>" for raw BGR frames or "synthetic" instead of the webcam')
+@click.option('--sink', '-out', type=str, default='display',
+              help='"display", "null" (discard), a video file (.avi, .mp4, .mkv) or a directory for PNGs, as '
+                   '"dir:<path>", with a trailing slash or an existing directory')
+@click.option('--pipelined/--serial', '-p/-np', default=None,
+              help='capture, inference and display in parallel, dropping frames the network cannot keep up with; '
+                   'the default for cameras and synthetic frames, recordings are processed serially without dropping '
+                   'frames')
 @click.option('--mirror/--no-mirror', '-m/-nm', default=True)
 @click.option('--use-network/--no-network', '-n/-nn', default=True)
 @click.option('--use-cuda/--no-cuda', '-c/-nc', default=True)
+@click.option('--fuse/--no-fuse', '-f/-nf', default=True, help='fold batch norms and upscaling for inference')
+@click.option('--inference-mode', '-im', type=click.Choice(INFERENCE_MODES), default='fp32')
+@click.option('--temporal-threshold', '-tt', type=float, default=None,
+              help='reuse the last mask while the mean change of the downsampled frame is below this value')
+@click.option('--temporal-max-skip', '-tms', type=int, default=5)
+@click.option('--roi-padding', '-rp', type=float, default=None,
+              help='segment only the padded bounding box of the last mask')
+@click.option('--target-fps', '-fps', type=float, default=None,
+              help='scale the input down until the inference runs at this frame rate')
 @click.option('--overlay/--no-overlay', '-o/-no', default=True)
 @click.option('--boolean-mask/--no-boolean-mask', '-bm/-nbm', default=True)
 @click.option('--overlay-color', '-oc', type=click.Choice(['r', 'g', 'b']), default='r')
 @click.option('--overlay-alpha', '-oa', type=float, default=1.0)
-def main(variant: str, version: int, webcam: int, mirror: bool, use_network: bool, use_cuda: bool,
-         overlay: bool, boolean_mask: bool, overlay_color: str, overlay_alpha: int) -> None:
+def main(variant: str, version: int, webcam: int, source: Optional[str], sink: str, pipelined: Optional[bool],
+         mirror: bool, use_network: bool, use_cuda: bool, fuse: bool, inference_mode: str,
+         temporal_threshold: Optional[float], temporal_max_skip: int, roi_padding: Optional[float],
+         target_fps: Optional[float], overlay: bool, boolean_mask: bool, overlay_color: str,
+         overlay_alpha: int) -> None:
     if use_network:
-        net = get_network(variant, version)
+        net = get_network(variant, version, is_fusing=fuse)
         if use_cuda:
             net = net.cuda()
+        net = set_inference_mode(net, inference_mode)
+        if target_fps is not None:
+            net = AdaptiveResolutionPredictor(net, target_latency_ms=1000 / target_fps)
+        if roi_padding is not None:
+            net = RoiPredictor(net, padding=roi_padding)
+        if temporal_threshold is not None:
+            net = TemporalPredictor(net, threshold=temporal_threshold, max_skip=temporal_max_skip)
     else:
         net = None
-    cam = cv2.VideoCapture(webcam)
-    loop_video(variant, net, cam, mirror, use_cuda, overlay, boolean_mask, overlay_color, overlay_alpha)
-    cv2.destroyAllWindows()
-
-
-def get_network(variant: str, version: int, path_models: str = 'models') -> torch.nn.Module:
+    if source is None:
+        source = str(webcam)
+    frame_source = get_frame_source(source)
+    frame_sink = get_frame_sink(sink, window_name=variant)
+    if pipelined is None:
+        is_live = isinstance(frame_source, CaptureSource) and source.isdigit()
+        pipelined = is_live or isinstance(frame_source, SyntheticSource)
+    loop_video(net, frame_source, frame_sink, mirror, use_cuda, overlay, boolean_mask, overlay_color, overlay_alpha,
+               is_pipelined=pipelined)
+    frame_source.release()
+    frame_sink.release()
+    while isinstance(net, (TemporalPredictor, RoiPredictor, AdaptiveResolutionPredictor)):
+        net.log_stats()
+        net = net.net
+
+
+def get_network(variant: str, version: int, path_models: str = 'models', is_fusing: bool = False) -> torch.nn.Module:
     path_models = Path(path_models)
     if variant == 'vgg':
         net = OSVOS_VGG(pretrained=False)
@@ -59,78 +105,53 @@ def get_network(variant: str, version: int, path_models: str = 'models') -> torc
         raise Exception('Not yet implemented')
     else:
         raise Exception('Click should have prevented this')
+    if is_fusing:
+        net = fuse_for_inference(net)
     return net
 
 
-def loop_video(variant: str, net: Optional[torch.nn.Module], cam: cv2.VideoCapture, mirror: bool, use_cuda: bool,
-               overlay: bool, boolean_mask: bool, overlay_color: str, overlay_alpha: int) -> None:
+def loop_video(net: Optional[torch.nn.Module], source: FrameSource, sink: FrameSink, mirror: bool, use_cuda: bool,
+               overlay: bool, boolean_mask: bool, overlay_color: str, overlay_alpha: int,
+               is_pipelined: bool = False) -> None:
     use_network = net is not None
-    while True:
-        start_time = time.time()
-        ret_val, img = cam.read()
+    timer = StageTimer()
+    # without a network nothing is moved to the device, which also works on machines without cuda
+    preprocessor = FramePreprocessor(device=torch.device('cuda' if use_cuda else 'cpu')) if use_network else None
+    renderer = OverlayRenderer(overlay, boolean_mask, overlay_color, overlay_alpha)
+
+    def process(img: np.ndarray) -> np.ndarray:
         if mirror:
             img = cv2.flip(img, 1)
         if use_network:
-            img = apply_network(net, img, use_cuda, overlay, boolean_mask, overlay_color, overlay_alpha)
-        cv2.imshow(variant, img)
-        log.info('FPS: {0:0.1f}'.format(1.0 / (time.time() - start_time)))
-        if cv2.waitKey(1) == 27:
-            break  # esc to quit
-
-
-def apply_network(net: torch.nn.Module, img: np.ndarray, use_cuda: bool, overlay: bool,
-                  boolean_mask: bool, overlay_color: str, overlay_alpha: int) -> np.ndarray:
-    input_img = img
-    img = img - mean_value
-    img = to_tensor(img)
-    if use_cuda:
-        img = img.cuda()
-    network_output = net.forward(img)
-    prediction = network_output[-1]
-    prediction = to_numpy(prediction)
-    if boolean_mask:
-        prediction[prediction >= 0.5] = 1
-        prediction[prediction < 0.5] = 0
-    if overlay:
-        output = perform_overlay(input_img, prediction, overlay_alpha, overlay_color)
-    else:
-        output = prediction
-    return output
-
-
-def to_tensor(img: np.ndarray) -> torch.autograd.Variable:
-    img = img[np.newaxis, ...]
-    img = torch.from_numpy(img.transpose((0, 3, 1, 2)))
-    if isinstance(img, torch.ByteTensor):
-        img = img.float().div(255)
-    img = torch.autograd.Variable(img, volatile=True)
-    return img
-
-
-def to_numpy(output: torch.nn.Module) -> np.ndarray:
-    output = output.cpu().data.numpy()[0, :, :, :]
-    output = np.transpose(output, (1, 2, 0))
-    output = 1 / (1 + np.exp(-output))
-    output = np.squeeze(output)
-    return output
-
-
-def perform_overlay(input_img: np.ndarray, prediction: np.ndarray, overlay_alpha: float,
-                    overlay_color: str) -> np.ndarray:
-    if overlay_color == 'r':
-        color_index = 2
-    elif overlay_color == 'g':
-        color_index = 1
-    elif overlay_color == 'b':
-        color_index = 0
-    else:
-        raise Exception('Click should have prevented this')
-    mask = np.zeros(input_img.shape, dtype=float)
-    mask[..., color_index] = 255
-    output = input_img + overlay_alpha * mask * prediction[..., np.newaxis]
-    output[output > 255] = 255
-    output = output.astype('uint8')
-    return output
+            img = apply_network(net, img, preprocessor, renderer, timer)
+        return img
+
+    if is_pipelined:
+        run_pipelined(source.read, process, sink.write, timer)
+        return
+
+    while True:
+        with timer.measure('capture'):
+            ret_val, img = source.read()
+        if not ret_val:
+            break
+        with timer.measure('inference'):
+            img = process(img)
+        with timer.measure('render'):
+            is_continuing = sink.write(img)
+        timer.tick()
+        if not is_continuing:
+            break
+
+
+def apply_network(net: torch.nn.Module, img: np.ndarray, preprocessor: FramePreprocessor, renderer: OverlayRenderer,
+                  timer: Optional[StageTimer] = None) -> np.ndarray:
+    with torch.no_grad():
+        network_output = net.forward(preprocessor(img))
+    if timer is None:
+        return renderer.render(img, network_output[-1])
+    with timer.measure('postprocess'):
+        return renderer.render(img, network_output[-1])
 
 
 if __name__ == '__main__':
@@ -1,14 +1,17 @@
 import sys
 import timeit
 from pathlib import Path
+from typing import Optional
 
+import torch
 from tensorboardX import SummaryWriter
 from torch import optim
 from torch.autograd import Variable
 from torch.utils.data import DataLoader
 
 from config.mypath import Path as P
-from layers.osvos_layers import class_balanced_cross_entropy_loss
+from dataloaders.batch_transforms import BatchScaleNRotate
+from layers.osvos_layers import DeepSupervisionLoss
 from util import gpu_handler, io_helper, experiment_helper, args_helper
 from util.logger import get_logger
 from util.network_provider import NetworkProvider, provider_mapping
@@ -26,18 +29,24 @@ def train_and_test(net_provider: NetworkProvider, settings: OfflineSettings) ->
     io_helper.write_settings(save_dir_models, net_provider.name, settings, variant_offline=settings.variant_offline)
     if settings.is_training:
         net_provider.load_network_train()
-        data_loader_train = io_helper.get_data_loader_train(db_root_dir, settings.batch_size_train)
-        data_loader_test = io_helper.get_data_loader_test(db_root_dir, settings.batch_size_test)
+        # BatchScaleNRotate flips on the device
+        data_loader_train = io_helper.get_data_loader_train(db_root_dir, settings.batch_size_train,
+                                                            cache_dir=settings.frame_cache_dir,
+                                                            is_flipping=not settings.is_augmenting_on_device)
+        data_loader_test = io_helper.get_data_loader_test(db_root_dir, settings.batch_size_test,
+                                                          cache_dir=settings.frame_cache_dir)
         optimizer = net_provider.get_optimizer()
         summary_writer = _get_summary_writer()
+        augmentation = BatchScaleNRotate() if settings.is_augmenting_on_device else None
 
         _train(net_provider, data_loader_train, data_loader_test, optimizer, summary_writer, settings.start_epoch,
-               settings.n_epochs, settings.avg_grad_every_n, settings.snapshot_every_n,
-               settings.is_testing_while_training, settings.test_every_n)
+               settings.n_epochs, settings.snapshot_every_n, settings.is_testing_while_training, settings.test_every_n,
+               augmentation)
 
     if settings.is_testing:
         net_provider.load_network_test()
-        data_loader = io_helper.get_data_loader_test(db_root_dir, settings.batch_size_test)
+        data_loader = io_helper.get_data_loader_test(db_root_dir, settings.batch_size_test,
+                                                     cache_dir=settings.frame_cache_dir)
 
         if settings.variant_offline is None:
             save_dir = save_dir_results / net_provider.name / 'offline'
@@ -45,7 +54,12 @@ def train_and_test(net_provider: NetworkProvider, settings: OfflineSettings) ->
             save_dir = save_dir_results / net_provider.name / str(settings.variant_offline) / 'offline'
 
         experiment_helper.test(net_provider, data_loader, save_dir, settings.is_visualizing_results,
-                               settings.eval_speeds)
+                               settings.eval_speeds, is_fusing_for_inference=settings.is_fusing_for_inference,
+                               inference_mode=settings.inference_mode,
+                               temporal_threshold=settings.temporal_threshold,
+                               temporal_max_skip=settings.temporal_max_skip,
+                               roi_padding=settings.roi_padding,
+                               target_fps=settings.target_fps)
 
     if settings.is_visualizing_network:
         io_helper.visualize_network(net_provider.network)
@@ -56,19 +70,23 @@ def _get_summary_writer() -> SummaryWriter:
 
 
 def _train(net_provider: NetworkProvider, data_loader_train: DataLoader, data_loader_test: DataLoader,
-           optimizer: optim.SGD, summary_writer: SummaryWriter, start_epoch: int, n_epochs: int, avg_grad_every_n: int,
-           snapshot_every_n: int, is_testing_while_training: bool, test_every_n: int) -> None:
+           optimizer: optim.SGD, summary_writer: SummaryWriter, start_epoch: int, n_epochs: int,
+           snapshot_every_n: int, is_testing_while_training: bool, test_every_n: int,
+           augmentation: Optional[BatchScaleNRotate] = None) -> None:
     log.info('Start of offline training')
 
     net = net_provider.network
 
     n_samples_train = len(data_loader_train)
     n_samples_test = len(data_loader_test)
-    running_loss_train = [0] * 5
-    running_loss_test = [0] * 5
+    criterion = DeepSupervisionLoss()
+    criterion_test = DeepSupervisionLoss(is_balancing_per_sample=False)
+    # the losses are summed up on the device and only copied to the host once per epoch
+    running_loss_train = 0
+    running_loss_test = 0
+    loss_iter = []
     loss_train = []
     loss_test = []
-    counter_gradient = 0
 
     log.info('Training Network')
     for epoch in range(start_epoch, n_epochs):
@@ -78,62 +96,60 @@ def _train(net_provider: NetworkProvider, data_loader_train: DataLoader, data_lo
             inputs, gts = minibatch['image'], minibatch['gt']
             inputs, gts = Variable(inputs), Variable(gts)
             inputs, gts = gpu_handler.cast_cuda_if_possible([inputs, gts])
+            if augmentation is not None:
+                inputs, gts = augmentation(inputs, gts)
+            batch_size = inputs.size()[0]
 
             outputs = net.forward(inputs)
 
-            losses = [0] * len(outputs)
-            for i in range(0, len(outputs)):
-                losses[i] = class_balanced_cross_entropy_loss(outputs[i], gts, size_average=False)
-                running_loss_train[i] += losses[i].data[0]
-            loss = (1 - epoch / n_epochs) * sum(losses[:-1]) + losses[-1]  # type: Variable
+            # the classes are balanced per sample, like the gradient averaging over single samples did before
+            loss, losses = criterion(outputs, gts, side_weight=1 - epoch / n_epochs)
+            loss = loss / batch_size
+            running_loss_train = running_loss_train + losses / batch_size
+            loss_iter.append(loss.detach())
 
             if index % n_samples_train == n_samples_train - 1:
-                running_loss_train = [x / n_samples_train for x in running_loss_train]
+                running_loss_train = (running_loss_train / n_samples_train).tolist()
                 loss_train.append(running_loss_train[-1])
                 summary_writer.add_scalar('data/total_loss_epoch', running_loss_train[-1], epoch)
+                for i, loss_i in enumerate(torch.stack(loss_iter).tolist()):
+                    summary_writer.add_scalar('data/total_loss_iter', loss_i, i + n_samples_train * epoch)
                 log.info('[Epoch: %d, numImages: %5d]' % (epoch, index + 1))
                 for l in range(0, len(running_loss_train)):
                     log.info('Loss %d: %f' % (l, running_loss_train[l]))
-                    running_loss_train[l] = 0
+                running_loss_train = 0
+                loss_iter = []
 
                 stop_time = timeit.default_timer()
                 log.info('Execution time: ' + str(stop_time - start_time))
 
-            loss /= avg_grad_every_n
             loss.backward()
-            counter_gradient += 1
-
-            if counter_gradient % avg_grad_every_n == 0:
-                summary_writer.add_scalar('data/total_loss_iter', loss.data[0], index + n_samples_train * epoch)
-                optimizer.step()
-                optimizer.zero_grad()
-                counter_gradient = 0
+            optimizer.step()
+            optimizer.zero_grad()
 
         if (epoch % snapshot_every_n) == snapshot_every_n - 1 and epoch != 0:
             net_provider.save_model(epoch)
 
         if is_testing_while_training and epoch % test_every_n == (test_every_n - 1):
-            for index, minibatch in enumerate(data_loader_test):
-                inputs, gts = minibatch['image'], minibatch['gt']
-                inputs, gts = Variable(inputs, volatile=True), Variable(gts, volatile=True)
-                inputs, gts = gpu_handler.cast_cuda_if_possible([inputs, gts])
+            with torch.no_grad():
+                for index, minibatch in enumerate(data_loader_test):
+                    inputs, gts = minibatch['image'], minibatch['gt']
+                    inputs, gts = gpu_handler.cast_cuda_if_possible([inputs, gts])
 
-                outputs = net.forward(inputs)
+                    outputs = net.forward(inputs)
 
-                losses = [0] * len(outputs)
-                for i in range(0, len(outputs)):
-                    losses[i] = class_balanced_cross_entropy_loss(outputs[i], gts, size_average=False)
-                    running_loss_test[i] += losses[i].data[0]
+                    _, losses = criterion_test(outputs, gts)
+                    running_loss_test = running_loss_test + losses
 
-                if index % n_samples_test == n_samples_test - 1:
-                    running_loss_test = [x / n_samples_test for x in running_loss_test]
-                    loss_test.append(running_loss_test[-1])
+                    if index % n_samples_test == n_samples_test - 1:
+                        running_loss_test = (running_loss_test / n_samples_test).tolist()
+                        loss_test.append(running_loss_test[-1])
 
-                    log.info('[Epoch: %d, numImages: %5d]' % (epoch, index + 1))
-                    summary_writer.add_scalar('data/test_loss_epoch', running_loss_test[-1], epoch)
-                    for l in range(0, len(running_loss_test)):
-                        log.info('***Testing *** Loss %d: %f' % (l, running_loss_test[l]))
-                        running_loss_test[l] = 0
+                        log.info('[Epoch: %d, numImages: %5d]' % (epoch, index + 1))
+                        summary_writer.add_scalar('data/test_loss_epoch', running_loss_test[-1], epoch)
+                        for l in range(0, len(running_loss_test)):
+                            log.info('***Testing *** Loss %d: %f' % (l, running_loss_test[l]))
+                        running_loss_test = 0
 
     summary_writer.close()
 
@@ -151,10 +167,14 @@ if __name__ == '__main__':
     save_dir_results.mkdir(parents=True, exist_ok=True)
 
     settings = OfflineSettings(is_training=args.is_training, is_testing=args.is_testing, start_epoch=0, n_epochs=240,
-                               avg_grad_every_n=10, snapshot_every_n=40, is_testing_while_training=False,
-                               test_every_n=5, batch_size_train=1, batch_size_test=1, is_visualizing_network=False,
+                               snapshot_every_n=40, is_testing_while_training=False,
+                               test_every_n=5, batch_size_train=10, batch_size_test=1, is_visualizing_network=False,
                                is_visualizing_results=False, is_loading_vgg_caffe=False,
-                               variant_offline=args.variant_offline, eval_speeds=args.eval_speeds)
+                               variant_offline=args.variant_offline, eval_speeds=args.eval_speeds,
+                               frame_cache_dir=args.frame_cache_dir, is_augmenting_on_device=args.scale_n_rotate,
+                               is_fusing_for_inference=args.fuse_for_inference, inference_mode=args.inference_mode,
+                               temporal_threshold=args.temporal_threshold, temporal_max_skip=args.temporal_max_skip,
+                               roi_padding=args.roi_padding, target_fps=args.target_fps)
 
     provider_class = provider_mapping[('offline', args.network)]
     if args.network == 'resnet34':
@@ -1,6 +1,7 @@
 import sys
 import timeit
 from pathlib import Path
+from typing import Optional
 
 from tensorboardX import SummaryWriter
 from torch import optim, nn
@@ -8,6 +9,7 @@ from torch.autograd import Variable
 from torch.utils.data import DataLoader
 
 from config.mypath import Path as P
+from dataloaders.batch_transforms import BatchScaleNRotate
 from layers.osvos_layers import class_balanced_cross_entropy_loss
 from util import gpu_handler, io_helper, experiment_helper, args_helper
 from util.logger import get_logger
@@ -27,15 +29,19 @@ def train_and_test(net_provider: NetworkProvider, seq_name: str, settings: Onlin
 
     if settings.is_training:
         net_provider.load_network_train()
-        data_loader = io_helper.get_data_loader_train(db_root_dir, settings.batch_size_train, seq_name)
+        data_loader = io_helper.get_data_loader_train(db_root_dir, settings.batch_size_train, seq_name,
+                                                      cache_dir=settings.frame_cache_dir,
+                                                      is_flipping=not settings.is_augmenting_on_device)
         optimizer = net_provider.get_optimizer()
+        augmentation = BatchScaleNRotate() if settings.is_augmenting_on_device else None
 
         _train(net_provider, data_loader, optimizer, summary_writer, seq_name, settings.start_epoch, settings.n_epochs,
-               settings.avg_grad_every_n, settings.snapshot_every_n)
+               settings.snapshot_every_n, augmentation)
 
     if settings.is_testing:
         net_provider.load_network_test(sequence=seq_name)
-        data_loader = io_helper.get_data_loader_test(db_root_dir, settings.batch_size_test, seq_name)
+        data_loader = io_helper.get_data_loader_test(db_root_dir, settings.batch_size_test, seq_name,
+                                                     cache_dir=settings.frame_cache_dir)
 
         if settings.variant_offline is None:
             save_dir = save_dir_results / net_provider.name / 'online'
@@ -44,7 +50,13 @@ def train_and_test(net_provider: NetworkProvider, seq_name: str, settings: Onlin
                         str(settings.variant_online))
 
         experiment_helper.test(net_provider, data_loader, save_dir, settings.is_visualizing_results,
-                               settings.eval_speeds, seq_name=seq_name)
+                               settings.eval_speeds, seq_name=seq_name,
+                               is_fusing_for_inference=settings.is_fusing_for_inference,
+                               inference_mode=settings.inference_mode,
+                               temporal_threshold=settings.temporal_threshold,
+                               temporal_max_skip=settings.temporal_max_skip,
+                               roi_padding=settings.roi_padding,
+                               target_fps=settings.target_fps)
 
     if settings.is_visualizing_network:
         io_helper.visualize_network(net_provider.network)
@@ -56,7 +68,8 @@ def _get_summary_writer(seq_name: str) -> SummaryWriter:
 
 
 def _train(net_provider: NetworkProvider, dataloader: DataLoader, optimizer: optim.SGD, summary_writer: SummaryWriter,
-           seq_name: str, start_epoch: int, n_epochs: int, avg_grad_every_n: int, snapshot_every_n: int) -> None:
+           seq_name: str, start_epoch: int, n_epochs: int, snapshot_every_n: int,
+           augmentation: Optional[BatchScaleNRotate] = None) -> None:
     log.info('Start of Online Training, sequence: ' + seq_name)
 
     net = net_provider.network
@@ -64,7 +77,6 @@ def _train(net_provider: NetworkProvider, dataloader: DataLoader, optimizer: opt
     speeds_training = []
     n_samples = len(dataloader)
     loss_tr = []
-    counter_gradient = 0
 
     time_all_start = timeit.default_timer()
     for epoch in range(start_epoch, n_epochs):
@@ -75,11 +87,15 @@ def _train(net_provider: NetworkProvider, dataloader: DataLoader, optimizer: opt
         for minibatch_index, minibatch in enumerate(dataloader):
             inputs, gts = minibatch['image'], minibatch['gt']
             inputs, gts = gpu_handler.cast_cuda_if_possible([inputs, gts])
+            if augmentation is not None:
+                inputs, gts = augmentation(inputs, gts)
 
             outputs = net.forward(inputs)
 
-            loss = class_balanced_cross_entropy_loss(outputs[-1], gts, size_average=False)
-            running_loss_tr += loss.data[0]
+            # the classes are balanced per sample, like the gradient averaging over single samples did before
+            loss = class_balanced_cross_entropy_loss(outputs[-1], gts, size_average=False,
+                                                     is_balancing_per_sample=True) / inputs.size()[0]
+            running_loss_tr += loss.item()
 
             if epoch % (n_epochs // 20) == (n_epochs // 20 - 1):
                 running_loss_tr /= n_samples
@@ -89,18 +105,14 @@ def _train(net_provider: NetworkProvider, dataloader: DataLoader, optimizer: opt
                 log.info('Loss {0}: {1}'.format(seq_name, running_loss_tr))
                 summary_writer.add_scalar('data/total_loss_epoch', running_loss_tr, epoch)
 
-            loss /= avg_grad_every_n
             loss.backward()
             loss_epoch += loss.item()
-            counter_gradient += 1
 
-            if counter_gradient % avg_grad_every_n == 0:
-                summary_writer.add_scalar('data/total_loss_iter', loss.data[0], minibatch_index + n_samples * epoch)
-                optimizer.step()
-                optimizer.zero_grad()
-                counter_gradient = 0
+            summary_writer.add_scalar('data/total_loss_iter', loss.item(), minibatch_index + n_samples * epoch)
+            optimizer.step()
+            optimizer.zero_grad()
 
-        loss_epoch /= len(dataloader.dataset)
+        loss_epoch /= n_samples
         summary_writer.add_scalar('data/{mode}/loss'.format(mode='train'), loss_epoch, epoch)
 
         if (epoch % snapshot_every_n) == snapshot_every_n - 1:  # and epoch != 0:
@@ -144,12 +156,18 @@ if __name__ == '__main__':
     path_output_model_base = Path('models') / path_stem
     path_output_model_base.mkdir(parents=True, exist_ok=True)
 
-    settings = OnlineSettings(is_training=args.is_training, is_testing=args.is_testing, start_epoch=0, n_epochs=10000,
-                              avg_grad_every_n=5, snapshot_every_n=10000, is_testing_while_training=False,
-                              test_every_n=5, batch_size_train=1, batch_size_test=1, is_visualizing_network=False,
+    # one epoch is a single step with a batch of variants of the first frame, so 2000 epochs see as many samples
+    # as 10000 epochs with gradients averaged over 5 single samples did
+    settings = OnlineSettings(is_training=args.is_training, is_testing=args.is_testing, start_epoch=0, n_epochs=2000,
+                              snapshot_every_n=2000, is_testing_while_training=False,
+                              test_every_n=5, batch_size_train=5, batch_size_test=1, is_visualizing_network=False,
                               is_visualizing_results=False, offline_epoch=240,
                               variant_offline=args.variant_offline, variant_online=args.variant_online,
-                              eval_speeds=args.eval_speeds)
+                              eval_speeds=args.eval_speeds, frame_cache_dir=args.frame_cache_dir,
+                              is_augmenting_on_device=args.scale_n_rotate,
+                              is_fusing_for_inference=args.fuse_for_inference, inference_mode=args.inference_mode,
+                              temporal_threshold=args.temporal_threshold, temporal_max_skip=args.temporal_max_skip,
+                              roi_padding=args.roi_padding, target_fps=args.target_fps)
 
     provider_class = provider_mapping[('online', args.network)]
     if args.network == 'resnet34':
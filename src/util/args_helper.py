@@ -1,5 +1,7 @@
 import argparse
-from typing import Optional
+from typing import Optional, Tuple
+
+from networks.inference import INFERENCE_MODES
 
 
 def _get_base_parser():
@@ -20,6 +22,32 @@ def _get_base_parser():
 
     parser.add_argument('--eval-speeds', action='store_true', help='evaluates the network speeds')
 
+    parser.add_argument('--frame-cache-dir', default=None, type=str,
+                        help='directory to cache the decoded frames in, disabled if not set')
+
+    parser.add_argument('--scale-n-rotate', action='store_true',
+                        help='randomly scale, rotate and flip the training batches on the device')
+
+    parser.add_argument('--fuse-for-inference', action='store_true',
+                        help='test with the batch norms and the upscaling folded into the convolutions')
+
+    parser.add_argument('--inference-mode', default='fp32', type=str, choices=INFERENCE_MODES,
+                        help='memory format and precision to test with')
+
+    parser.add_argument('--temporal-threshold', default=None, type=float,
+                        help='reuse the prediction of the last frame if the mean change of the downsampled input is '
+                             'below this value, disabled if not set')
+
+    parser.add_argument('--temporal-max-skip', default=5, type=int,
+                        help='maximum number of frames in a row that reuse a prediction')
+
+    parser.add_argument('--roi-padding', default=None, type=float,
+                        help='segment only the bounding box of the last mask, padded by this fraction of its size, '
+                             'disabled if not set')
+
+    parser.add_argument('--target-fps', default=None, type=float,
+                        help='scale the input down until the inference runs at this frame rate, disabled if not set')
+
     return parser
 
 
@@ -37,3 +65,11 @@ def parse_args(is_online: bool) -> argparse.Namespace:
     args.is_testing = not args.no_testing
 
     return args
+
+
+def parse_resolution(resolution: str) -> Tuple[int, int]:
+    """
+    'HxW' to (height, width), e.g. 480x854
+    """
+    height, width = resolution.lower().split('x')
+    return int(height), int(width)
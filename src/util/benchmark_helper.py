@@ -0,0 +1,199 @@
+import csv
+import datetime
+import json
+import resource
+import sys
+import timeit
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple, Union
+
+import attr
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
+
+from util.logger import get_logger
+
+log = get_logger(__file__)
+
+
+@attr.s
+class BenchmarkResult:
+    name = attr.ib()
+    device = attr.ib()
+    height = attr.ib()
+    width = attr.ib()
+    batch_size = attr.ib()
+    n_warmup = attr.ib()
+    n_runs = attr.ib()
+    latency_mean_ms = attr.ib()
+    latency_p50_ms = attr.ib()
+    latency_p90_ms = attr.ib()
+    latency_p99_ms = attr.ib()
+    throughput_fps = attr.ib()
+    peak_rss_mb = attr.ib()
+    peak_cuda_mb = attr.ib(default=None)
+    timestamp = attr.ib(default=attr.Factory(lambda: datetime.datetime.now().isoformat(timespec='seconds')))
+
+
+def get_network(net: Union[nn.Module, object]) -> nn.Module:
+    """
+    Accept a NetworkProvider (or anything with a network attribute) as well as a plain module
+    """
+    return net if isinstance(net, nn.Module) else net.network
+
+
+def get_device(net: nn.Module) -> torch.device:
+    for tensor in list(net.parameters()) + list(net.buffers()):
+        return tensor.device
+    return torch.device('cpu')
+
+
+def synchronize(device: torch.device) -> None:
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def get_peak_rss_mb() -> float:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak_rss / 2 ** 20 if sys.platform == 'darwin' else peak_rss / 2 ** 10
+
+
+def benchmark(net: Union[nn.Module, object], inputs: Sequence[torch.Tensor], name: str, n_warmup: int = 5,
+              n_runs: int = 50, is_logging: bool = True) -> BenchmarkResult:
+    """Time the forward pass of net on the given inputs, which are cycled through.
+    The first n_warmup forwards are not timed, they include the allocations and the algorithm selection of cudnn.
+    """
+    net = get_network(net)
+    device = get_device(net)
+    inputs = [x.to(device) for x in inputs]
+    index_input = [0]
+
+    def forward():
+        net(inputs[index_input[0] % len(inputs)])
+        index_input[0] += 1
+
+    batch_size, _, height, width = inputs[0].size()
+    with torch.no_grad():
+        return benchmark_callable(forward, name, device, height, width, batch_size, n_warmup=n_warmup,
+                                  n_runs=n_runs, is_logging=is_logging)
+
+
+def benchmark_callable(function: Callable[[], object], name: str, device: torch.device, height: int, width: int,
+                       batch_size: int = 1, n_warmup: int = 5, n_runs: int = 50,
+                       is_logging: bool = True) -> BenchmarkResult:
+    """
+    Time any function working on inputs of the given size, e.g. a training step or a single layer
+    """
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+    times = []
+    for index in range(n_warmup + n_runs):
+        synchronize(device)
+        time_start = timeit.default_timer()
+        function()
+        synchronize(device)
+        if index >= n_warmup:
+            times.append(timeit.default_timer() - time_start)
+
+    times_ms = np.array(times) * 1000
+    peak_cuda_mb = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else None
+    result = BenchmarkResult(name=name, device=str(device), height=int(height), width=int(width),
+                             batch_size=int(batch_size), n_warmup=n_warmup, n_runs=n_runs,
+                             latency_mean_ms=float(times_ms.mean()),
+                             latency_p50_ms=float(np.percentile(times_ms, 50)),
+                             latency_p90_ms=float(np.percentile(times_ms, 90)),
+                             latency_p99_ms=float(np.percentile(times_ms, 99)),
+                             throughput_fps=float(batch_size * 1000 / times_ms.mean()),
+                             peak_rss_mb=get_peak_rss_mb(), peak_cuda_mb=peak_cuda_mb)
+    if is_logging:
+        log_result(result)
+    return result
+
+
+def benchmark_resolutions(net: Union[nn.Module, object], resolutions: Iterable[Tuple[int, int]], name: str,
+                          batch_size: int = 1, n_warmup: int = 5, n_runs: int = 50,
+                          seed: int = 0) -> List[BenchmarkResult]:
+    """
+    Benchmark with fixed synthetic inputs, one result per (height, width)
+    """
+    generator = torch.Generator().manual_seed(seed)
+    results = []
+    for height, width in resolutions:
+        inputs = [torch.randn(batch_size, 3, height, width, generator=generator)]
+        results.append(benchmark(net, inputs, name, n_warmup=n_warmup, n_runs=n_runs))
+    return results
+
+
+def benchmark_data_loader(net: Union[nn.Module, object], data_loader: DataLoader, name: str, n_warmup: int = 5,
+                          n_runs: int = 50, n_inputs: int = 10) -> BenchmarkResult:
+    """
+    Benchmark with the images of the first n_inputs minibatches, which are loaded before timing
+    """
+    inputs = []
+    for minibatch in data_loader:
+        inputs.append(minibatch['image'].float())
+        if len(inputs) == n_inputs:
+            break
+    return benchmark(net, inputs, name, n_warmup=n_warmup, n_runs=n_runs)
+
+
+def log_result(result: BenchmarkResult) -> None:
+    log.info('{0} [{1}, {2}x{3}x{4}]: p50 {5:.2f} ms, p90 {6:.2f} ms, p99 {7:.2f} ms, {8:.1f} fps, '
+             'peak RSS {9:.0f} MB'.format(result.name, result.device, result.batch_size, result.height, result.width,
+                                         result.latency_p50_ms, result.latency_p90_ms, result.latency_p99_ms,
+                                         result.throughput_fps, result.peak_rss_mb))
+
+
+def save_results(results: List[BenchmarkResult], path: Path, is_appending: bool = True) -> None:
+    """
+    Append the results to a .json (list of results) or .csv file, so that runs can be compared over time
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if not is_appending and path.exists():
+        path.unlink()
+    rows = [attr.asdict(r) for r in results]
+    if path.suffix == '.json':
+        rows_old = []
+        if path.exists():
+            with open(str(path)) as f:
+                rows_old = json.load(f)
+        with open(str(path), 'w') as f:
+            json.dump(rows_old + rows, f, indent=2)
+    elif path.suffix == '.csv':
+        is_new = not path.exists()
+        with open(str(path), 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=[a.name for a in attr.fields(BenchmarkResult)])
+            if is_new:
+                writer.writeheader()
+            writer.writerows(rows)
+    else:
+        raise Exception('Unknown benchmark output format {0}, must be .json or .csv'.format(path.suffix))
+    log.info('Saved {0} benchmark results to {1}'.format(len(rows), str(path)))
+
+
+def load_results(path: Path) -> List[BenchmarkResult]:
+    path = Path(path)
+    if path.suffix == '.json':
+        with open(str(path)) as f:
+            rows = json.load(f)
+    else:
+        with open(str(path), newline='') as f:
+            rows = list(csv.DictReader(f))
+        rows = [{k: _parse_csv_value(v) for k, v in row.items()} for row in rows]
+    return [BenchmarkResult(**row) for row in rows]
+
+
+def _parse_csv_value(value: str) -> Optional[Union[int, float, str]]:
+    if value == '':
+        return None
+    for t in (int, float):
+        try:
+            return t(value)
+        except ValueError:
+            pass
+    return value
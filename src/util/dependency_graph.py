@@ -0,0 +1,259 @@
+from typing import Dict, List, Optional, Set
+
+import attr
+import torch
+from torch import nn
+
+from util.logger import get_logger
+
+log = get_logger(__file__)
+
+# autograd nodes that keep the channels of their input, matched by the prefix of their class name
+_PASS_THROUGH_NODES = ('Relu', 'Threshold', 'Hardtanh', 'LeakyRelu', 'MaxPool', 'AvgPool', 'Dropout',
+                       'NativeDropout', 'Clone')
+_ADD_NODES = ('AddBackward', 'SubBackward')
+# union-find element of the channels that must not change, e.g. the network input and output
+_FIXED = '<fixed>'
+
+
+@attr.s
+class ChannelGroup:
+    """Output channels of convolutions that have to be pruned together, e.g. all convolutions added in a residual
+    path, with the batch norms normalizing them and the convolutions reading them
+    """
+    index = attr.ib()
+    n_channels = attr.ib()
+    producers = attr.ib(default=attr.Factory(list))
+    batchnorms = attr.ib(default=attr.Factory(list))
+    consumers = attr.ib(default=attr.Factory(list))
+    is_prunable = attr.ib(default=True)
+
+
+class DependencyGraph(object):
+    """Channel groups of a network, found by tracing the autograd graph of a forward pass on example_input.
+
+    Every Conv2d produces channels. Residual additions join the channels of their inputs into one group, activations
+    and pooling pass them on, and batch norms and convolutions consume them. Channels reaching anything else (a
+    concatenation, a cropping, a transposed convolution, the network output) are fixed, as are the ones of grouped
+    convolutions. This works for every backbone without knowing its layout, as long as the channel dependencies are
+    visible in the autograd graph.
+    """
+
+    def __init__(self, net: nn.Module, example_input: torch.Tensor):
+        self.groups = self._trace(net, example_input)
+
+    @property
+    def prunable_groups(self) -> List[ChannelGroup]:
+        return [g for g in self.groups if g.is_prunable]
+
+    def _trace(self, net: nn.Module, example_input: torch.Tensor) -> List[ChannelGroup]:
+        modules = {name: m for name, m in net.named_modules()
+                   if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d, nn.BatchNorm2d))}
+        node_to_name = {}
+        input_nodes = {}
+
+        def get_hook(name):
+            def hook(module, inputs, output):
+                input_nodes[name] = inputs[0].grad_fn
+                node_to_name[output.grad_fn] = name
+            return hook
+
+        handles = [m.register_forward_hook(get_hook(name)) for name, m in modules.items()]
+        is_training = {m: m.training for m in net.modules()}
+        # eval mode, so that the running statistics of the batch norms do not change
+        net.eval()
+        try:
+            with torch.enable_grad():
+                outputs = net(example_input.detach().requires_grad_())
+        finally:
+            for handle in handles:
+                handle.remove()
+            for m, training in is_training.items():
+                m.training = training
+        outputs = outputs if isinstance(outputs, (list, tuple)) else [outputs]
+
+        parents = {_FIXED: _FIXED}
+
+        def find(element):
+            parents.setdefault(element, element)
+            while parents[element] != element:
+                parents[element] = parents[parents[element]]
+                element = parents[element]
+            return element
+
+        def union(elements):
+            if len(elements) == 0:
+                return
+            roots = [find(e) for e in elements]
+            # the fixed element stays the root, so that it can be tested directly
+            root = _FIXED if _FIXED in roots else roots[0]
+            for r in roots:
+                parents[r] = root
+
+        sources_memo = {}
+
+        def get_sources(node) -> Set[str]:
+            """
+            Convolutions whose output channels reach the output of node unchanged
+            """
+            if node is None or type(node).__name__ == 'AccumulateGrad':
+                return {_FIXED}
+            if node in sources_memo:
+                return sources_memo[node]
+            name = node_to_name.get(node)
+            node_type = type(node).__name__
+            if name is not None:
+                module = modules[name]
+                if isinstance(module, nn.BatchNorm2d):
+                    sources = get_sources(input_nodes[name])
+                elif isinstance(module, nn.Conv2d) and module.groups == 1:
+                    sources = {name}
+                else:
+                    sources = {_FIXED}
+            elif node_type.startswith(_PASS_THROUGH_NODES) or node_type.startswith(_ADD_NODES):
+                sources = set()
+                for child, _ in node.next_functions:
+                    if child is not None:
+                        sources |= get_sources(child)
+                if node_type.startswith(_ADD_NODES):
+                    union(sources)
+            else:
+                sources = {_FIXED}
+            sources_memo[node] = sources
+            return sources
+
+        # anything the graph does with the channels apart from the known operations fixes them
+        stack = [o.grad_fn for o in outputs]
+        for o in outputs:
+            union(get_sources(o.grad_fn) | {_FIXED})
+        visited = set()
+        while stack:
+            node = stack.pop()
+            if node is None or node in visited:
+                continue
+            visited.add(node)
+            name = node_to_name.get(node)
+            node_type = type(node).__name__
+            if name is not None:
+                children = [input_nodes[name]]
+            else:
+                children = [child for child, _ in node.next_functions if child is not None]
+                if not (node_type.startswith(_PASS_THROUGH_NODES) or node_type.startswith(_ADD_NODES)):
+                    for child in children:
+                        if type(child).__name__ != 'AccumulateGrad':
+                            union(get_sources(child) | {_FIXED})
+            stack.extend(children)
+
+        traced = [name for name in modules if name in input_nodes]
+        for name in traced:
+            module = modules[name]
+            sources = get_sources(input_nodes[name])
+            if isinstance(module, nn.ConvTranspose2d) or (isinstance(module, nn.Conv2d) and module.groups != 1):
+                sources = sources | {_FIXED}
+            union(sources)
+
+        groups = {}  # type: Dict[str, ChannelGroup]
+
+        def get_group(element) -> ChannelGroup:
+            root = find(element)
+            if root not in groups:
+                groups[root] = ChannelGroup(index=len(groups), n_channels=None, is_prunable=root != _FIXED)
+            return groups[root]
+
+        for name in traced:
+            module = modules[name]
+            if isinstance(module, nn.Conv2d) and module.groups == 1:
+                group = get_group(name)
+                group.producers.append(name)
+                group.n_channels = module.out_channels
+            sources = get_sources(input_nodes[name])
+            if _FIXED in sources or len(sources) == 0:
+                continue
+            group = get_group(next(iter(sources)))
+            if isinstance(module, nn.BatchNorm2d):
+                group.batchnorms.append(name)
+            elif isinstance(module, nn.Conv2d):
+                group.consumers.append(name)
+
+        groups = [g for g in groups.values() if len(g.producers) > 0]
+        for index, group in enumerate(groups):
+            group.index = index
+        log.info('Traced {0} channel groups, {1} of them prunable'.format(len(groups),
+                                                                        len([g for g in groups if g.is_prunable])))
+        return groups
+
+
+def prune_groups(net: nn.Module, graph: DependencyGraph, keep_masks: Dict[int, torch.Tensor]) -> nn.Module:
+    """Remove channels of the groups of graph, keep_masks maps a group index to a boolean mask of its channels to
+    keep. Every affected module is rebuilt once, so the graph must be traced again before the next pruning.
+    """
+    keeps_in = {}
+    keeps_out = {}
+    keeps_batchnorm = {}
+    for index, keep in keep_masks.items():
+        group = graph.groups[index]
+        if not group.is_prunable:
+            raise Exception('Channel group {0} ({1}) cannot be pruned'.format(index, group.producers))
+        keep = torch.as_tensor(keep, dtype=torch.bool)
+        if not keep.any():
+            keep = keep.clone()
+            keep[-1] = True
+        keep = torch.nonzero(keep).view(-1)
+        keeps_out.update({name: keep for name in group.producers})
+        keeps_in.update({name: keep for name in group.consumers})
+        keeps_batchnorm.update({name: keep for name in group.batchnorms})
+
+    for name in set(keeps_in) | set(keeps_out):
+        _set_module(net, name, select_conv(net.get_submodule(name), keep_in=keeps_in.get(name),
+                                           keep_out=keeps_out.get(name)))
+    for name, keep in keeps_batchnorm.items():
+        _set_module(net, name, select_batchnorm(net.get_submodule(name), keep))
+    return net
+
+
+def _set_module(net: nn.Module, name: str, module: nn.Module) -> None:
+    name_parent, _, name_child = name.rpartition('.')
+    setattr(net.get_submodule(name_parent) if name_parent else net, name_child, module)
+
+
+def select_conv(conv: nn.Conv2d, keep_in: Optional[torch.Tensor] = None,
+                keep_out: Optional[torch.Tensor] = None) -> nn.Conv2d:
+    """
+    New convolution with the kept input and output channels of conv, on the device of its weights
+    """
+    weight = conv.weight.data
+    bias = None if conv.bias is None else conv.bias.data
+    if keep_out is not None:
+        keep_out = keep_out.to(weight.device)
+        weight = weight.index_select(0, keep_out)
+        bias = None if bias is None else bias.index_select(0, keep_out)
+    if keep_in is not None:
+        weight = weight.index_select(1, keep_in.to(weight.device))
+
+    # the parameters are overwritten, initializing them would only cost time
+    conv_new = torch.nn.utils.skip_init(nn.Conv2d, weight.size()[1] * conv.groups, weight.size()[0],
+                                        kernel_size=conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                                        dilation=conv.dilation, groups=conv.groups, bias=bias is not None,
+                                        device=weight.device)
+    conv_new.weight.data.copy_(weight)
+    if bias is not None:
+        conv_new.bias.data.copy_(bias)
+    return conv_new.train(conv.training)
+
+
+def select_batchnorm(batchnorm: nn.BatchNorm2d, keep: torch.Tensor) -> nn.BatchNorm2d:
+    """
+    New batch norm with the parameters and running statistics of the kept channels
+    """
+    batchnorm_new = nn.BatchNorm2d(len(keep), eps=batchnorm.eps, momentum=batchnorm.momentum,
+                                   affine=batchnorm.affine, track_running_stats=batchnorm.track_running_stats)
+    batchnorm_new = batchnorm_new.to(batchnorm.running_mean.device if batchnorm.track_running_stats
+                                     else batchnorm.weight.device)
+    for name in ['weight', 'bias', 'running_mean', 'running_var']:
+        tensor = getattr(batchnorm, name)
+        if tensor is not None:
+            getattr(batchnorm_new, name).data.copy_(tensor.data.index_select(0, keep.to(tensor.device)))
+    if batchnorm.track_running_stats:
+        batchnorm_new.num_batches_tracked.copy_(batchnorm.num_batches_tracked)
+    # a new module is in training mode, which would switch the batch norm of an evaluated network to batch statistics
+    return batchnorm_new.train(batchnorm.training)
@@ -3,68 +3,80 @@ from pathlib import Path
 from typing import Optional
 
 import numpy as np
-from scipy import misc
 import matplotlib.pyplot as plt
-from torch.autograd import Variable
+import torch
 from torch.utils.data import DataLoader
-from torch import cuda
 
 from dataloaders.helpers import im_normalize
-from . import gpu_handler
+from networks.inference import fuse_for_inference, set_inference_mode
+from . import benchmark_helper, gpu_handler
 from .network_provider import NetworkProvider
+from .prediction_writer import PredictionWriter
+from .resolution_helper import AdaptiveResolutionPredictor
+from .roi_helper import RoiPredictor
+from .temporal_helper import TemporalPredictor
 from .logger import get_logger
 
 log = get_logger(__file__)
 
 
 def test(net_provider: NetworkProvider, data_loader: DataLoader, save_dir: Path,
-         is_visualizing_results: bool, eval_speeds: bool, seq_name: Optional[str] = None) -> None:
+         is_visualizing_results: bool, eval_speeds: bool, seq_name: Optional[str] = None,
+         is_fusing_for_inference: bool = False, inference_mode: str = 'fp32',
+         temporal_threshold: Optional[float] = None, temporal_max_skip: int = 5,
+         roi_padding: Optional[float] = None, target_fps: Optional[float] = None) -> None:
     log.info('Testing Network')
 
     net = net_provider.network
+    if is_fusing_for_inference:
+        # uses the running statistics of the batch norms, like eval mode
+        net = fuse_for_inference(net)
+    net = set_inference_mode(net, inference_mode)
+
+    if eval_speeds:
+        name = '{0}/{1}'.format(getattr(net_provider, 'name', type(net).__name__), seq_name or 'offline')
+        result = benchmark_helper.benchmark_data_loader(net, data_loader, name)
+        benchmark_helper.save_results([result], save_dir / 'speeds.json')
+        return
+
+    # wrappers that keep state between the frames of a sequence
+    predictors = []
+    if target_fps is not None:
+        net = AdaptiveResolutionPredictor(net, target_latency_ms=1000 / target_fps)
+        predictors.append(net)
+    if roi_padding is not None:
+        net = RoiPredictor(net, padding=roi_padding)
+        predictors.append(net)
+    if temporal_threshold is not None:
+        net = TemporalPredictor(net, threshold=temporal_threshold, max_skip=temporal_max_skip)
+        predictors.append(net)
 
     if is_visualizing_results:
         ax_arr = _init_plot()
 
-    n_runs = 1
-    times = []
-    if eval_speeds:
-        n_runs = 10
-    time_all_start = timeit.default_timer()
-    for _ in range(n_runs):
-        for minibatch_index, minibatch in enumerate(data_loader):
+    with PredictionWriter() as writer, torch.no_grad():
+        seq_name_last = None
+        time_all_start = timeit.default_timer()
+        for minibatch in data_loader:
             img, gt, minibatch_seq_name, fname = minibatch['image'], minibatch['gt'], \
                                                  minibatch['seq_name'], minibatch['fname']
 
-            inputs, gts = Variable(img, volatile=True), Variable(gt, volatile=True)
-            inputs, gts = gpu_handler.cast_cuda_if_possible([inputs, gts])
+            inputs, gts = gpu_handler.cast_cuda_if_possible([img, gt])
+
+            if minibatch_seq_name[0] != seq_name_last:
+                for predictor in predictors:
+                    predictor.reset()
+                seq_name_last = minibatch_seq_name[0]
 
-            if eval_speeds:
-                # https://github.com/jcjohnson/cnn-benchmarks/blob/master/utils.lua
-                cuda.synchronize()
-                time_image_start = timeit.default_timer()
             outputs = net.forward(inputs)
-            if eval_speeds:
-                cuda.synchronize()
-                time_image_stop = timeit.default_timer()
-                time_image_total = time_image_stop - time_image_start
-                if minibatch_index > 0:
-                    # first allocate takes longer
-                    times.append(time_image_total)
-            else:
-                for index in range(inputs.size()[0]):
-                    pred = np.transpose(outputs[-1].cpu().data.numpy()[index, :, :, :], (1, 2, 0))
-                    pred = 1 / (1 + np.exp(-pred))
-                    pred = np.squeeze(pred)
-
-                    save_dir_seq = save_dir / minibatch_seq_name[index]
-                    save_dir_seq.mkdir(parents=True, exist_ok=True)
-
-                    file_name = save_dir_seq / '{0}.png'.format(fname[index])
-                    misc.imsave(str(file_name), pred)
-
-                    if is_visualizing_results:
-                        _visualize_results(ax_arr, gt, img, index, pred)
+            preds = outputs[-1].cpu().data.numpy()
+            for index in range(inputs.size()[0]):
+                file_name = save_dir / minibatch_seq_name[index] / '{0}.png'.format(fname[index])
+                writer.put(file_name, preds[index])
+
+                if is_visualizing_results:
+                    pred = np.squeeze(1 / (1 + np.exp(-preds[index])))
+                    _visualize_results(ax_arr, gt, img, index, pred)
 
     time_all_stop = timeit.default_timer()
     time_for_all = time_all_stop - time_all_start
@@ -73,11 +85,8 @@ def test(net_provider: NetworkProvider, data_loader: DataLoader, save_dir: Path,
     log.info('Test {0}: total test time {1} sec'.format(seq_name, str(time_for_all)))
     log.info('Test {0}: {1} images'.format(seq_name, str(n_images)))
     log.info('Test {0}: time per sample {1} sec'.format(seq_name, str(time_per_sample)))
-
-    if eval_speeds:
-        log.info('Test {0}: accurate {1} images'.format(seq_name, str((n_images - 1) * n_runs)))
-        log.info('Test {0}: accurate total time {1} sec ({2} runs)'.format(seq_name, np.sum (times), n_runs))
-        log.info('Test {0}: accurate time per sample {1} sec ({2} runs)'.format(seq_name, np.average(times), n_runs))
+    for predictor in predictors:
+        predictor.log_stats(seq_name)
 
 
 def _init_plot():
@@ -0,0 +1,198 @@
+import os
+import re
+import sys
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import BinaryIO, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from util.logger import get_logger
+from util.stream_helper import SyntheticCapture
+
+log = get_logger(__file__)
+
+
+class FrameSource(ABC):
+    """BGR uint8 frames with the read() / release() interface of cv2.VideoCapture"""
+
+    @abstractmethod
+    def read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        pass
+
+    def release(self) -> None:
+        pass
+
+
+class CaptureSource(FrameSource):
+    """Camera (by index) or video file, read through cv2.VideoCapture"""
+
+    def __init__(self, device_or_path):
+        self.capture = cv2.VideoCapture(device_or_path)
+        if not self.capture.isOpened():
+            raise Exception('Could not open {0}'.format(device_or_path))
+
+    def read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        return self.capture.read()
+
+    def release(self) -> None:
+        self.capture.release()
+
+
+class ImageDirectorySource(FrameSource):
+    """The images of a directory in file name order, e.g. a sequence of DAVIS/JPEGImages/480p"""
+
+    def __init__(self, path: Path, extensions: Tuple[str, ...] = ('.jpg', '.jpeg', '.png')):
+        self.paths = sorted(p for p in Path(path).iterdir() if p.suffix.lower() in extensions)
+        if len(self.paths) == 0:
+            raise Exception('No images found in {0}'.format(str(path)))
+        self._index = 0
+
+    def read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        if self._index >= len(self.paths):
+            return False, None
+        img = cv2.imread(str(self.paths[self._index]))
+        self._index += 1
+        return img is not None, img
+
+
+class RawStreamSource(FrameSource):
+    """Raw height x width x 3 BGR frames from a byte stream, e.g. ffmpeg -f rawvideo -pix_fmt bgr24 - | ..."""
+
+    def __init__(self, height: int, width: int, stream: Optional[BinaryIO] = None):
+        self.height = height
+        self.width = width
+        self.stream = sys.stdin.buffer if stream is None else stream
+        self._n_bytes = height * width * 3
+
+    def read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        data = self.stream.read(self._n_bytes)
+        if data is None or len(data) < self._n_bytes:
+            return False, None
+        return True, np.frombuffer(data, dtype=np.uint8).reshape(self.height, self.width, 3).copy()
+
+
+class SyntheticSource(FrameSource):
+    def __init__(self, **kwargs):
+        self.capture = SyntheticCapture(**kwargs)
+
+    def read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        return self.capture.read()
+
+
+def get_frame_source(spec: str) -> FrameSource:
+    """Create a frame source from a command line argument:
+    an integer (camera index), 'synthetic', 'stdin:<height>x<width>', an image directory or a video file
+    """
+    if re.fullmatch(r'\d+', spec):
+        return CaptureSource(int(spec))
+    if spec == 'synthetic':
+        return SyntheticSource(fps=30)
+    match = re.fullmatch(r'stdin:(\d+)x(\d+)', spec)
+    if match:
+        return RawStreamSource(int(match.group(1)), int(match.group(2)))
+    path = Path(spec)
+    if path.is_dir():
+        return ImageDirectorySource(path)
+    if path.is_file():
+        return CaptureSource(str(path))
+    raise Exception('Unknown frame source {0}'.format(spec))
+
+
+class FrameSink(ABC):
+    """Consumer of the processed frames, write() returns False to stop the loop"""
+
+    @abstractmethod
+    def write(self, frame: np.ndarray) -> bool:
+        pass
+
+    def release(self) -> None:
+        pass
+
+
+class DisplaySink(FrameSink):
+    def __init__(self, window_name: str):
+        self.window_name = window_name
+
+    def write(self, frame: np.ndarray) -> bool:
+        cv2.imshow(self.window_name, frame)
+        return cv2.waitKey(1) != 27  # esc to quit
+
+    def release(self) -> None:
+        cv2.destroyAllWindows()
+
+
+class VideoFileSink(FrameSink):
+    """Write the frames to a video file, opened with the size of the first frame"""
+
+    def __init__(self, path: Path, fps: float = 30, fourcc: str = 'mp4v'):
+        self.path = Path(path)
+        self.fps = fps
+        self.fourcc = fourcc
+        self._writer = None
+
+    def write(self, frame: np.ndarray) -> bool:
+        frame = to_uint8_bgr(frame)
+        if self._writer is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._writer = cv2.VideoWriter(str(self.path), cv2.VideoWriter_fourcc(*self.fourcc), self.fps,
+                                           (frame.shape[1], frame.shape[0]))
+        self._writer.write(frame)
+        return True
+
+    def release(self) -> None:
+        if self._writer is not None:
+            self._writer.release()
+            log.info('Wrote video {0}'.format(str(self.path)))
+
+
+class ImageDirectorySink(FrameSink):
+    """Write every frame as a numbered PNG, e.g. the masks of a sequence for evaluation"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._index = 0
+
+    def write(self, frame: np.ndarray) -> bool:
+        cv2.imwrite(str(self.path / '{0:05d}.png'.format(self._index)), to_uint8_bgr(frame))
+        self._index += 1
+        return True
+
+
+class NullSink(FrameSink):
+    """Discard the frames, to measure the throughput of the processing alone"""
+
+    def write(self, frame: np.ndarray) -> bool:
+        return True
+
+
+def get_frame_sink(spec: str, window_name: str = 'osvos') -> FrameSink:
+    """Create a frame sink from a command line argument:
+    'display', 'null', a video file (.avi, .mp4, .mkv) or a directory for PNGs, given as 'dir:<path>', with a
+    trailing slash or as an existing directory, so that a mistyped sink does not silently create a directory
+    """
+    if spec == 'display':
+        return DisplaySink(window_name)
+    if spec == 'null':
+        return NullSink()
+    if Path(spec).suffix.lower() in ['.avi', '.mp4', '.mkv']:
+        return VideoFileSink(Path(spec))
+    if spec.startswith('dir:'):
+        return ImageDirectorySink(Path(spec[len('dir:'):]))
+    if spec.endswith(('/', os.sep)) or Path(spec).is_dir():
+        return ImageDirectorySink(Path(spec))
+    raise ValueError('Unknown frame sink {0}, must be display, null, a video file or a directory as dir:<path>'
+                     .format(spec))
+
+
+def to_uint8_bgr(frame: np.ndarray) -> np.ndarray:
+    """
+    Masks and probabilities in [0, 1] are scaled to [0, 255], single channel frames are converted to BGR
+    """
+    if frame.dtype != np.uint8:
+        frame = np.clip(frame * 255, 0, 255).astype(np.uint8)
+    if frame.ndim == 2:
+        frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+    return frame
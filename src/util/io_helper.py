@@ -1,19 +1,21 @@
 import datetime
 import socket
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Union
 
 import shutil
 import torch
 import yaml
 from tensorboardX import SummaryWriter
 from torch.autograd import Variable
-from torch.utils.data import DataLoader
-from torchvision import transforms
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data.dataloader import default_collate
 
 import visualize as viz
 from dataloaders import custom_transforms
+from dataloaders.bucketing import BucketedDataset, ScaleBucketBatchSampler
 from dataloaders.davis_2016 import DAVIS2016
+from dataloaders.single_frame import SingleFrameLoader
 from util.settings import Settings
 from util.logger import get_logger
 
@@ -59,19 +61,49 @@ def write_settings(save_dir: Path, name: str, settings: Settings, variant_offlin
         yaml.dump(settings, f, default_flow_style=False)
 
 
-def get_data_loader_train(db_root_dir: Path, batch_size: int, seq_name: Optional[str] = None) -> DataLoader:
-    # Define augmentation transformations as a composition
-    composed_transforms = transforms.Compose([custom_transforms.RandomHorizontalFlip(),
-                                              custom_transforms.Resize(),
-                                              # custom_transforms.ScaleNRotate(rots=(-30, 30), scales=(.75, 1.25)),
-                                              custom_transforms.ToTensor()])
-    db_train = DAVIS2016(mode='train', db_root_dir=str(db_root_dir), transform=composed_transforms, seq_name=seq_name)
-    data_loader = DataLoader(db_train, batch_size=batch_size, shuffle=True, num_workers=1)
+def get_data_loader_train(db_root_dir: Path, batch_size: int, seq_name: Optional[str] = None,
+                          cache_dir: Optional[Path] = None,
+                          is_flipping: bool = True) -> Union[DataLoader, SingleFrameLoader]:
+    if seq_name is not None:
+        # online training uses only the first frame of the sequence
+        db_train = DAVIS2016(mode='train', db_root_dir=str(db_root_dir), transform=None, seq_name=seq_name,
+                             cache_dir=_to_str(cache_dir))
+        return SingleFrameLoader(db_train, batch_size=batch_size, is_flipping=is_flipping)
+
+    # Random flip and resize are chosen by the sampler, so that all samples of a batch have the same size
+    db_train = DAVIS2016(mode='train', db_root_dir=str(db_root_dir), transform=None, cache_dir=_to_str(cache_dir))
+    batch_sampler = ScaleBucketBatchSampler(len(db_train), batch_size, is_flipping=is_flipping)
+    data_loader = DataLoader(BucketedDataset(db_train), batch_sampler=batch_sampler, num_workers=1,
+                             collate_fn=_get_collate_fn(db_train))
     return data_loader
 
 
-def get_data_loader_test(db_root_dir: Path, batch_size: int, seq_name: Optional[str] = None) -> DataLoader:
+def get_data_loader_test(db_root_dir: Path, batch_size: int, seq_name: Optional[str] = None,
+                         cache_dir: Optional[Path] = None) -> DataLoader:
     db_test = DAVIS2016(mode='test', db_root_dir=str(db_root_dir), transform=custom_transforms.ToTensor(),
-                        seq_name=seq_name)
-    data_loader = DataLoader(db_test, batch_size=batch_size, shuffle=False, num_workers=2)
+                        seq_name=seq_name, cache_dir=_to_str(cache_dir))
+    data_loader = DataLoader(db_test, batch_size=batch_size, shuffle=False, num_workers=2,
+                             collate_fn=_get_collate_fn(db_test))
     return data_loader
+
+
+def get_data_loader_annotated(db_root_dir: Path, seq_name: str, n_frames: Optional[int] = None) -> DataLoader:
+    """
+    The first n_frames of a validation sequence, whose annotations are all available, for measuring the accuracy
+    """
+    db_test = DAVIS2016(mode='test', db_root_dir=str(db_root_dir), transform=custom_transforms.ToTensor())
+    indices = [i for i, s in enumerate(db_test.seq_list) if s == seq_name][:n_frames]
+    if len(indices) == 0:
+        raise Exception('Sequence {0} is not part of the validation set'.format(seq_name))
+    return DataLoader(Subset(db_test, indices), batch_size=1, shuffle=False)
+
+
+def _get_collate_fn(dataset: DAVIS2016):
+    # cached frames come without mean subtraction, it is done once per batch
+    if dataset.frame_cache is None:
+        return default_collate
+    return custom_transforms.SubtractMeanCollate(dataset.meanval)
+
+
+def _to_str(path: Optional[Path]) -> Optional[str]:
+    return None if path is None else str(path)
@@ -0,0 +1,60 @@
+import cv2
+import numpy as np
+import torch
+
+COLOR_INDICES = {'b': 0, 'g': 1, 'r': 2}
+
+
+class OverlayRenderer(object):
+    """Turn the logits of a frame into the displayed uint8 image.
+
+    The sigmoid, the threshold and the scaling by alpha run on the device of the logits, which then only has to
+    transfer a uint8 mask: the prediction in [0, 255] steps is mapped to the value added to the overlay channel by a
+    lookup table. The blend is a saturating uint8 addition into a ring of preallocated buffers, n_buffers of them so
+    that a frame is not overwritten while the pipeline still queues or displays it.
+    """
+
+    def __init__(self, overlay: bool = True, boolean_mask: bool = True, overlay_color: str = 'r',
+                 overlay_alpha: float = 1.0, n_buffers: int = 3):
+        if overlay_color not in COLOR_INDICES:
+            raise Exception('Unknown overlay color {0}, must be in {1}'.format(overlay_color, list(COLOR_INDICES)))
+        self.overlay = overlay
+        self.boolean_mask = boolean_mask
+        self.color_index = COLOR_INDICES[overlay_color]
+        self.n_buffers = n_buffers
+        # the value added for a prediction of q / 255
+        self._lut = torch.from_numpy(np.clip(np.round(np.arange(256) * overlay_alpha), 0, 255).astype(np.uint8))
+        self._buffers = []
+        self._addends = []
+        self._index_buffer = 0
+
+    def render(self, img: np.ndarray, logits: torch.Tensor) -> np.ndarray:
+        """
+        img: the uint8 BGR frame, logits: the 1 x 1 x H x W output of the network for it
+        """
+        with torch.no_grad():
+            mask = self._to_mask(logits[0, 0])
+            if not self.overlay:
+                return mask.cpu().numpy()
+            if self._lut.device != mask.device:
+                self._lut = self._lut.to(mask.device)
+            addend = self._lut[mask.long()].cpu().numpy()
+
+        output, addend_bgr = self._get_buffers(img.shape)
+        addend_bgr[..., self.color_index] = addend
+        return cv2.add(img, addend_bgr, dst=output)
+
+    def _to_mask(self, logits: torch.Tensor) -> torch.Tensor:
+        if self.boolean_mask:
+            # sigmoid(x) >= 0.5
+            return (logits >= 0).to(torch.uint8) * 255
+        return torch.sigmoid(logits.float()).mul_(255).round_().to(torch.uint8)
+
+    def _get_buffers(self, shape):
+        if len(self._buffers) == 0 or self._buffers[0].shape != shape:
+            self._buffers = [np.empty(shape, dtype=np.uint8) for _ in range(self.n_buffers)]
+            # the other channels stay zero
+            self._addends = [np.zeros(shape, dtype=np.uint8) for _ in range(self.n_buffers)]
+        index = self._index_buffer
+        self._index_buffer = (index + 1) % self.n_buffers
+        return self._buffers[index], self._addends[index]
@@ -0,0 +1,109 @@
+import queue
+import threading
+import timeit
+from pathlib import Path
+from typing import List, Optional
+
+import cv2
+import numpy as np
+
+from util.logger import get_logger
+
+log = get_logger(__file__)
+
+_stop = None
+
+
+class PredictionWriter(object):
+    """Write predictions as PNGs in background threads, so that inference and disk I/O overlap.
+
+    put() hands the logits of one prediction to a bounded queue and blocks while the queue is full, which keeps the
+    memory bounded if the disk is slower than the network. The workers apply the sigmoid, quantize to uint8,
+    create the directories and encode the PNGs (cv2 releases the GIL while encoding).
+    Use close() or the with statement to wait for all predictions to be written.
+    """
+
+    def __init__(self, n_workers: int = 2, max_queue_size: int = 16):
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._dirs_created = set()
+        self._error = None  # type: Optional[Exception]
+
+        self.n_written = 0
+        self.time_blocked = 0.0
+        self._queue_depths = []  # type: List[int]
+        self._time_start = timeit.default_timer()
+
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(n_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def put(self, file_name: Path, logits: np.ndarray) -> None:
+        """
+        Queue the H x W (or 1 x H x W) logits of a prediction to be written to file_name
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue_depths.append(self._queue.qsize())
+        time_start = timeit.default_timer()
+        self._queue.put((file_name, logits))
+        self.time_blocked += timeit.default_timer() - time_start
+
+    def close(self) -> None:
+        for _ in self._workers:
+            self._queue.put(_stop)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        if self._error is not None:
+            raise self._error
+        self._log_stats()
+
+    def _work(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _stop:
+                return
+            if self._error is not None:
+                continue
+            file_name, logits = item
+            try:
+                self._write(file_name, logits)
+            except Exception as e:
+                self._error = e
+
+    def _write(self, file_name: Path, logits: np.ndarray) -> None:
+        pred = to_uint8(logits)
+        directory = file_name.parent
+        if directory not in self._dirs_created:
+            directory.mkdir(parents=True, exist_ok=True)
+            with self._lock:
+                self._dirs_created.add(directory)
+        if not cv2.imwrite(str(file_name), pred):
+            raise Exception('Could not write {0}'.format(str(file_name)))
+        with self._lock:
+            self.n_written += 1
+
+    def _log_stats(self) -> None:
+        time_total = timeit.default_timer() - self._time_start
+        depths = self._queue_depths or [0]
+        log.info('Prediction writer: {0} images in {1:.2f} sec ({2:.1f} images/sec), queue depth mean {3:.1f} '
+                 'max {4}, inference blocked for {5:.2f} sec'.format(self.n_written, time_total,
+                                                                     self.n_written / max(time_total, 1e-8),
+                                                                     np.mean(depths), np.max(depths),
+                                                                     self.time_blocked))
+
+
+def to_uint8(logits: np.ndarray) -> np.ndarray:
+    """
+    Sigmoid of the logits quantized to [0, 255]
+    """
+    pred = np.squeeze(logits).astype(np.float32)
+    pred = 1 / (1 + np.exp(-pred))
+    return np.rint(pred * 255).astype(np.uint8)
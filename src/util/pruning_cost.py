@@ -0,0 +1,80 @@
+from copy import deepcopy
+from typing import Dict, List, Optional
+
+import torch
+from torch import nn
+
+from util import benchmark_helper
+from util.logger import get_logger
+
+log = get_logger(__file__)
+
+
+def get_input_sizes(net: nn.Module, modules: List[nn.Module], height: int, width: int) -> Dict[nn.Module, torch.Size]:
+    """
+    Size of the input of every module in a forward pass of net on a height x width frame
+    """
+    sizes = {}
+    handles = [m.register_forward_hook(lambda module, inputs, output: sizes.__setitem__(module, inputs[0].size()))
+               for m in modules]
+    device = benchmark_helper.get_device(net)
+    is_training = net.training
+    net.eval()
+    try:
+        with torch.no_grad():
+            net(torch.zeros(1, 3, height, width, device=device))
+    finally:
+        for handle in handles:
+            handle.remove()
+        net.train(is_training)
+    return sizes
+
+
+def measure_latency_ms(module: nn.Module, input_size: torch.Size, device: torch.device, n_warmup: int = 2,
+                       n_runs: int = 5) -> float:
+    """
+    Median latency of module on a random input, run on a copy on device
+    """
+    module = deepcopy(module).to(device).eval()
+    x = torch.randn(input_size, device=device)
+    result = benchmark_helper.benchmark(module, [x], type(module).__name__, n_warmup=n_warmup, n_runs=n_runs,
+                                        is_logging=False)
+    return result.latency_p50_ms
+
+
+def get_filter_costs(net: nn.Module, producers: Dict[int, List[nn.Module]], consumers: Dict[int, List[nn.Module]],
+                     height: int = 480, width: int = 854, device: Optional[torch.device] = None,
+                     n_warmup: int = 2, n_runs: int = 5) -> Dict[int, float]:
+    """Latency in ms that removing one filter of a layer saves, for every layer index of producers.
+
+    The latency of every convolution is measured at the input size it has for a height x width frame (on the CPU
+    by default, the deployment target). The latency of a convolution is assumed linear in its output channels when it
+    produces the filters of a layer, and linear in its input channels when it consumes them, so a filter costs the
+    sum of the latencies of these convolutions divided by their respective channel counts.
+    """
+    device = torch.device('cpu') if device is None else device
+    modules = list({m for ms in list(producers.values()) + list(consumers.values()) for m in ms})
+    input_sizes = get_input_sizes(net, modules, height, width)
+    latencies = {m: measure_latency_ms(m, input_sizes[m], device, n_warmup, n_runs)
+                 for m in modules if m in input_sizes}
+
+    costs = {}
+    for index, modules_producing in producers.items():
+        cost = sum(latencies.get(m, 0.0) / m.out_channels for m in modules_producing)
+        cost += sum(latencies.get(m, 0.0) / m.in_channels for m in consumers.get(index, []))
+        costs[index] = cost
+    log.info('Profiled {0} convolutions at {1}x{2}, {3:.1f} ms in total'.format(len(latencies), height, width,
+                                                                             sum(latencies.values())))
+    return costs
+
+
+def measure_network_latency_ms(net: nn.Module, height: int = 480, width: int = 854,
+                               device: Optional[torch.device] = None, n_warmup: int = 2, n_runs: int = 10) -> float:
+    """
+    Median latency of a forward pass of an evaluation copy of net on a height x width frame
+    """
+    device = torch.device('cpu') if device is None else device
+    x = torch.randn(1, 3, height, width, device=device)
+    result = benchmark_helper.benchmark(deepcopy(net).to(device).eval(), [x], 'network', n_warmup=n_warmup,
+                                        n_runs=n_runs, is_logging=False)
+    return result.latency_p50_ms
@@ -0,0 +1,98 @@
+import timeit
+from collections import Counter
+from typing import Optional, Sequence
+
+from torch import nn
+from torch.nn import functional as F
+
+from util import benchmark_helper
+from util.logger import get_logger
+
+log = get_logger(__file__)
+
+SCALES_DEFAULT = (1.0, 0.875, 0.75, 0.625, 0.5)
+
+
+class AdaptiveResolutionPredictor(nn.Module):
+    """Wrap a network to scale its input so that the latency of a frame stays within target_latency_ms.
+
+    The latency (including the resizing) is tracked as an exponential moving average. Above the target by more than
+    hysteresis the next smaller scale is used, and the next larger one if the average latency scaled by the number
+    of pixels predicts that it stays below the target by hysteresis. After a change the average starts over.
+    The outputs are resized back to the input size, so the wrapper can be used in place of the network.
+    """
+
+    def __init__(self, net: nn.Module, target_latency_ms: float, scales: Sequence[float] = SCALES_DEFAULT,
+                 momentum: float = 0.2, hysteresis: float = 0.1, n_min_frames: int = 3):
+        super(AdaptiveResolutionPredictor, self).__init__()
+        self.net = net
+        self.target_latency_ms = target_latency_ms
+        self.scales = sorted(scales, reverse=True)
+        self.momentum = momentum
+        self.hysteresis = hysteresis
+        self.n_min_frames = n_min_frames
+
+        self.index_scale = 0
+        self.latency_ms = None  # type: Optional[float]
+        self.scale_counts = Counter()
+        self._n_frames_at_scale = 0
+        self._device = None
+
+    @property
+    def scale(self) -> float:
+        return self.scales[self.index_scale]
+
+    def reset(self) -> None:
+        """
+        The latency does not depend on the sequence, the chosen scale is kept
+        """
+        pass
+
+    def forward(self, x):
+        if self._device is None:
+            self._device = benchmark_helper.get_device(self.net)
+        height, width = x.size()[-2:]
+        scale = self.scale
+        self.scale_counts[scale] += 1
+
+        time_start = timeit.default_timer()
+        if scale != 1.0:
+            size = (max(int(round(height * scale)), 1), max(int(round(width * scale)), 1))
+            x = F.interpolate(x, size=size, mode='bilinear', align_corners=False)
+        outputs = self.net(x)
+        if scale != 1.0:
+            outputs = [F.interpolate(o, size=(height, width), mode='bilinear', align_corners=False) for o in outputs]
+        benchmark_helper.synchronize(self._device)
+        self._update((timeit.default_timer() - time_start) * 1000)
+        return outputs
+
+    def _update(self, latency_ms: float) -> None:
+        if self.latency_ms is None:
+            self.latency_ms = latency_ms
+        else:
+            self.latency_ms = (1 - self.momentum) * self.latency_ms + self.momentum * latency_ms
+        self._n_frames_at_scale += 1
+        if self._n_frames_at_scale < self.n_min_frames:
+            return
+
+        index_scale = self.index_scale
+        if self.latency_ms > self.target_latency_ms * (1 + self.hysteresis):
+            index_scale = min(index_scale + 1, len(self.scales) - 1)
+        elif index_scale > 0:
+            latency_ms_larger = self.latency_ms * (self.scales[index_scale - 1] / self.scale) ** 2
+            if latency_ms_larger < self.target_latency_ms * (1 - self.hysteresis):
+                index_scale -= 1
+        if index_scale == self.index_scale:
+            return
+
+        log.info('Input scale {0:.3f} -> {1:.3f} (latency {2:.1f} ms, target {3:.1f} ms)'.format(
+            self.scale, self.scales[index_scale], self.latency_ms, self.target_latency_ms))
+        self.index_scale = index_scale
+        self.latency_ms = None
+        self._n_frames_at_scale = 0
+
+    def log_stats(self, name: str = '') -> None:
+        n_frames = max(sum(self.scale_counts.values()), 1)
+        scales = ', '.join('{0:.3f}: {1:.1%}'.format(s, self.scale_counts[s] / n_frames)
+                           for s in self.scales if self.scale_counts[s] > 0)
+        log.info('Resolution {0}: frames per input scale {1}'.format(name, scales))
@@ -0,0 +1,132 @@
+from typing import List, Optional, Tuple
+
+import torch
+from torch import nn
+
+from util.logger import get_logger
+
+log = get_logger(__file__)
+
+# logit of the pixels outside of the region of interest, sigmoid(-20) ~ 2e-9
+BACKGROUND_LOGIT = -20.0
+
+
+class RoiPredictor(nn.Module):
+    """Wrap a network to segment only a region of interest around the mask of the previous frame.
+
+    The bounding box of the previous mask is enlarged by padding (a fraction of its size on every side), grown to at
+    least min_size and rounded up to a multiple of multiple pixels. The network runs on that crop and its outputs are
+    pasted into full size outputs filled with BACKGROUND_LOGIT. The full frame is segmented instead for the first
+    frame, after reset(), when the object is lost, and when the mask of a crop touches a crop border that is not a
+    border of the frame, as the object might continue outside of it.
+    Only batches of a single frame are cropped, larger batches are always segmented at full size.
+    """
+
+    def __init__(self, net: nn.Module, padding: float = 0.25, min_size: int = 96, multiple: int = 16,
+                 max_area_fraction: float = 0.6):
+        super(RoiPredictor, self).__init__()
+        self.net = net
+        self.padding = padding
+        self.min_size = min_size
+        self.multiple = multiple
+        self.max_area_fraction = max_area_fraction
+
+        self.n_frames = 0
+        self.n_full = 0
+        self.n_pixels = 0
+        self.n_pixels_full = 0
+        self._box = None  # type: Optional[Tuple[int, int, int, int]]
+
+    def reset(self) -> None:
+        """
+        Forget the previous mask, e.g. at the start of a new sequence
+        """
+        self._box = None
+
+    @property
+    def area_fraction(self) -> float:
+        """
+        Processed pixels relative to full frames, roughly the fraction of the FLOPs of full frame inference
+        """
+        return self.n_pixels / max(self.n_pixels_full, 1)
+
+    def forward(self, x):
+        self.n_frames += 1
+        height, width = x.size()[-2:]
+        self.n_pixels_full += height * width
+        if x.size()[0] != 1:
+            self.reset()
+            return self._forward_full(x)
+
+        box = self._get_roi(height, width)
+        if box is None:
+            outputs = self._forward_full(x)
+        else:
+            y0, y1, x0, x1 = box
+            outputs_crop = self.net(x[:, :, y0:y1, x0:x1])
+            self.n_pixels += (y1 - y0) * (x1 - x0)
+            mask_crop = outputs_crop[-1][0, 0] >= 0
+            if not mask_crop.any() or self._is_touching_border(mask_crop, box, height, width):
+                outputs = self._forward_full(x)
+            else:
+                outputs = [self._paste(o, box, height, width) for o in outputs_crop]
+                self._box = _get_bounding_box(mask_crop, y0, x0)
+                return outputs
+
+        self._box = _get_bounding_box(outputs[-1][0, 0] >= 0)
+        return outputs
+
+    def _forward_full(self, x) -> List[torch.Tensor]:
+        self.n_full += 1
+        self.n_pixels += x.size()[-2] * x.size()[-1]
+        return self.net(x)
+
+    def _get_roi(self, height: int, width: int) -> Optional[Tuple[int, int, int, int]]:
+        if self._box is None:
+            return None
+        y0, y1, x0, x1 = self._box
+        y0, y1 = _pad_range(y0, y1, height, self.padding, self.min_size, self.multiple)
+        x0, x1 = _pad_range(x0, x1, width, self.padding, self.min_size, self.multiple)
+        # cropping saves little for large objects
+        if (y1 - y0) * (x1 - x0) > self.max_area_fraction * height * width:
+            return None
+        return y0, y1, x0, x1
+
+    @staticmethod
+    def _is_touching_border(mask: torch.Tensor, box: Tuple[int, int, int, int], height: int, width: int) -> bool:
+        y0, y1, x0, x1 = box
+        return bool((y0 > 0 and mask[0].any()) or (y1 < height and mask[-1].any()) or
+                    (x0 > 0 and mask[:, 0].any()) or (x1 < width and mask[:, -1].any()))
+
+    @staticmethod
+    def _paste(output: torch.Tensor, box: Tuple[int, int, int, int], height: int, width: int) -> torch.Tensor:
+        y0, y1, x0, x1 = box
+        output_full = output.new_full(output.size()[:2] + (height, width), BACKGROUND_LOGIT)
+        output_full[:, :, y0:y1, x0:x1] = output
+        return output_full
+
+    def log_stats(self, name: str = '') -> None:
+        log.info('ROI {0}: {1} of {2} frames at full size, {3:.1%} of the full frame pixels processed'.format(
+            name, self.n_full, self.n_frames, self.area_fraction))
+
+
+def _get_bounding_box(mask: torch.Tensor, offset_y: int = 0,
+                      offset_x: int = 0) -> Optional[Tuple[int, int, int, int]]:
+    """
+    (y0, y1, x0, x1) of the nonzero pixels of a 2D mask, with exclusive ends, None if the mask is empty
+    """
+    rows = torch.nonzero(mask.any(dim=1)).view(-1)
+    if len(rows) == 0:
+        return None
+    cols = torch.nonzero(mask.any(dim=0)).view(-1)
+    return (offset_y + int(rows[0]), offset_y + int(rows[-1]) + 1,
+            offset_x + int(cols[0]), offset_x + int(cols[-1]) + 1)
+
+
+def _pad_range(start: int, stop: int, size: int, padding: float, min_size: int, multiple: int) -> Tuple[int, int]:
+    length = stop - start
+    length = max(int(round(length * (1 + 2 * padding))), min_size)
+    length = min(-(-length // multiple) * multiple, size)
+    center = (start + stop) // 2
+    start = min(max(center - length // 2, 0), size - length)
+    return start, start + length
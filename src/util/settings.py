@@ -7,7 +7,6 @@ class Settings:
     is_testing = attr.ib()
     start_epoch = attr.ib()
     n_epochs = attr.ib()
-    avg_grad_every_n = attr.ib()
     snapshot_every_n = attr.ib()
     is_testing_while_training = attr.ib()
     test_every_n = attr.ib()
@@ -17,6 +16,14 @@ class Settings:
     is_visualizing_results = attr.ib()
     variant_offline = attr.ib()
     eval_speeds = attr.ib()
+    frame_cache_dir = attr.ib()
+    is_augmenting_on_device = attr.ib()
+    is_fusing_for_inference = attr.ib()
+    inference_mode = attr.ib()
+    temporal_threshold = attr.ib()
+    temporal_max_skip = attr.ib()
+    roi_padding = attr.ib()
+    target_fps = attr.ib()
 
 
 @attr.s
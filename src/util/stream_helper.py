@@ -0,0 +1,193 @@
+import threading
+import timeit
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+from util.logger import get_logger
+
+log = get_logger(__file__)
+
+
+class DropOldestQueue(object):
+    """Bounded queue between two pipeline stages that never blocks the producer.
+
+    If the queue is full, put() drops the oldest item, so a slow consumer always gets the most recent frames and
+    the latency stays bounded. After close(), get() returns the remaining items and then None.
+    """
+
+    def __init__(self, maxsize: int = 1):
+        self._items = deque()
+        self._maxsize = maxsize
+        self._condition = threading.Condition()
+        self._is_closed = False
+        self.n_dropped = 0
+
+    def put(self, item) -> None:
+        with self._condition:
+            if len(self._items) >= self._maxsize:
+                self._items.popleft()
+                self.n_dropped += 1
+            self._items.append(item)
+            self._condition.notify()
+
+    def get(self, timeout: Optional[float] = None):
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._items or self._is_closed, timeout=timeout):
+                return None
+            if self._items:
+                return self._items.popleft()
+            return None
+
+    def close(self) -> None:
+        with self._condition:
+            self._is_closed = True
+            self._condition.notify_all()
+
+
+class StageTimer(object):
+    """Thread-safe timing of the stages of a frame loop, logged every log_every_s seconds as the mean time per
+    stage and the number of frames per second that reached the end of the loop.
+    """
+
+    def __init__(self, log_every_s: float = 2.0):
+        self.log_every_s = log_every_s
+        self._lock = threading.Lock()
+        self._times = OrderedDict()
+        self._n_frames = 0
+        self._time_last_log = timeit.default_timer()
+        self.drop_counters = OrderedDict()
+
+    @contextmanager
+    def measure(self, stage: str):
+        time_start = timeit.default_timer()
+        yield
+        self.add(stage, timeit.default_timer() - time_start)
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._times.setdefault(stage, []).append(seconds)
+
+    def tick(self) -> None:
+        """
+        Count a finished frame and log the statistics if they are due
+        """
+        with self._lock:
+            self._n_frames += 1
+            time_now = timeit.default_timer()
+            time_elapsed = time_now - self._time_last_log
+            if time_elapsed < self.log_every_s:
+                return
+            stages = ', '.join('{0} {1:.1f} ms'.format(stage, 1000 * np.mean(times))
+                               for stage, times in self._times.items() if times)
+            drops = ''.join(', dropped {0}: {1}'.format(name, counter())
+                            for name, counter in self.drop_counters.items())
+            log.info('FPS: {0:0.1f} ({1}{2})'.format(self._n_frames / time_elapsed, stages, drops))
+            self._times = OrderedDict((stage, []) for stage in self._times)
+            self._n_frames = 0
+            self._time_last_log = time_now
+
+
+class SyntheticCapture(object):
+    """Stand-in for cv2.VideoCapture producing moving test frames, optionally at a fixed frame rate"""
+
+    def __init__(self, height: int = 480, width: int = 854, n_frames: Optional[int] = None,
+                 fps: Optional[float] = None, seed: int = 0):
+        self.height = height
+        self.width = width
+        self.n_frames = n_frames
+        self.fps = fps
+        self._index = 0
+        self._time_next = timeit.default_timer()
+        background = np.random.RandomState(seed).randint(0, 256, (height, width, 3))
+        self._background = background.astype(np.uint8)
+
+    def isOpened(self) -> bool:
+        return self.n_frames is None or self._index < self.n_frames
+
+    def read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        if not self.isOpened():
+            return False, None
+        if self.fps is not None:
+            delay = self._time_next - timeit.default_timer()
+            if delay > 0:
+                threading.Event().wait(delay)
+            self._time_next = max(self._time_next, timeit.default_timer() - 1 / self.fps) + 1 / self.fps
+
+        img = np.roll(self._background, 8 * self._index, axis=1)
+        # a bright square moving across the frame
+        size = min(self.height, self.width) // 4
+        x = (16 * self._index) % max(self.width - size, 1)
+        y = (self.height - size) // 2
+        img[y:y + size, x:x + size] = 255
+        self._index += 1
+        return True, img
+
+    def release(self) -> None:
+        self.n_frames = self._index
+
+
+def run_pipelined(read: Callable[[], Tuple[bool, Optional[np.ndarray]]], process: Callable[[np.ndarray], object],
+                  render: Callable[[object], bool], timer: StageTimer, queue_size: int = 1) -> None:
+    """Run capture, processing and rendering concurrently, joined by drop-oldest queues.
+
+    read: returns (success, frame) like cv2.VideoCapture.read, runs in a capture thread
+    process: maps a frame to a result, runs in an inference thread
+    render: consumes a result and returns False to stop, runs in the calling thread (GUI calls must stay there)
+    """
+    frames = DropOldestQueue(queue_size)
+    results = DropOldestQueue(queue_size)
+    timer.drop_counters['capture'] = lambda: frames.n_dropped
+    timer.drop_counters['inference'] = lambda: results.n_dropped
+    stop = threading.Event()
+    errors = []
+
+    def capture():
+        try:
+            while not stop.is_set():
+                with timer.measure('capture'):
+                    ret_val, img = read()
+                if not ret_val:
+                    break
+                frames.put(img)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            frames.close()
+
+    def infer():
+        try:
+            while not stop.is_set():
+                img = frames.get()
+                if img is None:
+                    break
+                with timer.measure('inference'):
+                    result = process(img)
+                results.put(result)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            results.close()
+
+    threads = [threading.Thread(target=capture, daemon=True), threading.Thread(target=infer, daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            result = results.get()
+            if result is None:
+                break
+            with timer.measure('render'):
+                is_continuing = render(result)
+            timer.tick()
+            if not is_continuing:
+                break
+    finally:
+        stop.set()
+        frames.close()
+        for thread in threads:
+            thread.join(timeout=1.0)
+    if errors:
+        raise errors[0]
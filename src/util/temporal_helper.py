@@ -0,0 +1,74 @@
+from typing import List, Optional
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from util.logger import get_logger
+
+log = get_logger(__file__)
+
+
+class TemporalPredictor(nn.Module):
+    """Wrap a network to skip its evaluation on frames that barely changed.
+
+    The change between two frames is the mean absolute difference of their grayscale versions, average pooled by
+    downsample, in the units of the (mean subtracted) input. Below threshold the outputs of the last evaluated frame
+    are reused. The network is evaluated at least every max_skip + 1 frames, and always after reset().
+    Only batches of a single frame are compared, larger batches are always evaluated.
+    """
+
+    def __init__(self, net: nn.Module, threshold: float = 2.0, max_skip: int = 5, downsample: int = 8):
+        super(TemporalPredictor, self).__init__()
+        self.net = net
+        self.threshold = threshold
+        self.max_skip = max_skip
+        self.downsample = downsample
+
+        self.n_frames = 0
+        self.n_skipped = 0
+        self._reference = None  # type: Optional[torch.Tensor]
+        self._outputs = None  # type: Optional[List[torch.Tensor]]
+        self._n_skipped_in_row = 0
+
+    def reset(self) -> None:
+        """
+        Forget the last frame, e.g. at the start of a new sequence
+        """
+        self._reference = None
+        self._outputs = None
+        self._n_skipped_in_row = 0
+
+    @property
+    def skip_rate(self) -> float:
+        return self.n_skipped / max(self.n_frames, 1)
+
+    def forward(self, x):
+        self.n_frames += 1
+        if x.size()[0] != 1:
+            self.reset()
+            return self.net(x)
+
+        thumbnail = F.avg_pool2d(x.mean(dim=1, keepdim=True), self.downsample, ceil_mode=True)
+        if self._is_reusable(thumbnail):
+            self.n_skipped += 1
+            self._n_skipped_in_row += 1
+            return self._outputs
+
+        self._outputs = self.net(x)
+        # the reference stays the last evaluated frame, so slow drifts add up until they exceed the threshold
+        self._reference = thumbnail
+        self._n_skipped_in_row = 0
+        return self._outputs
+
+    def _is_reusable(self, thumbnail: torch.Tensor) -> bool:
+        if self._reference is None or self._n_skipped_in_row >= self.max_skip:
+            return False
+        if self._reference.size() != thumbnail.size():
+            return False
+        change = (thumbnail - self._reference).abs().mean().item()
+        return change < self.threshold
+
+    def log_stats(self, name: str = '') -> None:
+        log.info('Temporal {0}: skipped {1} of {2} frames ({3:.1%})'.format(name, self.n_skipped, self.n_frames,
+                                                                          self.skip_rate))